@@ -27,6 +27,7 @@ import boto
 from boto.sts.connection import STSConnection
 from boto.sts.credentials import Credentials
 from boto.exception import BotoServerError
+from boto.regioninfo import RegionInfo
 
 class InvalidClientTokenIdError(BotoServerError):
     '''
@@ -42,19 +43,25 @@ class AsyncAwsSts(STSConnection):
     Usage: Keep an instance of this class (though it should be cheap to
     re instantiate) and periodically call get_session_token to get a new
     Credentials object when, say, your session token expires
+    
+    Requests go through the IOLoop's shared AsyncHTTPClient, unless a
+    asyncdynamo.transport.HTTPTransport is passed as `transport`. They go
+    to STS, or to `host` if one is given.
     '''
     
     def __init__(self, aws_access_key_id=None, aws_secret_access_key=None,
                  is_secure=True, port=None, proxy=None, proxy_port=None,
                  proxy_user=None, proxy_pass=None, debug=0,
                  https_connection_factory=None, region=None, path='/',
-                 converter=None, ioloop=None):
+                 converter=None, ioloop=None, transport=None, host=None):
+        if host and not region:
+            region = RegionInfo(name=host, endpoint=host, connection_cls=STSConnection)
         STSConnection.__init__(self, aws_access_key_id,
                                  aws_secret_access_key,
                                  is_secure, port, proxy, proxy_port,
                                  proxy_user, proxy_pass, debug,
                                  https_connection_factory, region, path, converter)
-        self.http_client = AsyncHTTPClient(io_loop=ioloop)
+        self.http_client = transport or AsyncHTTPClient(io_loop=ioloop)
     
     def get_session_token(self, callback):
         '''
@@ -97,7 +104,7 @@ class AsyncAwsSts(STSConnection):
         The callback should operate on the body of the response, and take an optional
         error argument that will be a tornado error
         '''
-        request = HTTPRequest('https://%s' % self.host, 
+        request = HTTPRequest('%s://%s' % (self.protocol, self.server_name()), 
             method=verb)
         request.params = params
         request.auth_path = '/' # need this for auth
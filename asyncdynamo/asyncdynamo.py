@@ -20,23 +20,167 @@ Copyright (c) 2012 bit.ly. All rights reserved.
 import sys
 assert sys.version_info >= (2, 7), "run this with python2.7"
 
-import simplejson as json
 from tornado.httpclient import HTTPRequest
 from tornado.httpclient import AsyncHTTPClient
 from tornado.ioloop import IOLoop
 import functools
-from collections import deque
 import time
+import calendar
 import logging
+import marshal
 
 from boto.connection import AWSAuthConnection
 from boto.exception import DynamoDBResponseError
 from boto.auth import HmacAuthV3HTTPHandler
 from boto.provider import Provider
+from boto.utils import parse_ts
 
 from async_aws_sts import AsyncAwsSts, InvalidClientTokenIdError
+from retry import RetryPolicy
+from ratelimit import READ_ACTIONS
+from pending import PendingRequestQueue, PendingQueueFullError, PRIORITY_NORMAL
+from codec import JSONCodec, apply_object_hook
+from deadline import RequestHandle, DeadlineExceededError
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None
 
 PENDING_SESSION_TOKEN_UPDATE = "this is not your session token"
+# session tokens are never refreshed sooner than this after one arrives
+MIN_SESSION_TOKEN_REFRESH_DELAY = 5
+
+SINGLE_FLIGHT_ACTIONS = READ_ACTIONS
+
+def _decode_body(codec, body, object_hook=None, postprocess=None, serialize=False):
+    '''
+    Decode, and postprocess, a response body. Returns the result, whether it was
+    serialized with marshal, and the seconds it took.
+    
+    With serialize, the result is returned marshalled if it can be: for a process pool
+    that is much cheaper to load back on the IOLoop than a pickle.
+    '''
+    started = time.time()
+    try:
+        result = codec.decode(body, object_hook=object_hook)
+    except TypeError:
+        result = None
+    if postprocess is not None and result is not None:
+        result = postprocess(result)
+    if serialize:
+        try:
+            return marshal.dumps(result), True, time.time() - started
+        except ValueError:
+            # object_hook or postprocess returned objects marshal does not support
+            pass
+    return result, False, time.time() - started
+
+def _single_table(request_items):
+    '''The table name of a batch request, if it only touches one table'''
+    if len(request_items) == 1:
+        return request_items.keys()[0]
+    return None
+
+def consumed_capacity(table_name, response):
+    '''
+    Map of table name to the ConsumedCapacityUnits reported in a decoded response.
+    Batch actions report units per table; other actions report one number, which
+    is charged to table_name. Responses of the 20120810 API report ConsumedCapacity
+    instead, when asked to.
+    '''
+    if not isinstance(response, dict):
+        return {}
+    if isinstance(response.get('ConsumedCapacity'), dict):
+        return {response['ConsumedCapacity'].get('TableName', table_name):
+                response['ConsumedCapacity'].get('CapacityUnits', 0)}
+    if 'Responses' in response:
+        return dict((name, result.get('ConsumedCapacityUnits', 0))
+                    for name, result in response['Responses'].items() if isinstance(result, dict))
+    if 'ConsumedCapacityUnits' in response:
+        return {table_name: response['ConsumedCapacityUnits']}
+    return {}
+
+class _ReplaySlot(object):
+    '''
+    Wraps the callback of a request replayed from the pending queue, and gives
+    its replay slot back once the request is finished (or queued again).
+    '''
+    
+    def __init__(self, db, callback):
+        self.db = db
+        self.callback = callback
+    
+    def release(self):
+        if self.db is not None:
+            self.db._replaying -= 1
+            self.db.ioloop.add_callback(self.db._replay_pending_requests)
+            self.db = None
+        return self.callback
+    
+    def __call__(self, *args, **kwargs):
+        return self.release()(*args, **kwargs)
+
+class _Hedge(object):
+    '''
+    Sends a read, and sends it again if the first attempt is still unanswered
+    `delay` seconds later and the hedge policy allows it. The first answer goes
+    to callback and the other attempt is cancelled. An attempt that fails while
+    the other one is still out leaves the answer to it.
+    '''
+    
+    def __init__(self, db, action, table_name, callback, handle, send):
+        self.db = db
+        self.action = action
+        self.table_name = table_name
+        self.callback = callback
+        self.handle = handle
+        self.send = send
+        self.started = time.time()
+        self.attempts = []
+        self.finished = False
+        self._timeout = None
+        handle.on_abandon = self.cancel
+    
+    def start(self, delay, record=None):
+        self._send(record)
+        if delay is not None and not self.finished:
+            self._timeout = self.db.ioloop.add_timeout(self.started + delay, self._hedge)
+    
+    def _send(self, record=None):
+        attempt = RequestHandle(self.db.ioloop, functools.partial(self._answer, len(self.attempts)),
+                                self.handle.deadline)
+        self.attempts.append(attempt)
+        self.send(callback=attempt, record=record, handle=attempt)
+    
+    def _hedge(self):
+        self._timeout = None
+        if not self.finished and self.db.hedge_policy.should_hedge(self.table_name):
+            self._send()
+    
+    def _answer(self, index, response, error=None):
+        if self.finished:
+            return
+        if error is not None and not all(attempt.finished for attempt in self.attempts):
+            return
+        if error is None:
+            self.db.hedge_policy.record(self.action, self.table_name, time.time() - self.started,
+                                        hedge_won=index > 0)
+        self._finish(response, error)
+    
+    def cancel(self):
+        '''The request was abandoned, drop whatever attempts are still out'''
+        if not self.finished:
+            self._finish({}, self.handle.error)
+    
+    def _finish(self, response, error):
+        self.finished = True
+        if self._timeout is not None:
+            self.db.ioloop.remove_timeout(self._timeout)
+            self._timeout = None
+        for attempt in self.attempts:
+            attempt.cancel()
+        self.callback(response, error=error)
 
 class AsyncDynamoDB(AWSAuthConnection):
     """
@@ -46,6 +190,65 @@ class AsyncDynamoDB(AWSAuthConnection):
     parametrized with the user's access key and secret key. Make calls with make_request
     or the helper methods, and AsyncDynamoDB will maintain session tokens in the background.
     
+    Requests rejected with a ProvisionedThroughputExceededException are retried with
+    jittered exponential backoff, as configured by `retry_policy` (an instance of
+    asyncdynamo.retry.RetryPolicy). Pass RetryPolicy(max_attempts=1) to disable retries.
+    
+    Optionally, a asyncdynamo.ratelimit.RateLimiter passed as `rate_limiter` holds requests
+    on the IOLoop until their table has read or write capacity left for them.
+    
+    Session tokens are refreshed in the background `session_token_refresh_margin` seconds
+    before they expire (or halfway through their life, if that is sooner, and never less
+    than MIN_SESSION_TOKEN_REFRESH_DELAY seconds after they arrive), while the current
+    token stays in use. Set `prefetch_session_token`
+    to fetch the first token when the instance is created rather than on the first request.
+    
+    Requests made while there is no session token wait in `pending_queue`, a bounded
+    asyncdynamo.pending.PendingRequestQueue, and are replayed by priority once a token arrives,
+    with no more than `pending_replay_concurrency` of them in flight at a time.
+    
+    By default requests go through the IOLoop's shared AsyncHTTPClient. Pass an
+    asyncdynamo.transport.HTTPTransport as `transport` to use a pool of persistent
+    connections instead, optionally opening `prewarm_connections` of them up front.
+    
+    With `single_flight`, concurrent GetItem, BatchGetItem, Query and Scan requests with
+    identical bodies share a single HTTP request.
+    
+    Request bodies are encoded and responses decoded by `codec`, by default an
+    asyncdynamo.codec.JSONCodec using simplejson. JSONCodec('ujson') is usually faster
+    on large responses.
+    
+    Responses of `decode_threshold` bytes or more are decoded in `decode_executor`, a
+    concurrent.futures executor, rather than on the IOLoop, when one is given. With a
+    ProcessPoolExecutor, results come back marshalled, which costs the IOLoop a fraction of
+    decoding them (object hooks and postprocess functions must be picklable). Python 2
+    threads hardly help, as a busy thread keeps the GIL from the IOLoop. `decode_stats`
+    keeps the time spent decoding on the IOLoop ('inline'), in the executor, and loading
+    offloaded results on the IOLoop ('offloaded' 'loop_seconds'); benchmarks/decode_offload.py
+    compares them.
+    
+    Pass an asyncdynamo.instrumentation.Instrumentation as `instrumentation` to time the
+    phases of every request (rate limiting, waiting for a session token, backoff, signing,
+    network, decoding and the callback) and feed them to its sinks.
+    
+    Requests go to `host` over https, or over plain http with is_secure=False, on `port`
+    if one is given. Session tokens come from STS, or from `sts_host` (and `sts_port`)
+    when given, reached the same way; asyncdynamo.standin.DynamoStandIn serves both for
+    tests and benchmarks. With authenticate_requests=False requests are not signed at all.
+    
+    An asyncdynamo.capacity.CapacityTracker passed as `capacity_tracker` totals the capacity
+    consumed per table and action, and counts the hash keys requested most often.
+    An asyncdynamo.recorder.RequestRecorder passed as `request_recorder` logs requests
+    for asyncdynamo.loadgen to replay.
+    
+    make_request and the helpers take a `deadline` and return an
+    asyncdynamo.deadline.RequestHandle, whose cancel() abandons the request.
+    
+    With an asyncdynamo.hedge.HedgePolicy as `hedge_policy`, reads still unanswered after
+    a delay, such as the usual 95th percentile of their latency, are sent a second time,
+    and whichever attempt answers first is used.
+    
+    `throttles` counts the requests to each table that DynamoDB throttled, retried or not.
     
     As in Boto Layer1:
     "This is the lowest-level interface to DynamoDB.  Methods at this
@@ -65,6 +268,9 @@ class AsyncDynamoDB(AWSAuthConnection):
     Version = '20111205'
     """DynamoDB API version."""
     
+    SegmentedScanVersion = '20120810'
+    """DynamoDB API version used by scan_segment, the first one with parallel scans"""
+    
     ThruputError = "ProvisionedThroughputExceededException"
     """The error response returned when provisioned throughput is exceeded"""
     
@@ -77,7 +283,13 @@ class AsyncDynamoDB(AWSAuthConnection):
     def __init__(self, aws_access_key_id=None, aws_secret_access_key=None,
                  is_secure=True, port=None, proxy=None, proxy_port=None,
                  host=None, debug=0, session_token=None,
-                 authenticate_requests=True, validate_cert=True, max_sts_attempts=3, ioloop=None):
+                 authenticate_requests=True, validate_cert=True, max_sts_attempts=3, ioloop=None,
+                 retry_policy=None, rate_limiter=None, session_token_refresh_margin=300,
+                 prefetch_session_token=False, pending_queue=None, pending_replay_concurrency=50,
+                 transport=None, prewarm_connections=0, single_flight=False, codec=None,
+                 decode_executor=None, decode_threshold=256 * 1024, instrumentation=None,
+                 capacity_tracker=None, sts_host=None, sts_port=None,
+                 request_recorder=None, hedge_policy=None):
         if not host:
             host = self.DefaultHost
         self.validate_cert = validate_cert
@@ -88,11 +300,51 @@ class AsyncDynamoDB(AWSAuthConnection):
                                    is_secure, port, proxy, proxy_port,
                                    debug=debug, security_token=session_token)
         self.ioloop = ioloop or IOLoop.instance()
-        self.http_client = AsyncHTTPClient(io_loop=self.ioloop)
-        self.pending_requests = deque()
-        self.sts = AsyncAwsSts(aws_access_key_id, aws_secret_access_key, ioloop=self.ioloop)
+        self.url = '%s://%s' % (self.protocol, self.server_name())
+        self.codec = codec or JSONCodec()
+        self.decode_executor = decode_executor
+        self._decode_marshal = ProcessPoolExecutor is not None and \
+            isinstance(decode_executor, ProcessPoolExecutor)
+        self.decode_threshold = decode_threshold
+        self.decode_stats = {
+            'inline': {'count': 0, 'bytes': 0, 'seconds': 0.0, 'max': 0.0},
+            'offloaded': {'count': 0, 'bytes': 0, 'seconds': 0.0, 'max': 0.0, 'waited': 0.0,
+                          'loop_seconds': 0.0},
+        }
+        self.instrumentation = instrumentation
+        self.http_client = transport or AsyncHTTPClient(io_loop=self.ioloop)
+        if pending_queue is None:
+            pending_queue = PendingRequestQueue()
+        self.pending_requests = pending_queue
+        self.pending_replay_concurrency = pending_replay_concurrency
+        self._replaying = 0
+        if sts_host:
+            self.sts = AsyncAwsSts(aws_access_key_id, aws_secret_access_key, is_secure=is_secure,
+                                   port=sts_port, ioloop=self.ioloop, transport=transport,
+                                   host=sts_host)
+        else:
+            self.sts = AsyncAwsSts(aws_access_key_id, aws_secret_access_key, ioloop=self.ioloop,
+                                   transport=transport)
         assert (isinstance(max_sts_attempts, int) and max_sts_attempts >= 0)
         self.max_sts_attempts = max_sts_attempts
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.throttles = {}
+        self.rate_limiter = rate_limiter
+        if rate_limiter is not None:
+            rate_limiter.bind(self)
+        self.capacity_tracker = capacity_tracker
+        self.request_recorder = request_recorder
+        self.hedge_policy = hedge_policy
+        if capacity_tracker is not None:
+            capacity_tracker.bind(self)
+        self.single_flight = single_flight
+        self._in_flight_reads = {}
+        self.session_token_refresh_margin = session_token_refresh_margin
+        self._refresh_timeout = None
+        if transport is not None and prewarm_connections:
+            transport.prewarm(self.url + '/', prewarm_connections)
+        if prefetch_session_token and self.authenticate_requests and not self.provider.security_token:
+            self._update_session_token(self._init_session_token_cb)
             
     def _init_session_token_cb(self, error=None):
         if error:
@@ -152,13 +404,77 @@ class AsyncDynamoDB(AWSAuthConnection):
                                      creds.session_token)
             # force the correct auth, with the new provider
             self._auth_handler = HmacAuthV3HTTPHandler(self.host, None, self.provider)
-            while self.pending_requests:
-                request = self.pending_requests.pop()
-                request()
+            self._schedule_session_token_refresh(creds)
+            self._replay_pending_requests()
             if callable(callback):
                 return callback()
     
-    def make_request(self, action, body='', callback=None, object_hook=None):
+    def _replay_pending_requests(self):
+        '''
+        Send queued requests, most important first, keeping no more than
+        pending_replay_concurrency of them in flight. Each one that finishes
+        makes room for the next.
+        '''
+        while self._replaying < self.pending_replay_concurrency:
+            if self.provider.security_token in [None, PENDING_SESSION_TOKEN_UPDATE]:
+                return
+            entry = self.pending_requests.pop()
+            if entry is None:
+                return
+            request, callback = entry
+            self._replaying += 1
+            request(callback=_ReplaySlot(self, callback))
+    
+    def _schedule_session_token_refresh(self, creds):
+        '''
+        Arrange for a new session token to be fetched shortly before `creds` expire,
+        so that requests never have to wait for one.
+        '''
+        if self._refresh_timeout is not None:
+            self.ioloop.remove_timeout(self._refresh_timeout)
+            self._refresh_timeout = None
+        if self.session_token_refresh_margin is None or not creds.expiration:
+            return
+        try:
+            expires = calendar.timegm(parse_ts(creds.expiration).timetuple())
+        except ValueError:
+            logging.warning("Unable to parse session token expiration %r, it will be refreshed when it expires" % creds.expiration)
+            return
+        lifetime = expires - time.time()
+        # a token that lives no longer than the margin is refreshed halfway through its life
+        margin = min(self.session_token_refresh_margin, lifetime / 2.0)
+        seconds_to_wait = max(MIN_SESSION_TOKEN_REFRESH_DELAY, lifetime - margin)
+        self._refresh_timeout = self.ioloop.add_timeout(time.time() + seconds_to_wait,
+            self._refresh_session_token)
+    
+    def _refresh_session_token(self, attempts=0):
+        '''
+        Fetch a new session token in the background. Unlike _update_session_token, this
+        leaves the current token in place, so requests keep flowing while STS is called.
+        '''
+        self._refresh_timeout = None
+        if self.provider.security_token in [None, PENDING_SESSION_TOKEN_UPDATE]:
+            # the token is already being replaced the slow way, nothing to do
+            return
+        self.sts.get_session_token(functools.partial(self._refresh_session_token_cb, attempts=attempts))
+    
+    def _refresh_session_token_cb(self, creds, error=None, attempts=0):
+        if error:
+            if self.provider.security_token in [None, PENDING_SESSION_TOKEN_UPDATE]:
+                return
+            if isinstance(error, InvalidClientTokenIdError) or attempts >= self.max_sts_attempts:
+                # keep using the current token; once it expires make_request will fetch a new one
+                logging.error("Unable to refresh session token: %s" % error)
+                return
+            seconds_to_wait = (0.1*(2**attempts))
+            logging.warning("Got error[ %s ] refreshing session token, retrying in %.02f seconds" % (error, seconds_to_wait))
+            self._refresh_timeout = self.ioloop.add_timeout(time.time() + seconds_to_wait,
+                functools.partial(self._refresh_session_token, attempts=attempts+1))
+            return
+        self._update_session_token_cb(creds)
+    
+    def make_request(self, action, body='', callback=None, object_hook=None, table_name=None,
+                     priority=PRIORITY_NORMAL, api_version=None, postprocess=None, deadline=None):
         '''
         Make an asynchronous HTTP request to DynamoDB. Callback should operate on
         the decoded json response (with object hook applied, of course). It should also
@@ -166,14 +482,125 @@ class AsyncDynamoDB(AWSAuthConnection):
         
         If there is not a valid session token, this method will ensure that a new one is fetched
         and cache the request when it is retrieved. 
+        
+        table_name picks the retry budget and the rate limiter buckets the request is
+        charged to; requests made without one share a retry budget and are not rate limited.
+        priority orders the request in the pending queue if it has to wait for a session token
+        (see asyncdynamo.pending).
+        
+        With single_flight enabled, a read that is identical to one already in flight does
+        not go out again; it gets its own copy of the response to the one in flight.
+        
+        api_version overrides the DynamoDB API version (Version) of this request only.
+        
+        postprocess, if given, is applied to successful decoded responses before they are
+        passed to callback, in the decode executor when the response is decoded there. It
+        must not modify the response it is given.
+        
+        With instrumentation, every request that goes out gets a RequestRecord; reads that
+        share one in flight with single_flight are timed as part of it.
+        
+        deadline is a time.time() timestamp (or a datetime.timedelta from now) after which
+        the caller no longer wants the response. It bounds the time the request spends
+        waiting for the rate limiter or a session token, each HTTP attempt, and the backoff
+        before retries: once it passes, the request is dropped wherever it is and callback
+        gets an asyncdynamo.deadline.DeadlineExceededError. Returns a RequestHandle, whose
+        cancel() does the same with a RequestCancelledError. A read sharing a request with
+        single_flight only gives up its own share of it; the request itself is dropped
+        once none of its readers want it any more.
+        
+        With a hedge_policy, a read it covers may be sent twice (see _Hedge); callback gets
+        the first answer. With instrumentation, the record times the first attempt.
         '''
-        this_request = functools.partial(self.make_request, action=action,
-            body=body, callback=callback,object_hook=object_hook)
+        if self.request_recorder is not None:
+            self.request_recorder.record(action, table_name, body)
+        handle = callback = pipeline = RequestHandle(self.ioloop, callback, deadline)
+        if self.single_flight and action in SINGLE_FLIGHT_ACTIONS:
+            key = (action, api_version, body)
+            handle.on_abandon = functools.partial(self._abandon_single_flight, key)
+            in_flight = self._in_flight_reads.get(key)
+            if in_flight is not None:
+                in_flight[1].append((handle, object_hook, postprocess))
+                return handle
+            shared = RequestHandle(self.ioloop, functools.partial(self._finish_single_flight, key))
+            self._in_flight_reads[key] = (shared, [(handle, object_hook, postprocess)])
+            callback = pipeline = shared
+            object_hook = None
+            postprocess = None
+        if self.capacity_tracker is not None:
+            self.capacity_tracker.record_request(action, table_name, body)
+        record = None
+        if self.instrumentation is not None:
+            record = self.instrumentation.start(action, table_name, body)
+            callback = self.instrumentation.wrap_callback(record, callback)
+        if self.hedge_policy is not None and action in self.hedge_policy.actions:
+            hedge = _Hedge(self, action, table_name, callback, pipeline, functools.partial(
+                self._make_request, action, body=body, object_hook=object_hook,
+                table_name=table_name, priority=priority, api_version=api_version,
+                postprocess=postprocess))
+            hedge.start(self.hedge_policy.delay(action, table_name), record)
+            return handle
+        self._make_request(action, body=body, callback=callback, object_hook=object_hook,
+                           table_name=table_name, priority=priority, api_version=api_version,
+                           postprocess=postprocess, record=record, handle=pipeline)
+        return handle
+    
+    def _abandon_single_flight(self, key):
+        '''Drop a shared read once every request waiting on it has given up'''
+        in_flight = self._in_flight_reads.get(key)
+        if in_flight is not None and all(waiter[0].finished for waiter in in_flight[1]):
+            in_flight[0].cancel()
+    
+    def _finish_single_flight(self, key, response, error=None):
+        '''Hand every request waiting on a shared read its own copy of the response'''
+        shared, waiters = self._in_flight_reads.pop(key)
+        for i, (callback, object_hook, postprocess) in enumerate(waiters):
+            if callback.finished:
+                continue
+            waiter_response = response
+            if i or object_hook is not None:
+                waiter_response = apply_object_hook(response, object_hook)
+            if postprocess is not None and not error and waiter_response is not None:
+                waiter_response = postprocess(waiter_response)
+            callback(waiter_response, error=error)
+    
+    def _make_request(self, action, body='', callback=None, object_hook=None, table_name=None,
+                      priority=PRIORITY_NORMAL, api_version=None, postprocess=None, attempts=0,
+                      admitted=False, record=None, handle=None):
+        '''
+        Does the work of make_request. attempts is the number of times this request has
+        already been retried, and admitted is True once the rate limiter has let it through.
+        record is the request's instrumentation.RequestRecord, if it is instrumented.
+        handle is its deadline.RequestHandle; once that is cancelled or past its deadline
+        the request is dropped here, whether it comes from a queue or a backoff.
+        '''
+        this_request = functools.partial(self._make_request, action=action,
+            body=body, callback=callback,object_hook=object_hook,
+            table_name=table_name, attempts=attempts, admitted=admitted, priority=priority,
+            api_version=api_version, postprocess=postprocess, record=record, handle=handle)
+        if record is not None:
+            record.resume()
+        if handle is not None and handle.abandoned():
+            # the handle has already told the caller; this gives back a replay slot and
+            # ends the request's instrumentation record
+            return callback({}, error=handle.error)
+        if self.rate_limiter is not None and not admitted:
+            if record is not None:
+                record.wait('rate_limited')
+            return self.rate_limiter.acquire(action, table_name,
+                functools.partial(this_request, admitted=True), handle)
         if self.authenticate_requests and self.provider.security_token in [None, PENDING_SESSION_TOKEN_UPDATE]:
             # we will not be able to complete this request because we do not have a valid session token.
             # queue it and try to get a new one. _update_session_token will ensure that only one request
             # for a session token goes out at a time
-            self.pending_requests.appendleft(this_request)
+            if isinstance(callback, _ReplaySlot):
+                # this request was being replayed when the token was lost again, give its slot back
+                callback = callback.release()
+                this_request = functools.partial(this_request, callback=callback)
+            if record is not None:
+                record.wait('pending')
+            if not self.pending_requests.push(this_request, callback, priority, handle):
+                callback({}, error=PendingQueueFullError())
             def cb_for_update(error=None):
                 # create a callback to handle errors getting session token
                 # callback here is assumed to take a json response, and an instance of DynamoDBResponseError
@@ -184,38 +611,132 @@ class AsyncDynamoDB(AWSAuthConnection):
             self._update_session_token(cb_for_update)
             return
         headers = {'X-Amz-Target' : '%s_%s.%s' % (self.ServiceName,
-                                                  self.Version, action),
+                                                  api_version or self.Version, action),
                 'Content-Type' : 'application/x-amz-json-1.0',
                 'Content-Length' : str(len(body))}
-        request = HTTPRequest('https://%s' % self.host, 
+        options = {}
+        if handle is not None and handle.deadline is not None:
+            # no attempt outlives the deadline; otherwise keep the client's default timeout
+            options['request_timeout'] = handle.remaining()
+        request = HTTPRequest(self.url, 
             method='POST',
             headers=headers,
             body=body,
-            validate_cert=self.validate_cert)
+            validate_cert=self.validate_cert,
+            **options)
         request.auth_path = '/' # Important! set the path variable for signing by boto. '/' is the path for all dynamodb requests
         if self.authenticate_requests:
-            self._auth_handler.add_auth(request) # add signature to headers of the request
+            if record is not None:
+                signing = time.time()
+                self._auth_handler.add_auth(request)
+                record.signing += time.time() - signing
+            else:
+                self._auth_handler.add_auth(request) # add signature to headers of the request
+        if not attempts:
+            self.retry_policy.record_request(table_name)
+        if record is not None:
+            record.wait('network')
         self.http_client.fetch(request, functools.partial(self._finish_make_request,
-            callback=callback, orig_request=this_request, token_used=self.provider.security_token, object_hook=object_hook)) # bam!
+            callback=callback, orig_request=this_request, token_used=self.provider.security_token,
+            object_hook=object_hook, action=action, table_name=table_name, attempts=attempts,
+            postprocess=postprocess, record=record, handle=handle)) # bam!
     
-    def _finish_make_request(self, response, callback, orig_request, token_used, object_hook=None):
+    def _finish_make_request(self, response, callback, orig_request, token_used, object_hook=None,
+                             action=None, table_name=None, attempts=0, postprocess=None,
+                             record=None, handle=None):
         '''
-        Check for errors and decode the json response (in the tornado response body), then pass on to orig callback.
-        This method also contains some of the logic to handle reacquiring session tokens.
+        Decode the json response (in the tornado response body), in the decode executor if it
+        is large, then pass on to _handle_response.
         '''
-        try:
-            json_response = json.loads(response.body, object_hook=object_hook)
-        except TypeError:
-            json_response = None
+        if response.error:
+            postprocess = None
+        handle_response = functools.partial(self._handle_response, response, callback=callback,
+            orig_request=orig_request, token_used=token_used, action=action,
+            table_name=table_name, attempts=attempts, record=record, handle=handle)
+        size = len(response.body or '')
+        if record is not None:
+            record.resume()
+            record.status = response.code
+            record.response_bytes += size
+        if self.decode_executor is not None and size >= self.decode_threshold:
+            submitted = time.time()
+            future = self.decode_executor.submit(_decode_body, self.codec, response.body,
+                                                 object_hook, postprocess, self._decode_marshal)
+            self.ioloop.add_future(future, functools.partial(self._finish_decode,
+                handle_response, size, submitted, record))
+            return
+        json_response, marshalled, seconds = _decode_body(self.codec, response.body,
+                                                          object_hook, postprocess)
+        self._record_decode('inline', size, seconds)
+        if record is not None:
+            record.decode += seconds
+        handle_response(json_response)
+    
+    def _finish_decode(self, handle_response, size, submitted, record, future):
+        started = time.time()
+        json_response, marshalled, seconds = future.result()
+        if marshalled:
+            json_response = marshal.loads(json_response)
+        finished = time.time()
+        self._record_decode('offloaded', size, seconds, waited=started - submitted,
+                            loop_seconds=finished - started)
+        if record is not None:
+            # what the request waited for, not the executor's share of it
+            record.decode += finished - submitted
+        handle_response(json_response)
+    
+    def _record_decode(self, where, size, seconds, waited=None, loop_seconds=None):
+        stats = self.decode_stats[where]
+        stats['count'] += 1
+        stats['bytes'] += size
+        stats['seconds'] += seconds
+        stats['max'] = max(stats['max'], seconds)
+        if waited is not None:
+            stats['waited'] += waited
+            stats['loop_seconds'] += loop_seconds
+    
+    def _handle_response(self, response, json_response, callback, orig_request, token_used,
+                         action=None, table_name=None, attempts=0, record=None, handle=None):
+        '''
+        Check for errors in the decoded response, then pass it on to orig callback.
+        This method also contains some of the logic to handle reacquiring session tokens, and
+        to retry requests that were throttled.
+        '''
+        if record is not None:
+            record.consumed += sum(consumed_capacity(table_name, json_response).values())
+        if self.rate_limiter is not None or self.capacity_tracker is not None:
+            throttled = bool(response.error and isinstance(json_response, dict) and
+                             self.ThruputError in json_response.get('__type', ''))
+            consumed = consumed_capacity(table_name, json_response)
+            if self.rate_limiter is not None:
+                self.rate_limiter.record(action, table_name, consumed, throttled=throttled)
+            if self.capacity_tracker is not None:
+                self.capacity_tracker.record_response(action, table_name, consumed, throttled=throttled)
 
         if json_response and response.error:
             # Normal error handling where we have a JSON response from AWS.
+            if self.ThruputError in json_response.get('__type', ''):
+                self.throttles[table_name] = self.throttles.get(table_name, 0) + 1
             if any((token_error in json_response.get('__type', []) \
                     for token_error in (self.ExpiredSessionError, self.UnrecognizedClientException))):
                 if self.provider.security_token == token_used:
                     # the token that we used has expired. wipe it out
                     self.provider.security_token = None
-                return orig_request() # make_request will handle logic to get a new token if needed, and queue until it is fetched
+                return orig_request() # _make_request will handle logic to get a new token if needed, and queue until it is fetched
+            elif self.ThruputError in json_response.get('__type', '') and \
+                    self.retry_policy.should_retry(table_name, attempts):
+                seconds_to_wait = self.retry_policy.backoff(attempts)
+                if handle is not None and handle.deadline is not None and \
+                        time.time() + seconds_to_wait >= handle.deadline:
+                    # the retry would go out past the deadline, give up now
+                    return callback(json_response, error=DeadlineExceededError())
+                logging.warning("Request to %s was throttled, retrying in %.02f seconds" % (table_name, seconds_to_wait))
+                if record is not None:
+                    record.retries = attempts + 1
+                    record.wait('backoff')
+                self.ioloop.add_timeout(time.time() + seconds_to_wait,
+                    functools.partial(orig_request, attempts=attempts+1, admitted=False))
+                return
             else:
                 # because some errors are benign, include the response when an error is passed
                 return callback(json_response, error=DynamoDBResponseError(response.error.code, 
@@ -228,7 +749,7 @@ class AsyncDynamoDB(AWSAuthConnection):
             return callback(json_response, error=None)
 
     def get_item(self, table_name, key, callback, attributes_to_get=None,
-            consistent_read=False, object_hook=None):
+            consistent_read=False, object_hook=None, priority=PRIORITY_NORMAL, deadline=None):
         '''
         Return a set of attributes for an item that matches
         the supplied key.
@@ -251,17 +772,40 @@ class AsyncDynamoDB(AWSAuthConnection):
         :type consistent_read: bool
         :param consistent_read: If True, a consistent read
             request is issued.  Otherwise, an eventually consistent
-            request is issued.        '''
-        data = {'TableName': table_name,
-                'Key': key}
-        if attributes_to_get:
-            data['AttributesToGet'] = attributes_to_get
-        if consistent_read:
-            data['ConsistentRead'] = True
-        return self.make_request('GetItem', body=json.dumps(data),
-            callback=callback, object_hook=object_hook)
-    
-    def batch_get_item(self, request_items, callback):
+            request is issued.
+
+        :type priority: int
+        :param priority: Replay priority of the request if it has to
+            wait for a session token, see asyncdynamo.pending.
+
+        :type deadline: float
+        :param deadline: time.time() after which the request is
+            abandoned, see make_request.
+        '''
+        body = self.codec.encode_fields(('TableName', table_name),
+                                        ('Key', key),
+                                        ('AttributesToGet', attributes_to_get or None),
+                                        ('ConsistentRead', True if consistent_read else None))
+        return self.make_request('GetItem', body=body,
+            callback=callback, object_hook=object_hook, table_name=table_name,
+            priority=priority, deadline=deadline)
+    
+    def describe_table(self, table_name, callback, deadline=None):
+        '''
+        Return information about the table, including its key schema
+        and provisioned throughput.
+        
+        The callback should operate on a dict representing the decoded
+        response from DynamoDB
+
+        :type table_name: str
+        :param table_name: The name of the table to describe.
+        '''
+        body = self.codec.encode_fields(('TableName', table_name))
+        return self.make_request('DescribeTable', body,
+                                 callback=callback, table_name=table_name, deadline=deadline)
+
+    def batch_get_item(self, request_items, callback, priority=PRIORITY_NORMAL, deadline=None):
         """
         Return a set of attributes for a multiple items in
         multiple tables using their primary keys.
@@ -272,12 +816,22 @@ class AsyncDynamoDB(AWSAuthConnection):
         :type request_items: dict
         :param request_items: A Python version of the RequestItems
             data structure defined by DynamoDB.
+
+        :type priority: int
+        :param priority: Replay priority of the request if it has to
+            wait for a session token, see asyncdynamo.pending.
+
+        :type deadline: float
+        :param deadline: time.time() after which the request is
+            abandoned, see make_request.
         """
-        data = {'RequestItems' : request_items}
-        json_input = json.dumps(data)
-        self.make_request('BatchGetItem', json_input, callback)
+        body = self.codec.encode_fields(('RequestItems', request_items))
+        return self.make_request('BatchGetItem', body, callback,
+                                 table_name=_single_table(request_items), priority=priority,
+                                 deadline=deadline)
 
-    def put_item(self, table_name, item, callback, expected=None, return_values=None, object_hook=None):
+    def put_item(self, table_name, item, callback, expected=None, return_values=None, object_hook=None,
+                 priority=PRIORITY_NORMAL, deadline=None):
         '''
         Create a new item or replace an old item with a new
         item (including all attributes).  If an item already
@@ -305,42 +859,45 @@ class AsyncDynamoDB(AWSAuthConnection):
             name-value pairs before then were changed.  Possible
             values are: None or 'ALL_OLD'. If 'ALL_OLD' is
             specified and the item is overwritten, the content
-            of the old item is returned.        
+            of the old item is returned.
+
+        :type priority: int
+        :param priority: Replay priority of the request if it has to
+            wait for a session token, see asyncdynamo.pending.
+
+        :type deadline: float
+        :param deadline: time.time() after which the request is
+            abandoned, see make_request.
         '''
-        data = {'TableName' : table_name,
-                'Item' : item}
-        if expected:
-            data['Expected'] = expected
-        if return_values:
-            data['ReturnValues'] = return_values
-        json_input = json.dumps(data)
-        return self.make_request('PutItem', json_input, callback=callback,
-                                 object_hook=object_hook)
-
-    def update_item(self, table_name, key, update_data, callback):
-        data = {
-            "TableName": table_name,
-            "Key": key,
-            "AttributeUpdates": update_data,
-            "ReturnValues": "ALL_NEW",
-        }
-        json_input = json.dumps(data)
-        return self.make_request("UpdateItem", json_input, callback=callback)
+        body = self.codec.encode_fields(('TableName', table_name),
+                                        ('Item', item),
+                                        ('Expected', expected or None),
+                                        ('ReturnValues', return_values or None))
+        return self.make_request('PutItem', body, callback=callback,
+                                 object_hook=object_hook, table_name=table_name,
+                                 priority=priority, deadline=deadline)
 
-    def remove_item(self, table_name, key, callback, expected=None):
-        data = {
-            "TableName": table_name,
-            "Key": key
-        }
-        if expected:
-            data["Expected"] = expected
-        json_input = json.dumps(data)
-        return self.make_request("DeleteItem", json_input, callback=callback)
+    def update_item(self, table_name, key, update_data, callback, priority=PRIORITY_NORMAL,
+                    deadline=None):
+        body = self.codec.encode_fields(("TableName", table_name),
+                                        ("Key", key),
+                                        ("AttributeUpdates", update_data),
+                                        ("ReturnValues", "ALL_NEW"))
+        return self.make_request("UpdateItem", body, callback=callback,
+                                 table_name=table_name, priority=priority, deadline=deadline)
+
+    def remove_item(self, table_name, key, callback, expected=None, priority=PRIORITY_NORMAL,
+                    deadline=None):
+        body = self.codec.encode_fields(("TableName", table_name),
+                                        ("Key", key),
+                                        ("Expected", expected or None))
+        return self.make_request("DeleteItem", body, callback=callback,
+                                 table_name=table_name, priority=priority, deadline=deadline)
 
     def query(self, table_name, hash_key_value, callback, range_key_conditions=None,
               attributes_to_get=None, limit=None, consistent_read=False,
               scan_index_forward=True, exclusive_start_key=None,
-              object_hook=None):
+              object_hook=None, priority=PRIORITY_NORMAL, postprocess=None, deadline=None):
         '''
         Perform a query of DynamoDB.  This version is currently punting
         and expecting you to provide a full and correct JSON body
@@ -380,30 +937,36 @@ class AsyncDynamoDB(AWSAuthConnection):
         :param exclusive_start_key: Primary key of the item from
             which to continue an earlier query.  This would be
             provided as the LastEvaluatedKey in that query.
+
+        :type priority: int
+        :param priority: Replay priority of the request if it has to
+            wait for a session token, see asyncdynamo.pending.
+
+        :type deadline: float
+        :param deadline: time.time() after which the request is
+            abandoned, see make_request.
+
+        :type postprocess: callable
+        :param postprocess: Applied to the decoded response, see
+            make_request.
         '''
-        data = {'TableName': table_name,
-                'HashKeyValue': hash_key_value}
-        if range_key_conditions:
-            data['RangeKeyCondition'] = range_key_conditions
-        if attributes_to_get:
-            data['AttributesToGet'] = attributes_to_get
-        if limit:
-            data['Limit'] = limit
-        if consistent_read:
-            data['ConsistentRead'] = True
-        if scan_index_forward:
-            data['ScanIndexForward'] = True
-        else:
-            data['ScanIndexForward'] = False
-        if exclusive_start_key:
-            data['ExclusiveStartKey'] = exclusive_start_key
-        json_input = json.dumps(data)
-        return self.make_request('Query', body=json_input,
-                                 callback=callback, object_hook=object_hook)
+        body = self.codec.encode_fields(('TableName', table_name),
+                                        ('HashKeyValue', hash_key_value),
+                                        ('RangeKeyCondition', range_key_conditions or None),
+                                        ('AttributesToGet', attributes_to_get or None),
+                                        ('Limit', limit or None),
+                                        ('ConsistentRead', True if consistent_read else None),
+                                        ('ScanIndexForward', bool(scan_index_forward)),
+                                        ('ExclusiveStartKey', exclusive_start_key or None))
+        return self.make_request('Query', body=body,
+                                 callback=callback, object_hook=object_hook,
+                                 table_name=table_name, priority=priority,
+                                 postprocess=postprocess, deadline=deadline)
 
     def scan(self, table_name, callback, scan_filter=None,
               attributes_to_get=None, limit=None, consistent_read=False,
-              exclusive_start_key=None, object_hook=None):
+              exclusive_start_key=None, object_hook=None, priority=PRIORITY_NORMAL,
+              postprocess=None, deadline=None):
         '''
         Perform a scan of DynamoDB.  This version is currently punting
         and expecting you to provide a full and correct JSON body
@@ -436,18 +999,67 @@ class AsyncDynamoDB(AWSAuthConnection):
         :param exclusive_start_key: Primary key of the item from
             which to continue an earlier query.  This would be
             provided as the LastEvaluatedKey in that query.
+
+        :type priority: int
+        :param priority: Replay priority of the request if it has to
+            wait for a session token, see asyncdynamo.pending.
+
+        :type deadline: float
+        :param deadline: time.time() after which the request is
+            abandoned, see make_request.
+
+        :type postprocess: callable
+        :param postprocess: Applied to the decoded response, see
+            make_request.
+        '''
+        body = self.codec.encode_fields(('TableName', table_name),
+                                        ('ScanFilter', scan_filter or None),
+                                        ('AttributesToGet', attributes_to_get or None),
+                                        ('Limit', limit or None),
+                                        ('ConsistentRead', True if consistent_read else None),
+                                        ('ExclusiveStartKey', exclusive_start_key or None))
+        return self.make_request('Scan', body=body,
+                                 callback=callback, object_hook=object_hook,
+                                 table_name=table_name, priority=priority,
+                                 postprocess=postprocess, deadline=deadline)
+
+    def scan_segment(self, table_name, segment, total_segments, callback, scan_filter=None,
+                     attributes_to_get=None, limit=None, consistent_read=False,
+                     exclusive_start_key=None, object_hook=None, priority=PRIORITY_NORMAL,
+                     postprocess=None, deadline=None):
+        '''
+        Scan one segment of a table split in total_segments segments, so that
+        several can be scanned in parallel. This uses the 20120810 API
+        (SegmentedScanVersion), whose keys name their attributes: the
+        LastEvaluatedKey of the response, and the exclusive_start_key to
+        pass back, look like {"id": {"S": "abc"}} rather than having a
+        HashKeyElement and a RangeKeyElement. Items and scan_filter have the
+        same format as in scan. The response reports ConsumedCapacity rather
+        than ConsumedCapacityUnits.
+
+        :type segment: int
+        :param segment: The segment to scan, from 0 to total_segments - 1.
+
+        :type total_segments: int
+        :param total_segments: The number of segments the table is split in.
+
+        :type exclusive_start_key: dict
+        :param exclusive_start_key: The LastEvaluatedKey of the previous
+            page of this segment.
+
+        See scan for the other arguments.
         '''
-        data = {'TableName': table_name}
-        if scan_filter:
-            data['ScanFilter'] = scan_filter
-        if attributes_to_get:
-            data['AttributesToGet'] = attributes_to_get
-        if limit:
-            data['Limit'] = limit
-        if consistent_read:
-            data['ConsistentRead'] = True
-        if exclusive_start_key:
-            data['ExclusiveStartKey'] = exclusive_start_key
-        json_input = json.dumps(data)
-        return self.make_request('Scan', body=json_input,
-                                 callback=callback, object_hook=object_hook)
+        body = self.codec.encode_fields(('TableName', table_name),
+                                        ('Segment', segment),
+                                        ('TotalSegments', total_segments),
+                                        ('ReturnConsumedCapacity', 'TOTAL'),
+                                        ('ScanFilter', scan_filter or None),
+                                        ('AttributesToGet', attributes_to_get or None),
+                                        ('Limit', limit or None),
+                                        ('ConsistentRead', True if consistent_read else None),
+                                        ('ExclusiveStartKey', exclusive_start_key or None))
+        return self.make_request('Scan', body=body,
+                                 callback=callback, object_hook=object_hook,
+                                 table_name=table_name, priority=priority,
+                                 api_version=self.SegmentedScanVersion,
+                                 postprocess=postprocess, deadline=deadline)
@@ -0,0 +1,550 @@
+#!/bin/env python
+#
+# Copyright 2013 bit.ly
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Batching of requests made through GenDynamoTable and GenDynamo.
+"""
+
+from collections import OrderedDict, deque
+import functools
+import json
+import logging
+import time
+
+from boto.exception import DynamoDBResponseError
+from tornado import gen
+from tornado import stack_context
+
+from asyncdynamo import _single_table
+from deadline import absolute_deadline
+
+MAX_BATCH_GET_KEYS = 100
+MAX_BATCH_WRITE_ITEMS = 25
+MAX_REQUEST_BYTES = 1024 * 1024
+
+
+class BatchIncompleteError(DynamoDBResponseError):
+    '''
+    Error passed to the callback of a batch job that still had unprocessed
+    keys or items when its timeout expired
+    '''
+
+    def __init__(self, remaining):
+        message = "%d requests were still unprocessed when the batch timed out" % remaining
+        DynamoDBResponseError.__init__(self, None, message, {"message": message})
+
+
+def key_id(key):
+    '''A hashable, canonical representation of a DynamoDB key'''
+    return json.dumps(key, sort_keys=True)
+
+
+def item_key(item, hash_key_name, range_key_name=None):
+    '''The DynamoDB key of a packed item'''
+    key = {"HashKeyElement": item[hash_key_name]}
+    if range_key_name:
+        key["RangeKeyElement"] = item[range_key_name]
+    return key
+
+
+class GetBatcher(object):
+    '''
+    Collects the keys requested through GenDynamoTable.get during one IOLoop
+    iteration (or during `window` seconds, if it is not 0) and fetches them
+    with as few BatchGetItem requests as possible.
+
+    Keys requested more than once are only fetched once. Every caller gets a
+    GetItem-like response: {"Item": item} if the item exists, {} otherwise.
+    Keys that DynamoDB leaves unprocessed are queued again after a backoff
+    given by the connection's retry policy; callers of a key still
+    unprocessed `timeout` seconds after it was first queued get a
+    BatchIncompleteError.
+    '''
+
+    def __init__(self, table, window=0, timeout=60):
+        self.table = table
+        self.window = window
+        self.timeout = timeout
+        self.pending = {}
+        self._timeout = None
+
+    def load(self, key, callback, attrs=None):
+        '''
+        Queue a key. callback will be called with a GetItem-like response and an
+        error argument, just like the callback of AsyncDynamoDB.get_item.
+        '''
+        attrs = tuple(sorted(attrs)) if attrs else None
+        group = self.pending.setdefault(attrs, OrderedDict())
+        entry = group.get(key_id(key))
+        if entry is None:
+            # (key, callbacks, times it was unprocessed, when it was first queued)
+            entry = group[key_id(key)] = (key, [], 0, time.time())
+        entry[1].append(callback)
+        self._schedule(self.window)
+
+    def _schedule(self, delay):
+        if self._timeout is None:
+            self._timeout = self.table._db.ioloop.add_timeout(time.time() + delay, self.flush)
+
+    def flush(self):
+        '''Send everything queued so far'''
+        if self._timeout is not None:
+            self.table._db.ioloop.remove_timeout(self._timeout)
+            self._timeout = None
+        pending, self.pending = self.pending, {}
+        for attrs, group in pending.items():
+            entries = group.items()
+            for i in range(0, len(entries), MAX_BATCH_GET_KEYS):
+                self._send(attrs, OrderedDict(entries[i:i + MAX_BATCH_GET_KEYS]))
+
+    def _send(self, attrs, entries):
+        request = {"Keys": [entry[0] for entry in entries.values()]}
+        if attrs:
+            # the key attributes are needed to match items to callers
+            request["AttributesToGet"] = list(set(attrs) | set(self._key_names()))
+        self.table._db.batch_get_item({self.table._table_name: request},
+            functools.partial(self._on_response, attrs, entries))
+
+    def _key_names(self):
+        return [name for name in (self.table.hash_key_name, self.table.range_key_name) if name]
+
+    def _on_response(self, attrs, entries, response, error=None):
+        if error:
+            for entry in entries.values():
+                for callback in entry[1]:
+                    callback(response, error=error)
+            return
+        result = response.get("Responses", {}).get(self.table._table_name, {})
+        unprocessed = response.get("UnprocessedKeys", {}).get(self.table._table_name, {})
+        extra = set(self._key_names()) - set(attrs) if attrs else ()
+        items = {}
+        for item in result.get("Items", []):
+            items[key_id(item_key(item, self.table.hash_key_name, self.table.range_key_name))] = item
+        unprocessed = set(key_id(key) for key in unprocessed.get("Keys", []))
+        now = time.time()
+        retry, expired, expired_keys = OrderedDict(), [], 0
+        for kid, (key, callbacks, attempts, queued) in entries.items():
+            if kid not in unprocessed:
+                item = items.get(kid)
+                for callback in callbacks:
+                    if item is None:
+                        callback({}, error=None)
+                    else:
+                        callback({"Item": dict((k, v) for k, v in item.items() if k not in extra)},
+                                 error=None)
+            elif now >= queued + self.timeout:
+                expired.extend(callbacks)
+                expired_keys += 1
+            else:
+                retry[kid] = (key, callbacks, attempts + 1, queued)
+        if expired:
+            error = BatchIncompleteError(expired_keys)
+            for callback in expired:
+                callback(error.body, error=error)
+        if retry:
+            attempts = max(entry[2] for entry in retry.values())
+            seconds_to_wait = self.table._db.retry_policy.backoff(attempts - 1)
+            self.table._db.ioloop.add_timeout(now + seconds_to_wait,
+                                              functools.partial(self._requeue, attrs, retry))
+
+    def _requeue(self, attrs, entries):
+        group = self.pending.setdefault(attrs, OrderedDict())
+        for kid, entry in entries.items():
+            queued = group.get(kid)
+            if queued is not None:
+                # callers that asked for the key in the meantime wait with the others
+                entry[1].extend(queued[1])
+            group[kid] = entry
+        self._schedule(self.window)
+
+
+class BatchJob(object):
+    '''
+    Sends any number of BatchGetItem or BatchWriteItem requests.
+
+    `requests` is a list of (table_name, request) pairs, where a request is a
+    key for BatchGetItem and a PutRequest or DeleteRequest for BatchWriteItem.
+    They are split into chunks that respect the API's limits on items and
+    bytes per call, and up to `concurrency` chunks are sent at a time. Keys or
+    items that DynamoDB leaves unprocessed are sent again, after a backoff
+    given by the connection's retry policy, until everything is processed or
+    `timeout` seconds have passed. With a `deadline` (see
+    AsyncDynamoDB.make_request), every call carries it too, and resubmitting
+    stops there if that comes first.
+
+    callback is called once, with a response shaped like the response to a
+    single call (the "Responses" of every chunk merged together) and an error
+    argument.
+
+    Subclasses describe their action with class attributes: `list_field`
+    names the list that holds a table's requests in RequestItems and
+    UnprocessedKeys (None when they are listed directly), `unprocessed_field`
+    where the response returns the requests to send again, `items_field` the
+    results to collect for each table, and `unique` whether duplicate requests
+    are dropped. `attrs` maps table names to the AttributesToGet for that
+    table, for actions that read.
+    '''
+
+    action = None
+    max_items = None
+    list_field = None
+    unprocessed_field = None
+    items_field = None
+    unique = False
+
+    def __init__(self, db, requests, callback, attrs=None, concurrency=4, timeout=60,
+                 deadline=None):
+        self.db = db
+        self.callback = callback
+        self.attrs = attrs or {}
+        self.concurrency = concurrency
+        self.deadline = time.time() + timeout
+        self.request_deadline = absolute_deadline(deadline)
+        if self.request_deadline is not None:
+            self.deadline = min(self.deadline, self.request_deadline)
+        if self.unique:
+            requests = OrderedDict(((table_name, key_id(request)), (table_name, request))
+                                   for table_name, request in requests).values()
+        self.chunks = deque(self._chunk(requests))
+        self.in_flight = 0
+        self.resubmits = 0
+        self.unprocessed = 0
+        self.finished = False
+        self.result = {"Responses": {}}
+
+    def start(self):
+        self._pump()
+        return self
+
+    def _chunk(self, requests):
+        chunk, size = [], 0
+        for request in requests:
+            request_size = len(self.db.codec.encode(request[1]))
+            if chunk and (len(chunk) >= self.max_items or size + request_size > MAX_REQUEST_BYTES):
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(request)
+            size += request_size
+        if chunk:
+            yield chunk
+
+    def _pump(self):
+        if self.finished:
+            return
+        while self.chunks and self.in_flight < self.concurrency:
+            self.in_flight += 1
+            self._send(self.chunks.popleft())
+        if not self.chunks and not self.in_flight and not self.unprocessed:
+            self._finish(None)
+
+    def _send(self, chunk):
+        request_items = {}
+        for table_name, request in chunk:
+            request_items.setdefault(table_name, []).append(request)
+        if self.list_field is not None:
+            for table_name, requests in request_items.items():
+                table_request = request_items[table_name] = {self.list_field: requests}
+                if self.attrs.get(table_name):
+                    table_request["AttributesToGet"] = self.attrs[table_name]
+        body = self.db.codec.encode_fields(("RequestItems", request_items))
+        self.db.make_request(self.action, body=body,
+                             callback=self._on_response, table_name=_single_table(request_items),
+                             deadline=self.request_deadline)
+
+    def _on_response(self, response, error=None):
+        self.in_flight -= 1
+        if self.finished:
+            return
+        if error:
+            return self._finish(error, response)
+        for table_name, result in response.get("Responses", {}).items():
+            self._merge(table_name, result)
+        unprocessed = self._unprocessed(response)
+        if unprocessed:
+            if time.time() >= self.deadline:
+                return self._finish(BatchIncompleteError(len(unprocessed) + self.unprocessed))
+            self.unprocessed += len(unprocessed)
+            seconds_to_wait = self.db.retry_policy.backoff(self.resubmits)
+            self.resubmits += 1
+            self.db.ioloop.add_timeout(time.time() + seconds_to_wait,
+                                       functools.partial(self._resubmit, unprocessed))
+        self._pump()
+
+    def _resubmit(self, requests):
+        self.unprocessed -= len(requests)
+        self.chunks.extend(self._chunk(requests))
+        self._pump()
+
+    def _merge(self, table_name, result):
+        merged = self.result["Responses"].setdefault(table_name, {"ConsumedCapacityUnits": 0})
+        merged["ConsumedCapacityUnits"] += result.get("ConsumedCapacityUnits", 0)
+        if self.items_field is not None:
+            merged.setdefault(self.items_field, []).extend(result.get(self.items_field, []))
+
+    def _unprocessed(self, response):
+        unprocessed = []
+        for table_name, requests in response.get(self.unprocessed_field, {}).items():
+            if self.list_field is not None:
+                requests = requests.get(self.list_field, [])
+            unprocessed.extend((table_name, request) for request in requests)
+        return unprocessed
+
+    def _finish(self, error, response=None):
+        self.finished = True
+        if error:
+            return self.callback(response or error.body or {}, error=error)
+        return self.callback(self.result, error=None)
+
+
+class BatchGetJob(BatchJob):
+    '''BatchJob for BatchGetItem. Duplicate keys are only requested once.'''
+
+    action = 'BatchGetItem'
+    max_items = MAX_BATCH_GET_KEYS
+    list_field = "Keys"
+    unprocessed_field = "UnprocessedKeys"
+    items_field = "Items"
+    unique = True
+
+
+class BatchWriteJob(BatchJob):
+    '''BatchJob for BatchWriteItem'''
+
+    action = 'BatchWriteItem'
+    max_items = MAX_BATCH_WRITE_ITEMS
+    unprocessed_field = "UnprocessedItems"
+
+
+class BatchWriter(object):
+    '''
+    Buffers puts and deletes and sends them as BatchWriteItem requests.
+
+    The buffer is flushed once it holds `max_items` writes or `max_bytes` of
+    requests, and `flush_interval` seconds after the first write buffered
+    since the last flush. A later write to a key that is still buffered
+    replaces the earlier one. A write to a key whose previous write is still
+    in flight stays buffered until that write has landed, so writes to a key
+    always land in order. No more than `concurrency` flushes are in flight
+    at a time; writes made meanwhile are sent together by the next flush.
+
+    `put` and `delete` return a gen.Task that completes when the write has
+    landed (or been replaced by a later write that landed). `flush` sends
+    everything buffered right away, and `close` does the same and refuses
+    further writes; the tasks they return complete once nothing is left
+    buffered or in flight.
+
+    target is the GenDynamoTable or GenDynamo the writes are for. Writes to
+    a GenDynamo must name their table.
+    '''
+
+    def __init__(self, target, max_items=MAX_BATCH_WRITE_ITEMS, max_bytes=MAX_REQUEST_BYTES,
+                 flush_interval=0.1, concurrency=4, timeout=60):
+        self.target = target
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.buffer = OrderedDict()
+        self.size = 0
+        self.in_flight = 0
+        self.in_flight_keys = set()
+        self.closed = False
+        self._timeout = None
+        self._drain_callbacks = []
+
+    def _table(self, table):
+        if table is None:
+            if hasattr(self.target, '_tables'):
+                raise KeyError("a table is needed to write through a GenDynamo")
+            return self.target
+        return getattr(self.target, table)
+
+    def put(self, item, table=None):
+        tbl = self._table(table)
+        hash_key, range_key, rest = tbl._extract_keys(item)
+        key = tbl._key(hash_key, range_key)
+        return gen.Task(self._add, tbl, key, {"PutRequest": {"Item": tbl._pack(item)}})
+
+    def delete(self, key, table=None):
+        tbl = self._table(table)
+        hash_key, range_key, rest = tbl._extract_keys(key)
+        if rest:
+            raise KeyError("%r arguments are not supported "
+                           "for `delete` method" % rest)
+        key = tbl._key(hash_key, range_key)
+        return gen.Task(self._add, tbl, key, {"DeleteRequest": {"Key": key}})
+
+    def _add(self, tbl, key, request, callback):
+        if self.closed:
+            raise RuntimeError("BatchWriter is closed")
+        # errors are raised by _written, make sure they reach this caller
+        callbacks = [stack_context.wrap(functools.partial(self._written, tbl, key, callback))]
+        tbl._invalidate([key])
+        bid = (tbl._table_name, key_id(key))
+        size = len(tbl._db.codec.encode(request))
+        previous = self.buffer.pop(bid, None)
+        if previous is not None:
+            callbacks = previous[1] + callbacks
+            self.size -= previous[2]
+        self.buffer[bid] = (request, callbacks, size)
+        self.size += size
+        if len(self.buffer) >= self.max_items or self.size >= self.max_bytes:
+            self._send()
+        elif self._timeout is None:
+            self._timeout = self.target._db.ioloop.add_timeout(time.time() + self.flush_interval,
+                                                               self._send)
+
+    def _written(self, tbl, key, callback, response, error=None):
+        tbl._invalidate([key])
+        tbl._check_error(response, error)
+        callback(None)
+
+    def _send(self):
+        if self._timeout is not None:
+            self.target._db.ioloop.remove_timeout(self._timeout)
+            self._timeout = None
+        if self.in_flight >= self.concurrency:
+            return
+        ready = [bid for bid in self.buffer if bid not in self.in_flight_keys]
+        if not ready:
+            return
+        requests, callbacks = [], []
+        for bid in ready:
+            request, request_callbacks, size = self.buffer.pop(bid)
+            self.size -= size
+            requests.append((bid[0], request))
+            callbacks.extend(request_callbacks)
+        self.in_flight += 1
+        self.in_flight_keys.update(ready)
+        BatchWriteJob(self.target._db, requests,
+                      functools.partial(self._on_flushed, ready, callbacks),
+                      concurrency=self.concurrency, timeout=self.timeout).start()
+
+    def _on_flushed(self, bids, callbacks, response, error=None):
+        self.in_flight -= 1
+        self.in_flight_keys.difference_update(bids)
+        for callback in callbacks:
+            callback(response, error=error)
+        if self.buffer and (self.closed or self._drain_callbacks or len(self.buffer) >= self.max_items
+                            or self.size >= self.max_bytes or self._timeout is None):
+            self._send()
+        self._check_drained()
+
+    def _check_drained(self):
+        if not self.buffer and not self.in_flight:
+            drain_callbacks, self._drain_callbacks = self._drain_callbacks, []
+            for callback in drain_callbacks:
+                callback()
+
+    def flush(self):
+        '''Send everything buffered now, returns a gen.Task'''
+        return gen.Task(self._flush)
+
+    def _flush(self, callback):
+        self._drain_callbacks.append(callback)
+        self._send()
+        self._check_drained()
+
+    def close(self):
+        '''Flush and refuse further writes, returns a gen.Task'''
+        self.closed = True
+        return self.flush()
+
+
+class IncrementAggregator(object):
+    '''
+    Adds up GenDynamoTable.increment calls in memory, per key and field, and
+    writes the totals with one UpdateItem per key.
+
+    Totals are written every `interval` seconds, or as soon as `max_increments`
+    increments are waiting or `max_keys` keys have totals waiting, whichever
+    comes first. `callback`, if given, is called with the unpacked ALL_NEW
+    attributes returned for every key written. Totals that fail to be written
+    are logged and dropped.
+
+    `flush` writes everything now and `close` also stops aggregation; the
+    gen.Task they return completes when all writes have landed.
+    '''
+
+    def __init__(self, table, interval=1.0, max_increments=10000, max_keys=1000, callback=None):
+        self.table = table
+        self.interval = interval
+        self.max_increments = max_increments
+        self.max_keys = max_keys
+        self.callback = callback
+        self.pending = OrderedDict()
+        self.count = 0
+        self.in_flight = 0
+        self._timeout = None
+        self._drain_callbacks = []
+
+    def add(self, key, deltas, callback=None):
+        '''Add deltas ({field: number}) to the totals waiting for key'''
+        totals = self.pending.get(key_id(key))
+        if totals is None:
+            totals = self.pending[key_id(key)] = (key, {})
+        for field, delta in deltas.items():
+            totals[1][field] = totals[1].get(field, 0) + delta
+        self.count += 1
+        if len(self.pending) >= self.max_keys or self.count >= self.max_increments:
+            self._send()
+        elif self._timeout is None:
+            self._timeout = self.table._db.ioloop.add_timeout(time.time() + self.interval, self._send)
+        if callable(callback):
+            callback(None)
+
+    def _send(self):
+        if self._timeout is not None:
+            self.table._db.ioloop.remove_timeout(self._timeout)
+            self._timeout = None
+        pending, self.pending = self.pending, OrderedDict()
+        self.count = 0
+        for key, totals in pending.values():
+            update_data = dict((field, {"Value": self.table._pack_val(total), "Action": "ADD"})
+                               for field, total in totals.items() if total)
+            if not update_data:
+                continue
+            self.in_flight += 1
+            self.table._db.update_item(self.table._table_name, key, update_data,
+                                       self.table._invalidating([key], functools.partial(self._on_written, key, totals)))
+
+    def _on_written(self, key, totals, response, error=None):
+        self.in_flight -= 1
+        if error:
+            logging.error("Unable to write increments %r to %r: %s" % (totals, key, error))
+        elif callable(self.callback):
+            self.callback(self.table._unpack(response.get("Attributes", {})))
+        if not self.in_flight and not self.pending:
+            drain_callbacks, self._drain_callbacks = self._drain_callbacks, []
+            for callback in drain_callbacks:
+                callback()
+
+    def flush(self):
+        '''Write all waiting totals now, returns a gen.Task'''
+        return gen.Task(self._flush)
+
+    def _flush(self, callback):
+        self._send()
+        if self.in_flight:
+            self._drain_callbacks.append(callback)
+        else:
+            callback()
+
+    def close(self):
+        '''Flush, and send further increments straight to DynamoDB. Returns a gen.Task'''
+        if self.table._increment_aggregator is self:
+            self.table._increment_aggregator = None
+        return self.flush()
@@ -0,0 +1,145 @@
+#!/bin/env python
+#
+# Copyright 2013 bit.ly
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+In-process cache of DynamoDB items for GenDynamoTable.
+"""
+
+from collections import OrderedDict
+import time
+
+
+def item_size(item):
+    '''Approximate size in bytes of a packed item'''
+    if item is None:
+        return 64
+    size = 64
+    for name, value in item.items():
+        size += len(name) + 16
+        for typed_value in value.values():
+            if isinstance(typed_value, list):
+                size += sum(len(v) for v in typed_value)
+            else:
+                size += len(typed_value)
+    return size
+
+
+class ItemCache(object):
+    '''
+    LRU cache of packed items, keyed by asyncdynamo.batch.key_id.
+
+    Holds at most `max_items` items and, if `max_bytes` is set, about that many
+    bytes of them; the least recently used are evicted first. Items expire
+    `ttl` seconds after they were fetched. Keys found not to exist are
+    remembered for `miss_ttl` seconds, or not at all if it is None.
+
+    A fetch that started before a key was invalidated does not fill the cache
+    for that key, so a read racing with a write cannot store the old item.
+    Invalidations are only remembered while a fetch older than them is still
+    outstanding.
+    '''
+
+    def __init__(self, max_items=10000, max_bytes=None, ttl=60, miss_ttl=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.items = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._epoch = 0
+        # tokens of outstanding fetches, oldest first: {epoch: fetches}
+        self._fetching = OrderedDict()
+        # invalidated keys, in the order of their epochs: {key: epoch}
+        self._invalidated = OrderedDict()
+
+    def get(self, key):
+        '''Returns (True, item) on a hit, item being None for a cached miss, or (False, None)'''
+        entry = self.items.get(key)
+        if entry is not None:
+            expires, item, size = entry
+            if expires > time.time():
+                # move to the most recently used end
+                del self.items[key]
+                self.items[key] = entry
+                self.hits += 1
+                return True, item
+            self._remove(key)
+        self.misses += 1
+        return False, None
+
+    def begin(self):
+        '''Call before fetching items that will fill the cache, returns a token for fill and end'''
+        self._fetching[self._epoch] = self._fetching.get(self._epoch, 0) + 1
+        return self._epoch
+
+    def fill(self, key, item, token):
+        '''Cache the result of a fetch, unless key was invalidated since it began'''
+        if self._invalidated.get(key, -1) > token:
+            return
+        if item is None and self.miss_ttl is None:
+            return
+        self._remove(key)
+        size = item_size(item)
+        self.items[key] = (time.time() + (self.ttl if item is not None else self.miss_ttl), item, size)
+        self.bytes += size
+        while self.items and (len(self.items) > self.max_items or
+                              (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            self._remove(next(iter(self.items)))
+            self.evictions += 1
+
+    def end(self, token):
+        '''Call once a fetch is done, successful or not'''
+        self._fetching[token] -= 1
+        if self._fetching[token]:
+            return
+        del self._fetching[token]
+        if not self._fetching:
+            self._invalidated.clear()
+            return
+        # only fetches that began before an invalidation care about it
+        oldest = next(iter(self._fetching))
+        while self._invalidated:
+            key, epoch = next(self._invalidated.iteritems())
+            if epoch > oldest:
+                break
+            del self._invalidated[key]
+
+    def invalidate(self, key):
+        self._remove(key)
+        if self._fetching:
+            self._epoch += 1
+            self._invalidated.pop(key, None)
+            self._invalidated[key] = self._epoch
+
+    def _remove(self, key):
+        entry = self.items.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def clear(self):
+        self.items.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {
+            'items': len(self.items),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
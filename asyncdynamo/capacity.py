@@ -0,0 +1,275 @@
+#!/bin/env python
+#
+# Copyright 2013 bit.ly
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Accounting of the capacity consumed per table and action, and of the hash
+keys requested most often.
+"""
+
+from collections import deque
+import logging
+import random
+import time
+
+from tornado.ioloop import PeriodicCallback
+
+from ratelimit import action_kind
+
+# actions whose requests name the hash keys they touch
+KEYED_ACTIONS = frozenset(['GetItem', 'UpdateItem', 'DeleteItem', 'Query', 'PutItem',
+                           'BatchGetItem', 'BatchWriteItem'])
+
+
+class SpaceSaving(object):
+    '''
+    The Space-Saving heavy hitters sketch (Metwally et al.): counts at most
+    `capacity` keys, and a key that is not counted replaces the one with the
+    lowest count, inheriting that count as its error. Any key seen more than
+    total / capacity times is counted, and no count is off by more than its
+    error. Counts are kept in buckets by value so that every update is O(1).
+    '''
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.counts = {}
+        self.buckets = {}
+        self.min_count = 0
+        self.total = 0
+
+    def _move(self, key, old, new):
+        keys = self.buckets[old]
+        keys.discard(key)
+        if not keys:
+            del self.buckets[old]
+            if old == self.min_count:
+                self.min_count = new
+        self.buckets.setdefault(new, set()).add(key)
+
+    def add(self, key):
+        self.total += 1
+        entry = self.counts.get(key)
+        if entry is not None:
+            self._move(key, entry[0], entry[0] + 1)
+            entry[0] += 1
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = [1, 0]
+            self.buckets.setdefault(1, set()).add(key)
+            self.min_count = 1
+        else:
+            floor = self.min_count
+            victim = self.buckets[floor].pop()
+            del self.counts[victim]
+            if not self.buckets[floor]:
+                del self.buckets[floor]
+                self.min_count = floor + 1
+            self.counts[key] = [floor + 1, floor]
+            self.buckets.setdefault(floor + 1, set()).add(key)
+
+    def top(self, n=10):
+        '''[(key, count, error), ...] of the n most counted keys'''
+        ranked = sorted(self.counts.items(), key=lambda item: item[1][0], reverse=True)
+        return [(key, count, error) for key, (count, error) in ranked[:n]]
+
+
+def _hash_key(key):
+    '''The value of a packed HashKeyElement ({"S": "abc"} is "abc")'''
+    if isinstance(key, dict) and len(key) == 1:
+        return key.values()[0]
+    return None
+
+
+class CapacityTracker(object):
+    '''
+    Totals the capacity units consumed, requests and throttled requests per
+    table and action over sliding windows, and keeps a SpaceSaving sketch
+    of the hash keys requested from each table, to spot hot partitions.
+
+    Windows are made of `resolution` second buckets, the longest of
+    `windows` seconds being kept. The hash keys of a `key_sample_rate`
+    share of requests are counted: finding them means decoding the request
+    body again, so by default only 1% are, which still shows the keys that
+    are requested much more than others. 1.0 counts all of them. PutItem and
+    BatchWriteItem puts only carry the item, so their keys are only counted
+    for tables whose hash key attribute is in `hash_keys` ({table_name:
+    attribute}; GenDynamo fills it in for its tables).
+
+    Pass an instance to AsyncDynamoDB with the `capacity_tracker` argument,
+    then poll `totals` and `hot_keys`, or `dump` both, possibly every few
+    seconds with `report_every`.
+    '''
+
+    def __init__(self, windows=(60, 300), resolution=5, top_keys=100, key_sample_rate=0.01,
+                 hash_keys=None):
+        self.windows = tuple(sorted(windows))
+        self.resolution = resolution
+        self.top_keys = top_keys
+        self.key_sample_rate = key_sample_rate
+        self.hash_keys = dict(hash_keys or {})
+        self.buckets = deque()
+        self.sketches = {}
+        self.keys_since = time.time()
+        self.db = None
+
+    def bind(self, db):
+        '''Attach to the AsyncDynamoDB instance whose requests are tracked'''
+        self.db = db
+
+    def set_hash_key(self, table_name, attribute):
+        self.hash_keys[table_name] = attribute
+
+    def _bucket(self, now):
+        start = int(now // self.resolution) * self.resolution
+        if not self.buckets or self.buckets[-1][0] != start:
+            self.buckets.append((start, {}))
+            horizon = now - self.windows[-1] - self.resolution
+            while self.buckets[0][0] < horizon:
+                self.buckets.popleft()
+        return self.buckets[-1][1]
+
+    def record_request(self, action, table_name, body):
+        '''Count the hash keys of a request about to be sent'''
+        if action not in KEYED_ACTIONS:
+            return
+        if self.key_sample_rate < 1 and random.random() >= self.key_sample_rate:
+            return
+        try:
+            request = self.db.codec.decode(body)
+            for name, key in self._request_keys(action, table_name, request):
+                if key is not None:
+                    self._sketch(name).add(key)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            logging.warning("Unable to find the keys of a %s request to %s" % (action, table_name))
+
+    def _request_keys(self, action, table_name, request):
+        if action in ('GetItem', 'UpdateItem', 'DeleteItem'):
+            yield table_name, _hash_key(request['Key']['HashKeyElement'])
+        elif action == 'Query':
+            yield table_name, _hash_key(request['HashKeyValue'])
+        elif action == 'PutItem':
+            if table_name in self.hash_keys:
+                yield table_name, _hash_key(request['Item'].get(self.hash_keys[table_name]))
+        elif action == 'BatchGetItem':
+            for name, keys in request['RequestItems'].items():
+                for key in keys['Keys']:
+                    yield name, _hash_key(key['HashKeyElement'])
+        elif action == 'BatchWriteItem':
+            for name, requests in request['RequestItems'].items():
+                for write in requests:
+                    if 'DeleteRequest' in write:
+                        yield name, _hash_key(write['DeleteRequest']['Key']['HashKeyElement'])
+                    elif name in self.hash_keys:
+                        yield name, _hash_key(write['PutRequest']['Item'].get(self.hash_keys[name]))
+
+    def _sketch(self, table_name):
+        sketch = self.sketches.get(table_name)
+        if sketch is None:
+            sketch = self.sketches[table_name] = SpaceSaving(self.top_keys)
+        return sketch
+
+    def record_response(self, action, table_name, consumed, throttled=False):
+        '''
+        Count a response. consumed maps table names to the capacity units
+        reported in it (see asyncdynamo.consumed_capacity).
+        '''
+        if action_kind(action) is None:
+            return
+        counters = self._bucket(time.time())
+        for name, units in (consumed.items() or [(table_name, 0)]):
+            if name is None:
+                continue
+            counter = counters.get((name, action))
+            if counter is None:
+                counter = counters[(name, action)] = [0, 0, 0]
+            counter[0] += units
+            counter[1] += 1
+            if throttled:
+                counter[2] += 1
+
+    def totals(self, window=None):
+        '''
+        Totals over the last `window` seconds (the shortest of `windows` by
+        default), by table:
+
+        {table_name: {"read": units, "write": units, "read_per_second": units,
+                      "write_per_second": units,
+                      "actions": {action: {"units": units, "requests": n, "throttled": n}}}}
+        '''
+        window = window or self.windows[0]
+        now = time.time()
+        self._bucket(now)
+        since = now - window
+        result = {}
+        for start, counters in self.buckets:
+            if start + self.resolution <= since:
+                continue
+            for (name, action), (units, requests, throttled) in counters.items():
+                table = result.get(name)
+                if table is None:
+                    table = result[name] = {'read': 0, 'write': 0, 'actions': {}}
+                table[action_kind(action)] += units
+                totals = table['actions'].setdefault(action, {'units': 0, 'requests': 0,
+                                                             'throttled': 0})
+                totals['units'] += units
+                totals['requests'] += requests
+                totals['throttled'] += throttled
+        for table in result.values():
+            table['read_per_second'] = table['read'] / float(window)
+            table['write_per_second'] = table['write'] / float(window)
+        return result
+
+    def hot_keys(self, table_name=None, n=10):
+        '''
+        The n hash keys requested most often since the sketches were last
+        reset, as [(key, count, error), ...], for table_name or for every
+        table ({table_name: [...]}). A key was in between count - error and
+        count of the sampled requests (see `key_sample_rate`).
+        '''
+        if table_name is not None:
+            sketch = self.sketches.get(table_name)
+            return sketch.top(n) if sketch is not None else []
+        return dict((name, sketch.top(n)) for name, sketch in self.sketches.items())
+
+    def reset_keys(self):
+        self.sketches = {}
+        self.keys_since = time.time()
+
+    def dump(self, n=10, reset_keys=False):
+        '''Totals over each of `windows` and the n hottest keys of each table, as a dict'''
+        result = {
+            'time': time.time(),
+            'windows': dict((window, self.totals(window)) for window in self.windows),
+            'hot_keys': self.hot_keys(n=n),
+            'hot_keys_since': self.keys_since,
+            'key_requests': dict((name, sketch.total) for name, sketch in self.sketches.items()),
+        }
+        if reset_keys:
+            self.reset_keys()
+        return result
+
+    def report_every(self, seconds, callback=None, n=10, reset_keys=True):
+        '''
+        Call callback with a dump every `seconds` seconds (log it if there is no
+        callback), by default counting hot keys afresh each time. Returns the
+        started tornado PeriodicCallback, whose stop method ends the reports.
+        '''
+        def report():
+            dump = self.dump(n=n, reset_keys=reset_keys)
+            if callback is not None:
+                callback(dump)
+            else:
+                logging.info("DynamoDB capacity: %r" % dump)
+        reporter = PeriodicCallback(report, seconds * 1000, io_loop=self.db.ioloop)
+        reporter.start()
+        return reporter
@@ -0,0 +1,124 @@
+#!/bin/env python
+#
+# Copyright 2013 bit.ly
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+JSON codecs used by AsyncDynamoDB to encode requests and decode responses.
+"""
+
+import importlib
+
+_BOOLEANS = {True: 'true', False: 'false'}
+
+# module name: (encode function, decode function, decode takes object_hook)
+KNOWN_MODULES = {
+    'simplejson': ('dumps', 'loads', True),
+    'json': ('dumps', 'loads', True),
+    'ujson': ('dumps', 'loads', False),
+    'cjson': ('encode', 'decode', False),
+}
+
+
+def apply_object_hook(obj, object_hook=None):
+    '''
+    Deep copy of a decoded json document, applying object_hook to every
+    object in it the same way json.loads would
+    '''
+    if isinstance(obj, dict):
+        copied = dict((key, apply_object_hook(value, object_hook)) for key, value in obj.items())
+        if object_hook is not None:
+            return object_hook(copied)
+        return copied
+    if isinstance(obj, list):
+        return [apply_object_hook(value, object_hook) for value in obj]
+    return obj
+
+
+class JSONCodec(object):
+    '''
+    Encodes request bodies and decodes responses with a json module.
+
+    `module` is the name of one of KNOWN_MODULES, simplejson by default.
+    Modules whose decoder does not take an object_hook (ujson, cjson) get
+    it applied to the decoded document afterwards, so callbacks see the
+    same objects whichever codec is used.
+
+    To plug in another implementation, subclass JSONCodec and override
+    `encode` and `decode`, then pass an instance to AsyncDynamoDB as
+    `codec`.
+    '''
+
+    def __init__(self, module='simplejson'):
+        self.name = module
+        encode, decode, self.object_hook = KNOWN_MODULES[module]
+        module = importlib.import_module(module)
+        self._encode = getattr(module, encode)
+        self._decode = getattr(module, decode)
+        # json and simplejson expose their (C accelerated) string encoder
+        self._encode_string = getattr(getattr(module, 'encoder', None),
+                                      'encode_basestring_ascii', self._encode)
+
+    def __getstate__(self):
+        # the module's functions can not all be pickled, import it again instead
+        return {'name': self.name}
+
+    def __setstate__(self, state):
+        self.__init__(state['name'])
+
+    def encode(self, obj):
+        return self._encode(obj)
+
+    def decode(self, s, object_hook=None):
+        '''Decode s, raising TypeError if it is None'''
+        if s is None:
+            raise TypeError("can not decode None")
+        if self.object_hook:
+            return self._decode(s, object_hook=object_hook)
+        obj = self._decode(s)
+        if object_hook is not None:
+            return apply_object_hook(obj, object_hook)
+        return obj
+
+    def encode_fields(self, *fields):
+        '''
+        Encode a json object made of the (name, value) pairs in fields,
+        leaving out pairs whose value is None. The names are written as they
+        are, and so are scalar values, without going through a dict.
+        '''
+        parts = []
+        for name, value in fields:
+            if value is None:
+                continue
+            value_type = type(value)
+            if value_type is str or value_type is unicode:
+                value = self._encode_string(value)
+            elif value is True or value is False:
+                value = _BOOLEANS[value]
+            elif value_type is int or value_type is long:
+                value = str(value)
+            else:
+                value = self.encode(value)
+            parts.append('"%s":%s' % (name, value))
+        return '{%s}' % ','.join(parts)
+
+
+def available_codecs():
+    '''A JSONCodec for each of KNOWN_MODULES that can be imported'''
+    codecs = {}
+    for name in sorted(KNOWN_MODULES):
+        try:
+            codecs[name] = JSONCodec(name)
+        except ImportError:
+            pass
+    return codecs
@@ -0,0 +1,126 @@
+#!/bin/env python
+#
+# Copyright 2013 bit.ly
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Deadlines and cancellation of requests.
+"""
+
+import datetime
+import time
+
+from boto.exception import DynamoDBResponseError
+
+
+class DeadlineExceededError(DynamoDBResponseError):
+    '''
+    Error passed to the callback of a request whose deadline passed before it
+    completed, while it was queued, in flight or waiting to be retried
+    '''
+
+    def __init__(self):
+        DynamoDBResponseError.__init__(self, None, 'Request deadline exceeded')
+
+
+class RequestCancelledError(DynamoDBResponseError):
+    '''Error passed to the callback of a request cancelled with RequestHandle.cancel'''
+
+    def __init__(self):
+        DynamoDBResponseError.__init__(self, None, 'Request cancelled')
+
+
+def absolute_deadline(deadline):
+    '''
+    deadline as a time.time() timestamp. Like IOLoop.add_timeout, numbers are
+    taken as timestamps already and datetime.timedelta as relative to now.
+    '''
+    if isinstance(deadline, datetime.timedelta):
+        return time.time() + deadline.total_seconds()
+    return deadline
+
+
+class RequestHandle(object):
+    '''
+    Returned by AsyncDynamoDB.make_request and its helpers. The request's
+    callback goes through the handle, which calls it exactly once: with the
+    response, with a DeadlineExceededError once `deadline` passes, or with a
+    RequestCancelledError when `cancel` is called, whichever comes first.
+
+    Once a handle is finished its request is dropped wherever it waits (the
+    rate limiter, the pending queue, a backoff before a retry) and a response
+    still in flight is ignored.
+    '''
+
+    def __init__(self, ioloop, callback, deadline=None, on_abandon=None):
+        self.ioloop = ioloop
+        self.callback = callback
+        self.deadline = absolute_deadline(deadline)
+        self.on_abandon = on_abandon
+        self.finished = False
+        self.error = None
+        self._timeout = None
+        if self.deadline is not None:
+            self._timeout = ioloop.add_timeout(self.deadline, self.expire)
+
+    def __call__(self, response, error=None):
+        if self.finished:
+            return
+        self._finish()
+        if self.callback is not None:
+            self.callback(response, error=error)
+
+    def remaining(self):
+        '''Seconds left before the deadline, or None if there is none'''
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
+
+    def abandoned(self):
+        '''
+        True if the request was cancelled or is past its deadline, in which
+        case it is expired now if the IOLoop has not got round to it yet.
+        '''
+        if not self.finished and self.deadline is not None and time.time() >= self.deadline:
+            self.expire()
+        return self.error is not None
+
+    def expire(self):
+        '''Fail the request with a DeadlineExceededError'''
+        self._abandon(DeadlineExceededError())
+
+    def cancel(self):
+        '''
+        Fail the request with a RequestCancelledError. Returns False if it had
+        already finished.
+        '''
+        if self.finished:
+            return False
+        self._abandon(RequestCancelledError())
+        return True
+
+    def _abandon(self, error):
+        if self.finished:
+            return
+        self._finish()
+        self.error = error
+        if self.on_abandon is not None:
+            self.on_abandon()
+        if self.callback is not None:
+            self.callback({}, error=error)
+
+    def _finish(self):
+        self.finished = True
+        if self._timeout is not None:
+            self.ioloop.remove_timeout(self._timeout)
+            self._timeout = None
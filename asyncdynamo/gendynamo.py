@@ -2,9 +2,16 @@
 # -*- coding: utf-8 -*-
 
 import functools
-import json
+from collections import deque
 from tornado import gen
+from tornado import stack_context
 import asyncdynamo
+from batch import GetBatcher, BatchGetJob, BatchWriteJob, BatchWriter
+from batch import IncrementAggregator, key_id, item_key
+from ratelimit import ScanPacer
+from schema import compile_schema
+from lazy import LazyItem
+from deadline import RequestHandle, DeadlineExceededError, absolute_deadline
 
 
 class DynamoException(Exception):
@@ -31,6 +38,325 @@ class ScanException(DynamoException):
     pass
 
 
+class DeadlineExceededException(DynamoException):
+    pass
+
+
+class PageIterator(object):
+    """
+    Reads every page of a query or scan, fetching up to `prefetch` pages
+    ahead of the one being processed. `page_size` caps the items asked for
+    per request, and the chain's `limit`, if any, caps the total.
+
+        pages = table.query(key).gt(0).pages(prefetch=2)
+        while True:
+            items = yield pages.next_page()
+            if items is None:
+                break
+            ...
+
+    `last_key` is the (hash_key, range_key) of the last item of the last
+    page handed out, or None once everything was read. An interrupted job,
+    or one stopped by the chain's `limit`, can pass it to the chain's
+    `offset` to resume where it stopped.
+
+    Pages of a scan made `polite` are paced by its ScanPacer, and pages
+    rejected for lack of throughput are requested again.
+    """
+
+    def __init__(self, chain, exception_class, prefetch=1, page_size=None):
+        self._chain = chain
+        self._exception_class = exception_class
+        self._prefetch = max(1, prefetch)
+        self._page_size = page_size
+        self._remaining = chain._limit
+        self._start_key = chain._offset
+        self._pages = deque()
+        self._fetching = False
+        self._exhausted = False
+        self._error = None
+        self._waiter = None
+        self.last_key = None
+        self.pages = 0
+        self.items = 0
+        self._fetch()
+
+    def progress(self):
+        progress = {"pages": self.pages,
+                    "items": self.items,
+                    "last_key": self.last_key,
+                    "done": self._exhausted and not self._pages}
+        if self._chain._pacer is not None:
+            progress["pacing"] = self._chain._pacer.progress()
+        return progress
+
+    def next_page(self):
+        """A gen.Task for the next page of unpacked items, or None at the end"""
+        return gen.Task(self._next_page)
+
+    def _next_page(self, callback):
+        if self._waiter is not None:
+            raise RuntimeError("next_page called before the previous page "
+                               "was returned")
+        self._waiter = (callback, stack_context.wrap(self._raise_error))
+        self._deliver()
+
+    def _raise_error(self):
+        raise self._error
+
+    def _fetch(self):
+        if self._fetching or self._exhausted or \
+                len(self._pages) >= self._prefetch:
+            return
+        limit = self._page_size
+        if self._remaining is not None:
+            limit = min(limit or self._remaining, self._remaining)
+        self._fetching = True
+        request = functools.partial(self._chain._request, self._start_key,
+                                    limit, self._on_page)
+        if self._chain._pacer is not None:
+            self._chain._pacer.wait(request)
+        else:
+            request()
+
+    def _on_page(self, response, error=None):
+        self._fetching = False
+        table = self._chain._table_proxy
+        pacer = self._chain._pacer
+        if pacer is not None:
+            if error and pacer.is_throttle(response):
+                pacer.throttled()
+                return self._fetch()
+            if not error:
+                pacer.record(_consumed(table, response))
+        try:
+            table._check_error(response, error, cls=self._exception_class)
+        except DynamoException as e:
+            self._error = e
+            self._exhausted = True
+            return self._deliver()
+        items = table._response_items(response, lazy=self._chain._lazy)
+        self._start_key = response.get("LastEvaluatedKey")
+        if self._remaining is not None:
+            self._remaining -= len(items)
+        if not self._start_key or \
+                (self._remaining is not None and self._remaining <= 0):
+            self._exhausted = True
+        self._pages.append((items, self._start_key))
+        self._deliver()
+        self._fetch()
+
+    def _deliver(self):
+        if self._waiter is None:
+            return
+        callback, raise_error = self._waiter
+        if self._pages:
+            self._waiter = None
+            items, last_evaluated_key = self._pages.popleft()
+            self.last_key = self._unpack_key(last_evaluated_key)
+            self.pages += 1
+            self.items += len(items)
+            self._fetch()
+            callback(items)
+        elif self._error is not None:
+            self._waiter = None
+            raise_error()
+        elif self._exhausted:
+            self._waiter = None
+            if not self._start_key:
+                # the server has nothing more; after a limit, last_key resumes
+                self.last_key = None
+            callback(None)
+
+    def _unpack_key(self, key):
+        if not key:
+            return None
+        table = self._chain._table_proxy
+        range_key = key.get("RangeKeyElement")
+        return (table._unpack_val(key["HashKeyElement"]),
+                table._unpack_val(range_key) if range_key else None)
+
+
+class ParallelScan(object):
+    """
+    Scans a table as `total_segments` segments, `concurrency` of which
+    (all by default) are read at the same time, each by a chain of
+    scan_segment requests for up to `page_size` items.
+
+        scan = table.scan().gt(...).parallel(8)
+        while True:
+            items = yield scan.next_batch()
+            if items is None:
+                break
+            ...
+
+    Pages are handed out in the order they arrive, whatever their segment.
+    Once `buffer_size` items are waiting to be handed out, segments stop
+    requesting more pages until `next_batch` makes room, so a slow consumer
+    does not fill up memory.
+
+    `checkpoint()` returns the position of each segment after the pages
+    handed out so far, as a json friendly dict. Pass it as `resume` to a new
+    ParallelScan with the same `total_segments` to carry on from there.
+
+    When the scan is `polite`, all segments share its ScanPacer.
+    """
+
+    def __init__(self, chain, total_segments, concurrency=None,
+                 buffer_size=1000, page_size=None, resume=None):
+        self._chain = chain
+        self._table = chain._table_proxy
+        self.total_segments = total_segments
+        self._concurrency = concurrency or total_segments
+        self._buffer_size = buffer_size
+        self._page_size = page_size
+        if resume is not None:
+            if resume["total_segments"] != total_segments:
+                raise ValueError("can not resume a scan of %d segments as "
+                                 "%d segments" % (resume["total_segments"],
+                                                  total_segments))
+            self._positions = list(resume["segments"])
+        else:
+            self._positions = [None] * total_segments
+        self._todo = deque(segment for segment, position
+                           in enumerate(self._positions) if position is not True)
+        self._pages = deque()
+        self._buffered = 0
+        self._running = 0
+        self._paused = deque()
+        self._error = None
+        self._waiter = None
+        self.items = 0
+        self.scanned = 0
+        self.pages = 0
+        self._start_segments()
+
+    def next_batch(self):
+        """A gen.Task for the next page of unpacked items, or None at the end"""
+        return gen.Task(self._next_batch)
+
+    def checkpoint(self):
+        """
+        Position of every segment: None if it was not started, [hash_key,
+        range_key] of the last item handed out, or True once it is done
+        """
+        return {"total_segments": self.total_segments,
+                "segments": list(self._positions)}
+
+    def progress(self):
+        done = sum(1 for position in self._positions if position is True)
+        progress = {"segments": self.total_segments,
+                    "segments_done": done,
+                    "segments_running": self._running,
+                    "pages": self.pages,
+                    "items": self.items,
+                    "scanned": self.scanned,
+                    "buffered": self._buffered}
+        if self._chain._pacer is not None:
+            progress["pacing"] = self._chain._pacer.progress()
+        return progress
+
+    def _next_batch(self, callback):
+        if self._waiter is not None:
+            raise RuntimeError("next_batch called before the previous batch "
+                               "was returned")
+        self._waiter = (callback, stack_context.wrap(self._raise_error))
+        self._deliver()
+
+    def _raise_error(self):
+        raise self._error
+
+    def _start_segments(self):
+        while self._todo and self._running < self._concurrency and \
+                self._error is None:
+            segment = self._todo.popleft()
+            self._running += 1
+            self._fetch(segment, self._start_key(self._positions[segment]))
+
+    def _fetch(self, segment, exclusive_start_key):
+        if self._error is not None:
+            return
+        if self._buffered >= self._buffer_size:
+            self._paused.append((segment, exclusive_start_key))
+            return
+        request = functools.partial(
+            self._chain._segment_request, segment, self.total_segments,
+            exclusive_start_key, self._page_size,
+            functools.partial(self._on_page, segment, exclusive_start_key))
+        if self._chain._pacer is not None:
+            self._chain._pacer.wait(request)
+        else:
+            request()
+
+    def _on_page(self, segment, exclusive_start_key, response, error=None):
+        pacer = self._chain._pacer
+        if pacer is not None:
+            if error and pacer.is_throttle(response):
+                pacer.throttled()
+                return self._fetch(segment, exclusive_start_key)
+            if not error:
+                pacer.record(_consumed(self._table, response))
+        try:
+            self._table._check_error(response, error, cls=ScanException)
+        except DynamoException as e:
+            self._error = e
+            return self._deliver()
+        items = self._table._response_items(response, lazy=self._chain._lazy)
+        last_evaluated_key = response.get("LastEvaluatedKey")
+        self.scanned += response.get("ScannedCount", len(items))
+        self._pages.append((segment, items, last_evaluated_key))
+        self._buffered += len(items)
+        if last_evaluated_key:
+            self._fetch(segment, last_evaluated_key)
+        else:
+            self._running -= 1
+            self._start_segments()
+        self._deliver()
+
+    def _deliver(self):
+        if self._waiter is None:
+            return
+        callback, raise_error = self._waiter
+        while self._pages:
+            segment, items, last_evaluated_key = self._pages.popleft()
+            self._buffered -= len(items)
+            self._positions[segment] = self._position(last_evaluated_key)
+            self.pages += 1
+            if items:
+                self._waiter = None
+                self.items += len(items)
+                while self._paused and self._buffered < self._buffer_size:
+                    self._fetch(*self._paused.popleft())
+                return callback(items)
+        if self._error is not None:
+            self._waiter = None
+            raise_error()
+        elif not self._running and not self._todo:
+            self._waiter = None
+            callback(None)
+
+    def _position(self, key):
+        """Unpacks a LastEvaluatedKey of the 20120810 API"""
+        if not key:
+            return True
+        range_key = None
+        if self._table.range_key_name:
+            range_key = self._table._unpack_val(
+                key[self._table.range_key_name])
+        return [self._table._unpack_val(key[self._table.hash_key_name]),
+                range_key]
+
+    def _start_key(self, position):
+        """Packs a position as an ExclusiveStartKey of the 20120810 API"""
+        if position is None:
+            return None
+        hash_key, range_key = position
+        key = {self._table.hash_key_name: self._table._pack_val(hash_key)}
+        if range_key is not None:
+            key[self._table.range_key_name] = self._table._pack_val(range_key)
+        return key
+
+
 class ScanChain(gen.Task):
 
     def __init__(self, table_proxy, attrs=None):
@@ -41,6 +367,10 @@ class ScanChain(gen.Task):
         self._scan = None
         self._comp = None
         self._limit = None
+        self._offset = None
+        self._pacer = None
+        self._lazy = None
+        self._deadline = None
 
     def eq(self, val):
         self._comp = "EQ"
@@ -84,23 +414,79 @@ class ScanChain(gen.Task):
         self._limit = limit
         return self
 
+    def lazy(self, lazy=True):
+        """Return asyncdynamo.lazy.LazyItem views rather than dicts"""
+        self._lazy = lazy
+        return self
+
+    def deadline(self, deadline):
+        """
+        Give up on requests still unanswered at `deadline`, a time.time()
+        timestamp or a datetime.timedelta from now, see
+        AsyncDynamoDB.make_request. It applies to every page.
+        """
+        self._deadline = absolute_deadline(deadline)
+        return self
+
+    def pages(self, prefetch=1, page_size=None):
+        """Iterate over every page of the scan, see PageIterator"""
+        return PageIterator(self, ScanException, prefetch=prefetch,
+                            page_size=page_size)
+
     def __call__(self, callback):
         callback = functools.partial(self._table_proxy._scan_callback,
-                                     callback)
-        if self._scan:
-            scan_filter = dict([key, {
-                "AttributeValueList": [self._table_proxy._pack_val(
-                    value)],
-                "ComparisonOperator": self._comp
-            }] for key, value in self._scan.items())
-        else:
-            scan_filter = None
+                                     callback, lazy=self._lazy)
+        self._request(self._offset, self._limit, callback)
+
+    def polite(self, share=0.2, read_capacity=None, **kwargs):
+        """
+        Pace `pages` and `parallel` so that they only consume `share` of the
+        table's read capacity, see asyncdynamo.ratelimit.ScanPacer
+        """
+        self._pacer = ScanPacer(self._table_proxy._db,
+                                self._table_proxy._table_name, share=share,
+                                read_capacity=read_capacity, **kwargs)
+        return self
+
+    def parallel(self, total_segments, concurrency=None, buffer_size=1000,
+                 page_size=None, resume=None):
+        """Scan the table as segments read concurrently, see ParallelScan"""
+        return ParallelScan(self, total_segments, concurrency=concurrency,
+                            buffer_size=buffer_size, page_size=page_size,
+                            resume=resume)
+
+    def _scan_filter(self):
+        if not self._scan:
+            return None
+        return dict([key, {
+            "AttributeValueList": [self._table_proxy._pack_val(
+                value)],
+            "ComparisonOperator": self._comp
+        }] for key, value in self._scan.items())
+
+    def _request(self, exclusive_start_key, limit, callback):
         self._table_proxy._db.scan(self._table_proxy._table_name,
-                                   limit=self._limit,
+                                   limit=limit,
                                    attributes_to_get=self._attr,
-                                   scan_filter=scan_filter,
+                                   scan_filter=self._scan_filter(),
+                                   exclusive_start_key=exclusive_start_key,
+                                   postprocess=self._table_proxy._postprocess(
+                                       self._lazy),
+                                   deadline=self._deadline,
                                    callback=callback)
 
+    def _segment_request(self, segment, total_segments, exclusive_start_key,
+                         limit, callback):
+        self._table_proxy._db.scan_segment(
+            self._table_proxy._table_name, segment, total_segments,
+            limit=limit,
+            attributes_to_get=self._attr,
+            scan_filter=self._scan_filter(),
+            exclusive_start_key=exclusive_start_key,
+            postprocess=self._table_proxy._postprocess(self._lazy),
+            deadline=self._deadline,
+            callback=callback)
+
     def offset(self, hash_key, range_key=None):
         self._offset = self._table_proxy._key(hash_key=hash_key,
                                               range_key=range_key)
@@ -119,6 +505,9 @@ class QueryChain(gen.Task):
         self._offset = None
         self._attr = attrs
         self._limit = None
+        self._pacer = None
+        self._lazy = None
+        self._deadline = None
 
     def gt(self, val):
         self._comp = "GT"
@@ -134,6 +523,20 @@ class QueryChain(gen.Task):
         self._limit = limit
         return self
 
+    def lazy(self, lazy=True):
+        """Return asyncdynamo.lazy.LazyItem views rather than dicts"""
+        self._lazy = lazy
+        return self
+
+    def deadline(self, deadline):
+        """
+        Give up on requests still unanswered at `deadline`, a time.time()
+        timestamp or a datetime.timedelta from now, see
+        AsyncDynamoDB.make_request. It applies to every page.
+        """
+        self._deadline = absolute_deadline(deadline)
+        return self
+
     def lt(self, val):
         self._comp = "LT"
         self._range = val
@@ -167,20 +570,23 @@ class QueryChain(gen.Task):
         self._forward = False
         return self
 
+    def pages(self, prefetch=1, page_size=None):
+        """Iterate over every page of the query, see PageIterator"""
+        return PageIterator(self, QueryException, prefetch=prefetch,
+                            page_size=page_size)
+
     def __call__(self, callback):
+        callback = functools.partial(self._table_proxy._query_callback,
+                                     callback, lazy=self._lazy)
+        self._request(self._offset, self._limit, callback)
+
+    def _request(self, exclusive_start_key, limit, callback):
 
         if None in [self._key, self._range, self._comp]:
             raise RuntimeError("QueryChain wan't not configured properly")
 
         key = self._table_proxy._pack_val(self._key)
 
-        callback = functools.partial(self._table_proxy._query_callback,
-                                     callback)
-        if self._offset:
-            exclusive_start_key = self._offset
-        else:
-            exclusive_start_key = None
-
         range_key_conditions = {
             "AttributeValueList": [self._table_proxy._pack_val(self._range)],
             "ComparisonOperator": self._comp
@@ -192,25 +598,40 @@ class QueryChain(gen.Task):
             scan_index_forward=self._forward,
             exclusive_start_key=exclusive_start_key,
             attributes_to_get=self._attr,
-            limit=self._limit,
+            limit=limit,
+            postprocess=self._table_proxy._postprocess(self._lazy),
+            deadline=self._deadline,
             callback=callback)
 
 
 class GetMixin(object):
 
-    def get(self, attrs=None, **kwargs):
+    def get(self, attrs=None, deadline=None, **kwargs):
         hash_key, range_key, rest = self._extract_keys(kwargs)
-        self._attr = attrs
         if rest:
             raise KeyError("%r arguments are not supported "
                            "for `get` method" % rest)
         key = self._key(hash_key, range_key)
-        return gen.Task(self._get, key)
+        return gen.Task(self._get, key, attrs, deadline)
 
-    def _get(self, key, callback):
+    def _get(self, key, attrs, deadline, callback):
         cb = functools.partial(self._get_callback, callback)
-        self._db.get_item(self._table_name, key, attributes_to_get=self._attr,
-                          callback=cb)
+        if self.cache is not None:
+            found, item = self.cache.get(key_id(key))
+            if found:
+                return cb({"Item": _project(item, attrs)} if item else {}, None)
+            if not attrs:
+                cb = functools.partial(self._cache_get_callback, key,
+                                       self.cache.begin(), cb)
+        if self._get_batcher is not None:
+            if deadline is not None:
+                # the batch goes on for the other keys, this caller stops waiting
+                cb = RequestHandle(self._db.ioloop, cb, deadline)
+            # errors are raised by _get_callback, make sure they reach this caller
+            self._get_batcher.load(key, stack_context.wrap(cb), attrs=attrs)
+            return
+        self._db.get_item(self._table_name, key, attributes_to_get=attrs,
+                          callback=cb, deadline=deadline)
 
     def _get_callback(self, callback, response, error):
         self._check_error(response, error)
@@ -219,10 +640,16 @@ class GetMixin(object):
         else:
             callback(None)
 
+    def _cache_get_callback(self, key, token, callback, response, error=None):
+        if not error:
+            self.cache.fill(key_id(key), response.get("Item"), token)
+        self.cache.end(token)
+        callback(response, error)
+
 
 class BatchGetMixin(object):
 
-    def batch_get(self, items, attrs=None):
+    def batch_get(self, items, attrs=None, deadline=None):
         keys = []
         for item in items:
             hash_key, range_key, rest = self._extract_keys(item)
@@ -230,40 +657,78 @@ class BatchGetMixin(object):
                 raise KeyError("%r arguments are not supported "
                                "for `batch_get` method" % rest)
             keys.append(self._key(hash_key, range_key))
-        kw = {
-            "Keys": keys
-        }
-        if attrs:
-            kw['AttributesToGet'] = attrs
-        get_items = {
-            self._table_name: kw
-        }
-        return gen.Task(self._batch_get, get_items)
-
-    def _batch_get(self, get_items, callback):
-        cb = functools.partial(self._batch_get_callback, callback)
-        self._db.batch_get_item(get_items, cb)
-
-    def _batch_get_callback(self, callback, response, error):
+        return gen.Task(self._batch_get, keys, attrs, deadline)
+
+    def _batch_get(self, keys, attrs, deadline, callback):
+        cached = []
+        if self.cache is not None:
+            missing = []
+            for key in keys:
+                found, item = self.cache.get(key_id(key))
+                if not found:
+                    missing.append(key)
+                elif item:
+                    cached.append(_project(item, attrs))
+            keys = missing
+        cb = functools.partial(self._batch_get_callback, callback, cached)
+        if self.cache is not None and not attrs:
+            cb = functools.partial(self._cache_batch_get_callback, keys,
+                                   self.cache.begin(), cb)
+        BatchGetJob(self._db, [(self._table_name, key) for key in keys], cb,
+                    attrs={self._table_name: attrs},
+                    concurrency=self.batch_concurrency,
+                    timeout=self.batch_timeout, deadline=deadline).start()
+
+    def _batch_get_callback(self, callback, cached, response, error):
         self._check_error(response, error)
-        items = response.get("Responses").get(self._table_name).get("Items")
-        callback(map(self._unpack, items))
+        items = response.get("Responses").get(self._table_name, {}).get("Items", [])
+        callback(self._unpack_all(cached + items))
+
+    def _cache_batch_get_callback(self, keys, token, callback, response, error=None):
+        if not error:
+            items = response["Responses"].get(self._table_name, {}).get("Items", [])
+            found = dict((key_id(item_key(item, self.hash_key_name,
+                                          self.range_key_name)), item)
+                         for item in items)
+            for key in keys:
+                self.cache.fill(key_id(key), found.get(key_id(key)), token)
+        self.cache.end(token)
+        callback(response, error)
 
 
 class IncrementMixin(object):
 
-    def increment(self, **kwargs):
+    def increment(self, deadline=None, **kwargs):
         hash_key, range_key, rest = self._extract_keys(kwargs)
         key = self._key(hash_key, range_key)
+        if self._increment_aggregator is not None:
+            if deadline is not None:
+                raise ValueError("aggregated increments complete at once and "
+                                 "are written later, they take no deadline")
+            return gen.Task(self._increment_aggregator.add, key, rest)
         update_data = {}
         for field, increment in rest.items():
             update_data[field] = {"Value": self._pack_val(increment),
                                   "Action": "ADD"}
-        return gen.Task(self._increment, key, update_data)
-
-    def _increment(self, key, update_data, callback):
+        return gen.Task(self._increment, key, update_data, deadline)
+
+    def aggregate_increments(self, interval=1.0, max_increments=10000,
+                             max_keys=1000, callback=None):
+        """
+        From now on, add up increments in memory and write the totals in the
+        background. `increment` then completes right away, with None.
+        Returns the asyncdynamo.batch.IncrementAggregator doing the work;
+        call its `close` on shutdown.
+        """
+        self._increment_aggregator = IncrementAggregator(
+            self, interval=interval, max_increments=max_increments,
+            max_keys=max_keys, callback=callback)
+        return self._increment_aggregator
+
+    def _increment(self, key, update_data, deadline, callback):
         cb = functools.partial(self._increment_callback, callback)
-        self._db.update_item(self._table_name, key, update_data, cb)
+        self._db.update_item(self._table_name, key, update_data,
+                             self._invalidating([key], cb), deadline=deadline)
 
     def _increment_callback(self, callback, response, error):
         self._check_error(response, error)
@@ -272,7 +737,7 @@ class IncrementMixin(object):
 
 class PutMixin(object):
 
-    def put(self, **kwargs):
+    def put(self, deadline=None, **kwargs):
         self._extract_keys(kwargs)
 
         if self.range_key_name:
@@ -281,11 +746,14 @@ class PutMixin(object):
             expected = {self.hash_key_name: {"Exists": False}}
 
         data = self._pack(kwargs)
-        return gen.Task(self._put, data, expected)
+        return gen.Task(self._put, data, expected, deadline)
 
-    def _put(self, data, expected, callback):
+    def _put(self, data, expected, deadline, callback):
         cb = functools.partial(self._put_callback, callback)
-        self._db.put_item(self._table_name, data, cb, expected)
+        key = item_key(data, self.hash_key_name, self.range_key_name)
+        self._db.put_item(self._table_name, data,
+                          self._invalidating([key], cb), expected,
+                          deadline=deadline)
 
     def _put_callback(self, callback, response, error):
         self._check_error(response, error, cls=PutException)
@@ -294,18 +762,19 @@ class PutMixin(object):
 
 class UpdateMixin(object):
 
-    def update(self, **kwargs):
+    def update(self, deadline=None, **kwargs):
         hash_key, range_key, rest = self._extract_keys(kwargs)
         key = self._key(hash_key, range_key)
         update_data = {}
         for field, value in rest.items():
             update_data[field] = {"Value": self._pack_val(value),
                                   "Action": "PUT"}
-        return gen.Task(self._update, key, update_data)
+        return gen.Task(self._update, key, update_data, deadline)
 
-    def _update(self, key, update_data, callback):
+    def _update(self, key, update_data, deadline, callback):
         cb = functools.partial(self._update_callback, callback)
-        self._db.update_item(self._table_name, key, update_data, cb)
+        self._db.update_item(self._table_name, key, update_data,
+                             self._invalidating([key], cb), deadline=deadline)
 
     def _update_callback(self, callback, response, error):
         self._check_error(response, error)
@@ -314,21 +783,24 @@ class UpdateMixin(object):
 
 class MassDeleteMixin(object):
 
-    def mass_delete(self, keys):
-        if len(keys) > 25:
-            raise RuntimeError("mass_delete accepts not more than 25 keys")
-        keys = map(self._pack, keys)
-        return gen.Task(self._mass_delete, keys)
-
-    def _mass_delete(self, keys, callback):
-        self._db.make_request("BatchWriteItem", body=json.dumps({
-            "RequestItems": {
-                self._table_name: [
-                    {"DeleteRequest": {"Key": key}}
-                    for key in keys
-                ]
-            }
-        }), callback=functools.partial(self._mass_delete_callback, callback))
+    def mass_delete(self, keys, deadline=None):
+        packed_keys = []
+        for key in keys:
+            hash_key, range_key, rest = self._extract_keys(key)
+            if rest:
+                raise KeyError("%r arguments are not supported "
+                               "for `mass_delete` method" % rest)
+            packed_keys.append(self._key(hash_key, range_key))
+        return gen.Task(self._mass_delete, packed_keys, deadline)
+
+    def _mass_delete(self, keys, deadline, callback):
+        cb = functools.partial(self._mass_delete_callback, callback)
+        BatchWriteJob(self._db, [
+            (self._table_name, {"DeleteRequest": {"Key": key}})
+            for key in keys
+        ], self._invalidating(keys, cb),
+            concurrency=self.batch_concurrency,
+            timeout=self.batch_timeout, deadline=deadline).start()
 
     def _mass_delete_callback(self, callback, response, error):
         self._check_error(response, error)
@@ -337,21 +809,20 @@ class MassDeleteMixin(object):
 
 class MassWriteMixin(object):
 
-    def mass_write(self, items):
-        if len(items) > 25:
-            raise RuntimeError("mass_write accepts not more than 25 items")
+    def mass_write(self, items, deadline=None):
         items = map(self._pack, items)
-        return gen.Task(self._mass_write, items)
-
-    def _mass_write(self, items, callback):
-        self._db.make_request("BatchWriteItem", body=json.dumps({
-            "RequestItems": {
-                self._table_name: [
-                    {"PutRequest": {"Item": item}}
-                    for item in items
-                ]
-            }
-        }), callback=functools.partial(self._mass_write_callback, callback))
+        return gen.Task(self._mass_write, items, deadline)
+
+    def _mass_write(self, items, deadline, callback):
+        cb = functools.partial(self._mass_write_callback, callback)
+        keys = [item_key(item, self.hash_key_name, self.range_key_name)
+                for item in items]
+        BatchWriteJob(self._db, [
+            (self._table_name, {"PutRequest": {"Item": item}})
+            for item in items
+        ], self._invalidating(keys, cb),
+            concurrency=self.batch_concurrency,
+            timeout=self.batch_timeout, deadline=deadline).start()
 
     def _mass_write_callback(self, callback, response, error):
         self._check_error(response, error)
@@ -360,7 +831,7 @@ class MassWriteMixin(object):
 
 class RemoveMixin(object):
 
-    def remove(self, **kwargs):
+    def remove(self, deadline=None, **kwargs):
         hash_key, range_key, rest = self._extract_keys(kwargs)
         if rest:
             raise KeyError("%r arguments are not supported "
@@ -372,11 +843,13 @@ class RemoveMixin(object):
         for attr, value in kwargs.items():
             expected[attr] = {"Exists": True, "Value": self._pack_val(value)}
 
-        return gen.Task(self._remove, key, expected)
+        return gen.Task(self._remove, key, expected, deadline)
 
-    def _remove(self, key, expected, callback):
+    def _remove(self, key, expected, deadline, callback):
         cb = functools.partial(self._remove_callback, callback)
-        self._db.remove_item(self._table_name, key, cb, expected)
+        self._db.remove_item(self._table_name, key,
+                             self._invalidating([key], cb), expected,
+                             deadline=deadline)
 
     def _remove_callback(self, callback, response, error):
         self._check_error(response, error, cls=RemoveException)
@@ -388,9 +861,9 @@ class ScanMixin(object):
     def scan(self, attrs=None):
         return ScanChain(self, attrs=attrs)
 
-    def _scan_callback(self, callback, response, error):
+    def _scan_callback(self, callback, response, error, lazy=None):
         self._check_error(response, error, cls=ScanException)
-        callback(map(self._unpack, response.get("Items")))
+        callback(self._response_items(response, lazy=lazy))
 
 
 class QueryMixin(object):
@@ -398,16 +871,57 @@ class QueryMixin(object):
     def query(self, key, attrs=None):
         return QueryChain(self, key, attrs=attrs)
 
-    def _query_callback(self, callback, response, error):
+    def _query_callback(self, callback, response, error, lazy=None):
         self._check_error(response, error, cls=QueryException)
-        callback(map(self._unpack, response.get("Items")))
+        callback(self._response_items(response, lazy=lazy))
 
 
 class GenDynamoTable(GetMixin, BatchGetMixin, IncrementMixin,
                      PutMixin, QueryMixin, RemoveMixin, ScanMixin,
                      UpdateMixin, MassDeleteMixin, MassWriteMixin):
 
-    def __init__(self, hash_key, range_key=None):
+    def __init__(self, hash_key, range_key=None, batch_gets=False,
+                 batch_window=0, batch_concurrency=4, batch_timeout=60,
+                 cache=None, schema=None, lazy_items=False,
+                 unpack_in_executor=False):
+        """
+        With `batch_gets`, `get` calls made in the same IOLoop iteration (or
+        within `batch_window` seconds) are sent together as BatchGetItem
+        requests, see asyncdynamo.batch.GetBatcher. Keys left unprocessed are
+        sent again until they succeed or `batch_timeout` seconds pass.
+
+        `batch_get`, `mass_write` and `mass_delete` accept any number of
+        items, split them into as many requests as needed, and send up to
+        `batch_concurrency` of those at a time. Unprocessed keys and items
+        are sent again until they succeed or `batch_timeout` seconds pass.
+
+        `cache`, a asyncdynamo.cache.ItemCache, serves `get` and `batch_get`
+        from memory when it can. It is invalidated by the writes made through
+        this table, but not by writes made by anyone else.
+
+        `schema` maps attribute names to their type: int, str, 'NS' (a set of
+        ints) or 'SS' (a set of strings). Items are then packed and unpacked
+        by functions specialised for it, see asyncdynamo.schema. Attributes
+        left out of it, or whose type does not match, are still handled.
+
+        With `lazy_items`, queries and scans return asyncdynamo.lazy.LazyItem
+        views that only unpack the attributes that are read. The `lazy`
+        method of a query or scan chain picks this for one chain.
+
+        With `unpack_in_executor`, query and scan results that are not lazy
+        are unpacked along with their decoding, which happens in the decode
+        executor of the AsyncDynamoDB for large responses.
+
+        `get`, `batch_get`, `put`, `update`, `remove`, `increment`,
+        `mass_write` and `mass_delete` take a `deadline`, and query and scan
+        chains a `.deadline()`, see AsyncDynamoDB.make_request; requests past
+        it raise DeadlineExceededException.
+        """
+        self.lazy_items = lazy_items
+        self.unpack_in_executor = unpack_in_executor
+        self.cache = cache
+        self.batch_concurrency = batch_concurrency
+        self.batch_timeout = batch_timeout
         self.hash_key_type, self.hash_key_name = hash_key
         if range_key:
             self.range_key_type, self.range_key_name = range_key
@@ -421,16 +935,56 @@ class GenDynamoTable(GetMixin, BatchGetMixin, IncrementMixin,
         if self.range_key_type not in (int, str, None):
             raise TypeError("range_key should be int or str")
 
+        if schema is not None:
+            schema = dict(schema)
+            schema.setdefault(self.hash_key_name, self.hash_key_type)
+            if self.range_key_name:
+                schema.setdefault(self.range_key_name, self.range_key_type)
+            self._pack, self._unpack, self._unpack_all = compile_schema(
+                schema, self._pack_val, self._unpack_val)
+        self.schema = schema
+
+        if batch_gets:
+            self._get_batcher = GetBatcher(self, window=batch_window, timeout=batch_timeout)
+        else:
+            self._get_batcher = None
+        self._increment_aggregator = None
+
+    def batch_writer(self, **kwargs):
+        """A asyncdynamo.batch.BatchWriter for this table"""
+        return BatchWriter(self, **kwargs)
+
+    def _invalidating(self, keys, callback):
+        """
+        Drops keys from the cache now and again when the write to them is
+        done, in case a read of the old item completed meanwhile
+        """
+        if self.cache is None:
+            return callback
+        self._invalidate(keys)
+        return functools.partial(self._invalidate_callback, keys, callback)
+
+    def _invalidate(self, keys):
+        if self.cache is not None:
+            for key in keys:
+                self.cache.invalidate(key_id(key))
+
+    def _invalidate_callback(self, keys, callback, response, error=None):
+        self._invalidate(keys)
+        callback(response, error)
+
     def _check_error(self, response, error, cls=None):
         if error:
             response = response or {}
             message = response.get("message") or response.get("Message")
+            if isinstance(error, DeadlineExceededError):
+                raise DeadlineExceededException(error.reason)
             if cls is None:
                 cls = DynamoException
                 if "#ConditionalCheckFailedException"  \
                         in response.get("__type", ""):
                     cls = ConcurrentUpdateException
-            raise cls(message)
+            raise cls(message or getattr(error, "reason", None))
 
     def _extract_keys(self, data):
         data = data.copy()
@@ -440,7 +994,8 @@ class GenDynamoTable(GetMixin, BatchGetMixin, IncrementMixin,
 
         hash_key = data.pop(self.hash_key_name)
 
-        if self.hash_key_type is int and not isinstance(hash_key, int):
+        if self.hash_key_type is int and \
+                not isinstance(hash_key, (int, long)):
             raise ValueError("'%s' should be int but %r provided" %
                              (self.hash_key_name, hash_key))
 
@@ -457,7 +1012,8 @@ class GenDynamoTable(GetMixin, BatchGetMixin, IncrementMixin,
 
             range_key = data.pop(self.range_key_name)
 
-            if self.range_key_type is int and not isinstance(range_key, int):
+            if self.range_key_type is int and \
+                    not isinstance(range_key, (int, long)):
                 raise ValueError("'%s' should be int but %r provided" %
                                  (self.range_key_name, range_key))
 
@@ -475,13 +1031,13 @@ class GenDynamoTable(GetMixin, BatchGetMixin, IncrementMixin,
             return val["S"]
         elif "SS" in val:
             return set(val["SS"])
-        elif "SN" in val:
-            return set(map(int, val["SS"]))
+        elif "NS" in val:
+            return set(map(int, val["NS"]))
         else:
-            raise ValueError("can not unpack %r", val)
+            raise ValueError("can not unpack %r" % val)
 
     def _pack_val(self, val):
-        if isinstance(val, int):
+        if isinstance(val, (int, long)):
             keytype = "N"
             val = str(val)
         elif isinstance(val, basestring):
@@ -490,9 +1046,9 @@ class GenDynamoTable(GetMixin, BatchGetMixin, IncrementMixin,
             if not len(val):
                 raise ValueError("empty sets are not supported by DynamoDB")
             for item in val:
-                if isinstance(item, int):
+                if isinstance(item, (int, long)):
                     itemtype = "N"
-                elif isinstance(item, str):
+                elif isinstance(item, basestring):
                     itemtype = "S"
                 else:
                     raise ValueError("set should contain only `int` or "
@@ -500,10 +1056,10 @@ class GenDynamoTable(GetMixin, BatchGetMixin, IncrementMixin,
                 break
             if itemtype == "N":
                 for item in val:
-                    if not isinstance(item, int):
+                    if not isinstance(item, (int, long)):
                         raise ValueError("set should contain values of "
                                          "same type")
-                val = map(set, val)
+                val = map(str, val)
             elif itemtype == "S":
                 for item in val:
                     if not isinstance(item, basestring):
@@ -521,6 +1077,35 @@ class GenDynamoTable(GetMixin, BatchGetMixin, IncrementMixin,
     def _pack(self, item):
         return dict((k, self._pack_val(v)) for k, v in item.items())
 
+    def _unpack_all(self, items):
+        return map(self._unpack, items)
+
+    def _unpacks_in_executor(self, lazy=None):
+        if lazy is None:
+            lazy = self.lazy_items
+        return self.unpack_in_executor and not lazy
+
+    def _postprocess(self, lazy=None):
+        """postprocess function for the query and scan requests of this table"""
+        if not self._unpacks_in_executor(lazy):
+            return None
+        return ResponseUnpacker(self)
+
+    def _response_items(self, response, lazy=None):
+        """The unpacked items of a query or scan response"""
+        if self._unpacks_in_executor(lazy):
+            return response.get("Items", [])
+        return self._unpack_items(response.get("Items", []), lazy=lazy)
+
+    def _unpack_items(self, items, lazy=None):
+        """Unpacks query and scan results, as LazyItems if lazy"""
+        if lazy is None:
+            lazy = self.lazy_items
+        if lazy:
+            unpack_val = self._unpack_val
+            return [LazyItem(item, unpack_val) for item in items]
+        return self._unpack_all(items)
+
     def _key(self, hash_key, range_key=None):
         key = {"HashKeyElement": self._pack_val(hash_key)}
         if range_key is not None:
@@ -528,8 +1113,69 @@ class GenDynamoTable(GetMixin, BatchGetMixin, IncrementMixin,
         return key
 
 
+class ResponseUnpacker(object):
+    """
+    Returns a copy of a query or scan response with its items unpacked by
+    table. When pickled to be sent to a process pool, only what is needed
+    to rebuild the table's unpacking is kept.
+    """
+
+    _tables = {}
+
+    def __init__(self, table):
+        self._table = table
+
+    def __getstate__(self):
+        table = self._table
+        range_key = None
+        if table.range_key_name:
+            range_key = (table.range_key_type, table.range_key_name)
+        schema = sorted(table.schema.items()) if table.schema else None
+        return ((table.hash_key_type, table.hash_key_name), range_key, schema)
+
+    def __setstate__(self, state):
+        # compiling a schema is not free, keep one table per process
+        table = self._tables.get(state)
+        if table is None:
+            hash_key, range_key, schema = state
+            table = self._tables[state] = GenDynamoTable(
+                hash_key, range_key, schema=dict(schema) if schema else None)
+        self._table = table
+
+    def __call__(self, response):
+        return dict(response, Items=self._table._unpack_all(
+            response.get("Items", [])))
+
+
+def _consumed(table, response):
+    """Capacity units a query or scan response reports for table"""
+    return asyncdynamo.consumed_capacity(table._table_name, response).get(
+        table._table_name, 0)
+
+
+def _request_key(table, request):
+    """The key written by a BatchWriteItem PutRequest or DeleteRequest"""
+    if "PutRequest" in request:
+        return item_key(request["PutRequest"]["Item"], table.hash_key_name,
+                        table.range_key_name)
+    return request["DeleteRequest"]["Key"]
+
+
+def _project(item, attrs):
+    """Only keep the attributes in attrs, if any"""
+    if not attrs:
+        return item
+    return dict((k, v) for k, v in item.items() if k in attrs)
+
+
 class GenDynamo(object):
 
+    batch_concurrency = 4
+    """Requests sent at a time by multi_write and multi_delete"""
+
+    batch_timeout = 60
+    """Seconds multi_write and multi_delete keep resubmitting unprocessed items"""
+
     class __metaclass__(type):
         def __new__(cls, name, bases, dct):
             tables = []
@@ -545,46 +1191,47 @@ class GenDynamo(object):
             table = getattr(self, name)
             table._db = self._db
             table._table_name = name
-        self._pack = getattr(self, self._tables[0])._pack
+            if self._db.capacity_tracker is not None:
+                self._db.capacity_tracker.set_hash_key(name, table.hash_key_name)
+
+    def batch_writer(self, **kwargs):
+        """A asyncdynamo.batch.BatchWriter for the tables of this GenDynamo"""
+        return BatchWriter(self, **kwargs)
 
-    def multi_write(self, **tables):
-        data = {}
-        count = 0
+    def multi_write(self, deadline=None, **tables):
+        data = []
         for table, items in tables.items():
             if table not in self._tables:
                 raise RuntimeError("unknown table %r" % table)
-            data[table] = [{"PutRequest": {"Item": self._pack(item)}}
-                           for item in items]
-            count += len(data[table])
-            if count > 25:
-                raise RuntimeError("multi_write accepts not more than "
-                                   "25 items")
-        return gen.Task(self._multi_write, data)
-
-    def multi_delete(self, **tables):
-        data = {}
-        count = 0
+            tbl = getattr(self, table)
+            data.extend((table, {"PutRequest": {"Item": tbl._pack(item)}})
+                        for item in items)
+        return gen.Task(self._multi_write, data, deadline)
+
+    def multi_delete(self, deadline=None, **tables):
+        data = []
         for table, items in tables.items():
             tbl = getattr(self, table)
-            del_requests = []
             for item in items:
                 hash_key, range_key, rest = tbl._extract_keys(item)
                 if rest:
                     raise RuntimeError("%r can't be handled by "
                                        "multi_delete" % rest)
-                del_requests.append({"DeleteRequest": {
-                    "Key": tbl._key(hash_key, range_key)}})
-                count += 1
-                if count > 25:
-                    raise RuntimeError("multi_delete accepts not more than "
-                                       "25 items")
-            data[table] = del_requests
-        return gen.Task(self._multi_write, data)
-
-    def _multi_write(self, data, callback):
-        self._db.make_request("BatchWriteItem", body=json.dumps({
-            "RequestItems": data
-        }), callback=functools.partial(self._multi_write_callback, callback))
+                data.append((table, {"DeleteRequest": {
+                    "Key": tbl._key(hash_key, range_key)}}))
+        return gen.Task(self._multi_write, data, deadline)
+
+    def _multi_write(self, data, deadline, callback):
+        cb = functools.partial(self._multi_write_callback, callback)
+        for table_name in set(table_name for table_name, request in data):
+            tbl = getattr(self, table_name)
+            keys = [_request_key(tbl, request)
+                    for name, request in data if name == table_name]
+            cb = tbl._invalidating(keys, cb)
+        BatchWriteJob(self._db, data, cb,
+                      concurrency=self.batch_concurrency,
+                      timeout=self.batch_timeout, deadline=deadline).start()
 
     def _multi_write_callback(self, callback, response, error):
+        getattr(self, self._tables[0])._check_error(response, error)
         callback(response.get("Responses", {}))
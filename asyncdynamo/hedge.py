@@ -0,0 +1,121 @@
+#!/bin/env python
+#
+# Copyright 2013 bit.ly
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Hedging of slow reads: sending them a second time and keeping the first answer.
+"""
+
+from instrumentation import Histogram
+from ratelimit import READ_ACTIONS
+from retry import RetryBudget
+
+
+class HedgePolicy(object):
+    '''
+    Decides when a read that has not been answered yet is sent a second time,
+    to keep a few slow connections from setting the tail latency. Whichever
+    attempt answers first is used and the other one is cancelled.
+
+    Reads are hedged after `delay` seconds if it is given. Otherwise the delay
+    is the `percentile`th percentile of the latency observed for the action
+    on the table, once `min_samples` reads have been answered; until then
+    they are not hedged. Latencies are counted over the last `window` to
+    `2 * window` reads, and the percentile is worked out again every
+    `min_samples` of them.
+
+    Each table gets a RetryBudget of hedges: every hedgeable read earns
+    `max_share` of one, up to `burst`, so hedges add no more than about
+    `max_share` to the reads sent even when everything is slow.
+
+    Only `actions`, which must be reads, are hedged. Pass an instance to
+    AsyncDynamoDB with the `hedge_policy` argument.
+    '''
+
+    def __init__(self, delay=None, percentile=95, min_samples=100, window=10000,
+                 max_share=0.05, burst=10, actions=('GetItem', 'Query')):
+        assert frozenset(actions) <= READ_ACTIONS, "only reads can be hedged"
+        self.fixed_delay = delay
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.window = window
+        self.max_share = max_share
+        self.burst = burst
+        self.actions = frozenset(actions)
+        self.budgets = {}
+        self.latencies = {}
+        self.delays = {}
+        self.requests = 0
+        self.hedged = 0
+        self.hedges_won = 0
+        self.over_budget = 0
+
+    def budget(self, table_name):
+        budget = self.budgets.get(table_name)
+        if budget is None:
+            budget = self.budgets[table_name] = RetryBudget(self.max_share, self.burst)
+        return budget
+
+    def delay(self, action, table_name):
+        '''
+        Seconds after which a read of `action` on `table_name` is hedged, or
+        None if it is not hedged. Credits the table's hedge budget.
+        '''
+        if action not in self.actions:
+            return None
+        self.requests += 1
+        self.budget(table_name).deposit()
+        if self.fixed_delay is not None:
+            return self.fixed_delay
+        return self.delays.get((action, table_name))
+
+    def should_hedge(self, table_name):
+        '''True if a hedge may be sent now, spending a token of the table's budget'''
+        if self.budget(table_name).withdraw():
+            self.hedged += 1
+            return True
+        self.over_budget += 1
+        return False
+
+    def record(self, action, table_name, seconds, hedge_won=False):
+        '''Count the latency of a read that was answered, hedged or not'''
+        if hedge_won:
+            self.hedges_won += 1
+        if self.fixed_delay is not None:
+            return
+        key = (action, table_name)
+        histograms = self.latencies.get(key)
+        if histograms is None:
+            histograms = self.latencies[key] = [Histogram(), None]
+        current, previous = histograms
+        current.record(seconds)
+        if current.count % self.min_samples:
+            return
+        merged = current
+        if previous is not None and current.count < self.window:
+            merged = Histogram()
+            merged.add(previous)
+            merged.add(current)
+        self.delays[key] = merged.percentile(self.percentile)
+        if current.count >= self.window:
+            histograms[:] = [Histogram(), current]
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'hedged': self.hedged,
+            'hedges_won': self.hedges_won,
+            'over_budget': self.over_budget,
+            'delays': dict(('%s %s' % key, delay) for key, delay in self.delays.items()),
+        }
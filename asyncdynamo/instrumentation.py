@@ -0,0 +1,259 @@
+#!/bin/env python
+#
+# Copyright 2013 bit.ly
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Per request timings of AsyncDynamoDB, fed to pluggable sinks.
+"""
+
+import logging
+import socket
+import time
+
+PHASES = ('rate_limited', 'pending', 'backoff', 'signing', 'network', 'decode', 'callback')
+
+
+class RequestRecord(object):
+    '''
+    What happened to one call to make_request, retries included. Phase
+    timings are in seconds, summed over all attempts:
+
+    rate_limited: waiting for the RateLimiter
+    pending: waiting in the queue of requests without a session token
+    backoff: waiting to retry after being throttled
+    signing: computing the request signature
+    network: from sending the request to receiving the whole response
+    decode: decoding the response (in the decode executor, if it was offloaded)
+    callback: running the request's callback
+    '''
+
+    __slots__ = ('action', 'table_name', 'request_bytes', 'response_bytes', 'status',
+                 'retries', 'consumed', 'error', 'started', 'finished',
+                 '_waiting', '_waiting_since') + PHASES
+
+    def __init__(self, action, table_name, request_bytes):
+        self.action = action
+        self.table_name = table_name
+        self.request_bytes = request_bytes
+        self.response_bytes = 0
+        self.status = None
+        self.retries = 0
+        self.consumed = 0
+        self.error = None
+        self.started = time.time()
+        self.finished = None
+        self._waiting = None
+        self._waiting_since = None
+        for phase in PHASES:
+            setattr(self, phase, 0.0)
+
+    def wait(self, phase):
+        '''Start waiting in phase, until resume is called'''
+        self._waiting = phase
+        self._waiting_since = time.time()
+
+    def resume(self):
+        if self._waiting is not None:
+            setattr(self, self._waiting,
+                    getattr(self, self._waiting) + time.time() - self._waiting_since)
+            self._waiting = None
+
+    @property
+    def total(self):
+        return (self.finished or time.time()) - self.started
+
+    def phases(self):
+        return dict((phase, getattr(self, phase)) for phase in PHASES)
+
+    def __repr__(self):
+        return '<RequestRecord %s %s %s %.1fms>' % (self.action, self.table_name, self.status,
+                                                    self.total * 1000)
+
+
+class Instrumentation(object):
+    '''
+    Pass an instance to AsyncDynamoDB as `instrumentation` to get a
+    RequestRecord for every request, handed to the `record` method of each
+    sink once the request's callback returned. Without it, requests pay for
+    nothing more than a few `is None` checks.
+    '''
+
+    def __init__(self, sinks=()):
+        self.sinks = list(sinks)
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def start(self, action, table_name, body):
+        return RequestRecord(action, table_name, len(body))
+
+    def wrap_callback(self, record, callback):
+        '''A callback that times callback, then emits the record'''
+        def instrumented_callback(response, error=None):
+            record.resume()
+            record.error = error
+            started = time.time()
+            try:
+                return callback(response, error=error)
+            finally:
+                record.finished = time.time()
+                record.callback = record.finished - started
+                self.emit(record)
+        return instrumented_callback
+
+    def emit(self, record):
+        for sink in self.sinks:
+            try:
+                sink.record(record)
+            except Exception:
+                logging.exception("Instrumentation sink %r failed" % sink)
+
+
+class Histogram(object):
+    '''
+    Histogram of positive values in the spirit of HdrHistogram: values are
+    counted in buckets whose width grows with the value, so that any
+    percentile is reported within a relative error of 2 ** -precision
+    while memory only grows with the logarithm of the range of values.
+    '''
+
+    def __init__(self, precision=7, unit=1e-6):
+        self.precision = precision
+        self.unit = unit
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def _bucket(self, value):
+        units = int(value / self.unit)
+        shift = units.bit_length() - self.precision
+        if shift > 0:
+            units = (units >> shift) << shift
+        return units
+
+    def record(self, value):
+        bucket = self._bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def add(self, other):
+        '''Count the values of another Histogram of the same precision and unit'''
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def percentile(self, percent):
+        if not self.count:
+            return None
+        rank = max(1, int(round(self.count * percent / 100.0)))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return max(self.min, min(bucket * self.unit, self.max))
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else None,
+            'min': self.min,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'p999': self.percentile(99.9),
+            'max': self.max,
+        }
+
+
+class HistogramSink(object):
+    '''
+    Keeps a Histogram of the total time and of every phase, and counts of
+    response statuses, per (action, table name).
+    '''
+
+    def __init__(self, precision=7):
+        self.precision = precision
+        self.histograms = {}
+        self.statuses = {}
+        self.consumed = {}
+
+    def record(self, record):
+        key = (record.action, record.table_name)
+        histograms = self.histograms.get(key)
+        if histograms is None:
+            histograms = self.histograms[key] = dict(
+                (name, Histogram(self.precision)) for name in ('total',) + PHASES)
+        histograms['total'].record(record.total)
+        for phase in PHASES:
+            histograms[phase].record(getattr(record, phase))
+        statuses = self.statuses.setdefault(key, {})
+        statuses[record.status] = statuses.get(record.status, 0) + 1
+        self.consumed[key] = self.consumed.get(key, 0) + record.consumed
+
+    def snapshot(self):
+        '''{"action table": {"total": {...}, "network": {...}, ..., "statuses": {...}}}'''
+        result = {}
+        for key, histograms in self.histograms.items():
+            name = '%s %s' % key
+            result[name] = dict((phase, histogram.snapshot())
+                                for phase, histogram in histograms.items())
+            result[name]['statuses'] = dict(self.statuses[key])
+            result[name]['consumed'] = self.consumed[key]
+        return result
+
+    def reset(self):
+        self.histograms.clear()
+        self.statuses.clear()
+        self.consumed.clear()
+
+
+class StatsdSink(object):
+    '''
+    Sends the timings of every request to a StatsD server over UDP, as
+    <prefix>.<table>.<action>.<phase> timers in milliseconds, with a
+    <prefix>.<table>.<action>.status.<status> counter and the capacity
+    consumed as a <prefix>.<table>.<action>.consumed counter.
+    '''
+
+    def __init__(self, host='localhost', port=8125, prefix='dynamodb'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(0)
+
+    def record(self, record):
+        name = '%s.%s.%s' % (self.prefix, record.table_name or 'none', record.action)
+        lines = ['%s.total:%.3f|ms' % (name, record.total * 1000)]
+        for phase in PHASES:
+            lines.append('%s.%s:%.3f|ms' % (name, phase, getattr(record, phase) * 1000))
+        lines.append('%s.status.%s:1|c' % (name, record.status))
+        if record.consumed:
+            lines.append('%s.consumed:%s|c' % (name, record.consumed))
+        try:
+            self.socket.sendto('\n'.join(lines), self.address)
+        except socket.error:
+            # the server is down or the buffer is full, these timings are lost
+            pass
@@ -0,0 +1,151 @@
+#!/bin/env python
+#
+# Copyright 2013 bit.ly
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Items that unpack their attributes when they are first read.
+"""
+
+from collections import MutableMapping
+
+
+_MISSING = object()
+
+
+class LazyItem(object):
+    '''
+    A mapping view of a packed item ({"name": {"S": "value"}, ...}) that
+    unpacks each attribute with `unpack_val` the first time it is read and
+    keeps the result. Reading one or two attributes of a wide item costs
+    only those attributes.
+
+    It can be used wherever the dict returned by GenDynamoTable would be.
+    The first change to it unpacks everything left, after which it is no
+    more than a dict. `dict(item)` makes a plain copy.
+
+    The mapping methods are written out rather than inherited from
+    MutableMapping, whose classes have no __slots__ on python 2 and would
+    give every item a __dict__; it is registered as one instead.
+    '''
+
+    __slots__ = ('_raw', '_values', '_unpack_val')
+
+    def __init__(self, raw, unpack_val):
+        self._raw = raw
+        self._values = {}
+        self._unpack_val = unpack_val
+
+    def __getitem__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            if self._raw is None:
+                raise
+        value = self._values[name] = self._unpack_val(self._raw[name])
+        return value
+
+    def __contains__(self, name):
+        if self._raw is None:
+            return name in self._values
+        return name in self._raw
+
+    def __iter__(self):
+        return iter(self._values if self._raw is None else self._raw)
+
+    def __len__(self):
+        return len(self._values if self._raw is None else self._raw)
+
+    def __setitem__(self, name, value):
+        self._materialize()
+        self._values[name] = value
+
+    def __delitem__(self, name):
+        self._materialize()
+        del self._values[name]
+
+    def _materialize(self):
+        if self._raw is not None:
+            for name in self._raw:
+                if name not in self._values:
+                    self._values[name] = self._unpack_val(self._raw[name])
+            self._raw = None
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+    def keys(self):
+        return list(self)
+
+    def iterkeys(self):
+        return iter(self)
+
+    def values(self):
+        return [self[name] for name in self]
+
+    def itervalues(self):
+        for name in self:
+            yield self[name]
+
+    def items(self):
+        return [(name, self[name]) for name in self]
+
+    def iteritems(self):
+        for name in self:
+            yield name, self[name]
+
+    def has_key(self, name):
+        return name in self
+
+    def __eq__(self, other):
+        if isinstance(other, LazyItem):
+            other = dict(other)
+        return dict(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def pop(self, name, default=_MISSING):
+        self._materialize()
+        if default is _MISSING:
+            return self._values.pop(name)
+        return self._values.pop(name, default)
+
+    def popitem(self):
+        self._materialize()
+        return self._values.popitem()
+
+    def clear(self):
+        self._raw = None
+        self._values.clear()
+
+    def update(self, *args, **kwargs):
+        self._materialize()
+        self._values.update(*args, **kwargs)
+
+    def setdefault(self, name, default=None):
+        self._materialize()
+        return self._values.setdefault(name, default)
+
+    def copy(self):
+        return dict(self)
+
+    def __repr__(self):
+        return 'LazyItem(%r)' % dict(self)
+
+
+MutableMapping.register(LazyItem)
@@ -0,0 +1,527 @@
+#!/bin/env python
+#
+# Copyright 2013 bit.ly
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Open loop load generator and request log replay for DynamoDB.
+
+Generate 200 requests per second for a minute, mostly gets of Zipf
+distributed keys:
+
+    asyncdynamo-loadgen --table links --hash-key user:S --range-key ts:N \\
+        --rate 200 --duration 60 --mix get=80,put=10,query=5,batch_get=5 \\
+        --distribution zipf
+
+Replay a log written by asyncdynamo.recorder.RequestRecorder twice as fast:
+
+    asyncdynamo-loadgen --replay requests.log --speed 2
+
+Add --standin to run against an in-process asyncdynamo.standin server
+rather than DynamoDB. Requests are sent on schedule whether or not earlier
+ones have completed, and latencies are measured from when a request was
+due, so a slow server shows up as latency rather than as a lower rate.
+"""
+
+import bisect
+import functools
+import json
+import logging
+import optparse
+import os
+import random
+import sys
+import time
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from capacity import CapacityTracker
+from gendynamo import GenDynamo, GenDynamoTable
+from hedge import HedgePolicy
+from instrumentation import Histogram
+from recorder import RequestRecorder, read_log
+from standin import DynamoStandIn
+from transport import HTTPTransport
+
+OPERATIONS = ('get', 'put', 'update', 'query', 'batch_get')
+
+
+class KeyChooser(object):
+    '''
+    Picks key indexes in [0, keys): uniformly, or following Zipf's law with
+    exponent s, index 0 being the most frequent.
+    '''
+
+    def __init__(self, keys, distribution='uniform', s=1.1, rng=None):
+        if distribution not in ('uniform', 'zipf'):
+            raise ValueError("unknown key distribution %r" % distribution)
+        self.keys = keys
+        self.rng = rng or random.Random()
+        self.cdf = None
+        if distribution == 'zipf':
+            total = 0.0
+            self.cdf = []
+            for rank in range(1, keys + 1):
+                total += 1.0 / rank ** s
+                self.cdf.append(total)
+            self.cdf = [weight / total for weight in self.cdf]
+
+    def __call__(self):
+        if self.cdf is None:
+            return self.rng.randrange(self.keys)
+        return min(bisect.bisect_left(self.cdf, self.rng.random()), self.keys - 1)
+
+
+class Stats(object):
+    '''Latency histograms and outcome counts, per operation and overall'''
+
+    def __init__(self):
+        self.started = time.time()
+        self.histograms = {}
+        self.counts = {}
+        self.interval = Histogram()
+        self.interval_counts = {'completed': 0, 'errors': 0}
+
+    def record(self, operation, latency, outcome):
+        if operation not in self.histograms:
+            self.histograms[operation] = Histogram()
+            self.counts[operation] = {'ok': 0, 'error': 0, 'throttled': 0}
+        self.histograms[operation].record(latency)
+        self.counts[operation][outcome] += 1
+        self.interval.record(latency)
+        self.interval_counts['completed'] += 1
+        if outcome != 'ok':
+            self.interval_counts['errors'] += 1
+
+    def take_interval(self):
+        interval, counts = self.interval, self.interval_counts
+        self.interval = Histogram()
+        self.interval_counts = {'completed': 0, 'errors': 0}
+        return interval, counts
+
+
+def _outcome(error):
+    if error is None:
+        return 'ok'
+    # GenDynamo exceptions only carry the message of the error response
+    message = str(error)
+    if 'ProvisionedThroughputExceeded' in message or 'provisioned throughput' in message:
+        return 'throttled'
+    return 'error'
+
+
+class LoadGenerator(object):
+    '''
+    Sends requests on schedule, until `duration` seconds have passed, and
+    calls callback once the last one has completed (or `drain` seconds after
+    that). `schedule` is an iterator of (seconds since start, operation)
+    pairs; `send(operation, callback)` makes the request for operation and
+    calls callback with its error, or None. Results are reported under
+    `label(operation)`, the operation itself by default. At most `max_in_flight`
+    requests are outstanding: requests due beyond that are dropped and
+    counted.
+    '''
+
+    def __init__(self, schedule, send, duration=None, max_in_flight=10000, drain=10,
+                 report_every=5, label=None, ioloop=None):
+        self.schedule = schedule
+        self.send = send
+        self.label = label
+        self.duration = duration
+        self.max_in_flight = max_in_flight
+        self.drain = drain
+        self.report_every = report_every
+        self.ioloop = ioloop or IOLoop.instance()
+        self.stats = Stats()
+        self.in_flight = 0
+        self.sent = 0
+        self.dropped = 0
+        self.next = None
+        self.done = False
+        self.callback = None
+        self.last_report = None
+
+    def start(self, callback):
+        self.callback = callback
+        self.started = self.last_report = time.time()
+        self.stats = Stats()
+        self._advance()
+        self._tick()
+
+    def _advance(self):
+        try:
+            self.next = next(self.schedule)
+        except StopIteration:
+            self.next = None
+        if self.next is not None and self.duration is not None and self.next[0] >= self.duration:
+            self.next = None
+
+    def _tick(self):
+        now = time.time()
+        while self.next is not None and self.started + self.next[0] <= now:
+            due, operation = self.next
+            self._send(operation, self.started + due)
+            self._advance()
+        if self.report_every and now - self.last_report >= self.report_every:
+            self._report(now)
+        if self.next is not None:
+            self.ioloop.add_timeout(min(self.started + self.next[0], now + 0.5), self._tick)
+        elif self.in_flight:
+            if not self.done:
+                self.done = True
+                self.ioloop.add_timeout(now + self.drain, self._finish)
+            self.ioloop.add_timeout(now + 0.1, self._tick)
+        else:
+            self._finish()
+
+    def _send(self, operation, due):
+        if self.in_flight >= self.max_in_flight:
+            self.dropped += 1
+            return
+        self.in_flight += 1
+        self.sent += 1
+        label = operation if self.label is None else self.label(operation)
+        self.send(operation, functools.partial(self._done, label, due))
+
+    def _done(self, label, due, error=None):
+        self.in_flight -= 1
+        self.stats.record(label, time.time() - due, _outcome(error))
+
+    def _report(self, now):
+        interval, counts = self.stats.take_interval()
+        seconds = now - self.last_report
+        self.last_report = now
+        logging.info("%6.1fs sent %d, %.1f/s completed, p50 %.1fms p99 %.1fms, %d errors, "
+                     "%d in flight, %d dropped" % (
+                         now - self.started, self.sent, counts['completed'] / seconds,
+                         (interval.percentile(50) or 0) * 1000,
+                         (interval.percentile(99) or 0) * 1000,
+                         counts['errors'], self.in_flight, self.dropped))
+
+    def _finish(self):
+        if self.callback is not None:
+            callback, self.callback = self.callback, None
+            self.elapsed = time.time() - self.started
+            callback()
+
+
+def generated_schedule(rate, mix, rng, arrivals='poisson'):
+    '''Endless (seconds since start, operation) pairs, rate a second, picked by weight from mix'''
+    operations = sorted(mix)
+    cumulative = []
+    total = 0.0
+    for operation in operations:
+        total += mix[operation]
+        cumulative.append(total)
+    due = 0.0
+    while True:
+        due += rng.expovariate(rate) if arrivals == 'poisson' else 1.0 / rate
+        yield due, operations[bisect.bisect_left(cumulative, rng.random() * total)]
+
+
+def replay_schedule(log, speed=1.0):
+    '''(seconds since start, request) pairs of a RequestRecorder log'''
+    for request in read_log(log):
+        yield request['t'] / speed, request
+
+
+class Workload(object):
+    '''
+    The requests of generated load, made through a GenDynamo table, for hash
+    keys picked by chooser (a KeyChooser) and range keys picked uniformly
+    among range_keys.
+    '''
+
+    def __init__(self, db, table, chooser, range_keys=100, item_bytes=100, query_limit=10,
+                 batch_size=10, rng=None):
+        self.db = db
+        self.table = table
+        self.chooser = chooser
+        self.range_keys = range_keys
+        self.payload = 'x' * item_bytes
+        self.query_limit = query_limit
+        self.batch_size = batch_size
+        self.rng = rng or random.Random()
+
+    def _hash_key(self, index):
+        return index if self.table.hash_key_type is int else 'key%08d' % index
+
+    def key(self):
+        key = {self.table.hash_key_name: self._hash_key(self.chooser())}
+        if self.table.range_key_name is not None:
+            range_key = self.rng.randrange(self.range_keys)
+            key[self.table.range_key_name] = \
+                range_key if self.table.range_key_type is int else 'r%08d' % range_key
+        return key
+
+    def item(self):
+        return dict(self.key(), payload=self.payload)
+
+    def prefill(self, standin):
+        '''Store every key of the workload in a stand-in table'''
+        items = []
+        for index in range(self.chooser.keys):
+            key = {self.table.hash_key_name: self._hash_key(index)}
+            for range_key in (range(self.range_keys) if self.table.range_key_name else [None]):
+                if range_key is not None:
+                    key[self.table.range_key_name] = range_key \
+                        if self.table.range_key_type is int else 'r%08d' % range_key
+                items.append(self.table._pack(dict(key, payload=self.payload)))
+        standin.load(self.table._table_name, items)
+
+    @gen.engine
+    def send(self, operation, callback):
+        try:
+            if operation == 'get':
+                yield self.table.get(**self.key())
+            elif operation == 'put':
+                result = yield gen.Task(self.db._db.put_item, self.table._table_name,
+                                        self.table._pack(self.item()))
+                if result.kwargs['error']:
+                    raise result.kwargs['error']
+            elif operation == 'update':
+                yield self.table.update(**self.item())
+            elif operation == 'query':
+                lowest = -1 if self.table.range_key_type is int else ''
+                yield self.table.query(self._hash_key(self.chooser())).gt(lowest) \
+                    .limit(self.query_limit)
+            elif operation == 'batch_get':
+                keys = dict((repr(sorted(key.items())), key) for key in
+                            (self.key() for i in range(self.batch_size)))
+                yield self.table.batch_get(keys.values())
+            else:
+                raise ValueError("unknown operation %r" % operation)
+        except Exception, e:
+            callback(e)
+            return
+        callback(None)
+
+
+def send_recorded(db, request, callback):
+    '''Replay a request of a RequestRecorder log with AsyncDynamoDB'''
+    def done(response, error=None):
+        callback(error)
+    db.make_request(request['action'], body=request['body'], callback=done,
+                    table_name=request['table'])
+
+
+def _parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        operation, weight = part.split('=')
+        if operation not in OPERATIONS:
+            raise ValueError("unknown operation %r, use one of %s" % (operation,
+                                                                     ', '.join(OPERATIONS)))
+        weights[operation] = float(weight)
+    return weights
+
+
+def _parse_key(spec, option):
+    if spec is None:
+        return None
+    try:
+        name, key_type = spec.split(':')
+        return {'S': str, 'N': int}[key_type], name
+    except (ValueError, KeyError):
+        raise ValueError("%s should be name:S or name:N, not %r" % (option, spec))
+
+
+def report(generator, tracker, hot_keys=5, hedge_policy=None):
+    '''Summary of a finished run, as a dict'''
+    elapsed = generator.elapsed
+    operations = {}
+    for operation, histogram in generator.stats.histograms.items():
+        counts = generator.stats.counts[operation]
+        operations[operation] = dict(counts, latency_ms=dict(
+            (name, value * 1000 if value is not None else None)
+            for name, value in histogram.snapshot().items() if name != 'count'))
+    completed = sum(histogram.count for histogram in generator.stats.histograms.values())
+    capacity = tracker.totals(window=max(1, int(elapsed) + tracker.resolution))
+    responses = sum(totals['requests'] for table in capacity.values()
+                    for totals in table['actions'].values())
+    throttled = sum(totals['throttled'] for table in capacity.values()
+                    for totals in table['actions'].values())
+    summary = {
+        'seconds': elapsed,
+        'sent': generator.sent,
+        'completed': completed,
+        'dropped': generator.dropped,
+        'throughput': completed / elapsed if elapsed else 0,
+        'operations': operations,
+        'responses': responses,
+        'throttled_responses': throttled,
+        'throttle_rate': throttled / float(responses) if responses else 0.0,
+        'capacity': dict((name, {'read': table['read'], 'write': table['write'],
+                                 'read_per_second': table['read'] / elapsed,
+                                 'write_per_second': table['write'] / elapsed})
+                         for name, table in capacity.items()),
+        'hot_keys': tracker.hot_keys(n=hot_keys),
+    }
+    if hedge_policy is not None:
+        summary['hedging'] = hedge_policy.stats()
+    return summary
+
+
+def print_report(summary):
+    print
+    print 'sent %(sent)d, completed %(completed)d, dropped %(dropped)d in %(seconds).1fs ' \
+          '(%(throughput).1f/s)' % summary
+    print 'throttled responses %d of %d (%.2f%%)' % (
+        summary['throttled_responses'], summary['responses'], summary['throttle_rate'] * 100)
+    if 'hedging' in summary:
+        print 'hedged reads %(hedged)d of %(requests)d, hedge answered first %(hedges_won)d, ' \
+              'over budget %(over_budget)d' % summary['hedging']
+    print
+    print '%-10s %8s %8s %9s %9s %9s %9s %9s' % ('operation', 'ok', 'errors', 'throttled',
+                                                 'p50 ms', 'p99 ms', 'p99.9 ms', 'max ms')
+    for operation, stats in sorted(summary['operations'].items()):
+        latency = stats['latency_ms']
+        print '%-10s %8d %8d %9d %9.1f %9.1f %9.1f %9.1f' % (
+            operation, stats['ok'], stats['error'], stats['throttled'], latency['p50'],
+            latency['p99'], latency['p999'], latency['max'])
+    for name, capacity in sorted(summary['capacity'].items()):
+        print
+        print '%s: %.1f read units (%.1f/s), %.1f write units (%.1f/s)' % (
+            name, capacity['read'], capacity['read_per_second'], capacity['write'],
+            capacity['write_per_second'])
+        hot = summary['hot_keys'].get(name)
+        if hot:
+            print '  hottest hash keys: %s' % ', '.join('%s (%d)' % (key, count)
+                                                       for key, count, error in hot)
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]", description=__doc__.split('\n\n')[0])
+    parser.add_option("--host", help="DynamoDB endpoint (default: us-east-1)")
+    parser.add_option("--port", type=int)
+    parser.add_option("--insecure", action="store_true", default=False,
+                      help="plain http rather than https")
+    parser.add_option("--no-auth", action="store_true", default=False,
+                      help="do not sign requests")
+    parser.add_option("--access-key", default=os.environ.get('AWS_ACCESS_KEY_ID'))
+    parser.add_option("--secret-key", default=os.environ.get('AWS_SECRET_ACCESS_KEY'))
+    parser.add_option("--standin", action="store_true", default=False,
+                      help="run against an in-process stand-in server, filled with the keys")
+    parser.add_option("--standin-latency", type=float, default=0.0,
+                      help="latency of the stand-in in seconds")
+    parser.add_option("--standin-throttle-rate", type=float, default=0.0,
+                      help="share of requests the stand-in throttles")
+    parser.add_option("--table", default="loadgen")
+    parser.add_option("--hash-key", default="key:S", help="name:S or name:N")
+    parser.add_option("--range-key", help="name:S or name:N")
+    parser.add_option("--rate", type=float, default=100.0, help="requests per second")
+    parser.add_option("--duration", type=float, default=60.0, help="seconds")
+    parser.add_option("--arrivals", choices=['poisson', 'uniform'], default='poisson')
+    parser.add_option("--mix", default="get=80,put=10,query=5,batch_get=5",
+                      help="weights of %s" % ', '.join(OPERATIONS))
+    parser.add_option("--keys", type=int, default=10000, help="distinct hash keys")
+    parser.add_option("--distribution", choices=['uniform', 'zipf'], default='uniform')
+    parser.add_option("--zipf-s", type=float, default=1.1, help="Zipf exponent")
+    parser.add_option("--range-keys", type=int, default=10,
+                      help="distinct range keys per hash key")
+    parser.add_option("--item-bytes", type=int, default=100)
+    parser.add_option("--query-limit", type=int, default=10)
+    parser.add_option("--batch-size", type=int, default=10)
+    parser.add_option("--replay", help="replay this RequestRecorder log instead")
+    parser.add_option("--speed", type=float, default=1.0, help="replay speed")
+    parser.add_option("--record", help="record the requests made to this log")
+    parser.add_option("--hedge-delay", type=float,
+                      help="hedge gets and queries unanswered after this many seconds")
+    parser.add_option("--hedge-percentile", type=float,
+                      help="hedge gets and queries slower than this percentile of their latency")
+    parser.add_option("--hedge-share", type=float, default=0.05,
+                      help="most hedges per read (default 0.05)")
+    parser.add_option("--connections", type=int, default=100)
+    parser.add_option("--max-in-flight", type=int, default=10000)
+    parser.add_option("--report-every", type=float, default=5.0)
+    parser.add_option("--json", help="write the summary to this json file")
+    parser.add_option("--seed", type=int)
+    options, args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    logging.getLogger('tornado.access').setLevel(logging.WARNING)
+
+    try:
+        hash_key = _parse_key(options.hash_key, '--hash-key')
+        range_key = _parse_key(options.range_key, '--range-key')
+        mix = _parse_mix(options.mix)
+    except ValueError, e:
+        parser.error(str(e))
+    if mix.get('query') and range_key is None:
+        parser.error("query needs a table with a --range-key")
+    rng = random.Random(options.seed)
+    ioloop = IOLoop.instance()
+
+    tracker = CapacityTracker(windows=(max(60, int(options.duration) + 60),), resolution=1,
+                              key_sample_rate=1.0)
+    recorder = RequestRecorder(options.record) if options.record else None
+    transport = HTTPTransport(ioloop=ioloop, max_clients=options.connections)
+    standin = None
+    if options.standin:
+        standin = DynamoStandIn(latency=options.standin_latency,
+                                throttle_rate=options.standin_throttle_rate, ioloop=ioloop)
+        standin.create_table(options.table, (hash_key[1], 'N' if hash_key[0] is int else 'S'),
+                             range_key and (range_key[1], 'N' if range_key[0] is int else 'S'),
+                             read_units=1000000, write_units=1000000)
+        standin.listen()
+        kwargs = standin.client_kwargs(authenticate_requests=not options.no_auth)
+    else:
+        kwargs = dict(aws_access_key_id=options.access_key,
+                      aws_secret_access_key=options.secret_key, host=options.host,
+                      port=options.port, is_secure=not options.insecure,
+                      authenticate_requests=not options.no_auth, ioloop=ioloop)
+    hedge_policy = None
+    if options.hedge_delay is not None or options.hedge_percentile is not None:
+        hedge_policy = HedgePolicy(delay=options.hedge_delay,
+                                   percentile=options.hedge_percentile or 95,
+                                   max_share=options.hedge_share)
+    kwargs.update(transport=transport, capacity_tracker=tracker, request_recorder=recorder,
+                  hedge_policy=hedge_policy)
+
+    db_class = type('LoadDB', (GenDynamo,), {options.table: GenDynamoTable(hash_key, range_key)})
+    db = db_class(**kwargs)
+    if options.replay:
+        schedule = replay_schedule(options.replay, options.speed)
+        send = lambda request, callback: send_recorded(db._db, request, callback)
+        duration = None
+    else:
+        keys = KeyChooser(options.keys, options.distribution, options.zipf_s, rng)
+        workload = Workload(db, getattr(db, options.table), keys, range_keys=options.range_keys,
+                            item_bytes=options.item_bytes, query_limit=options.query_limit,
+                            batch_size=options.batch_size, rng=rng)
+        if standin is not None:
+            workload.prefill(standin)
+        schedule = generated_schedule(options.rate, mix, rng, options.arrivals)
+        send = workload.send
+        duration = options.duration
+
+    generator = LoadGenerator(schedule, send, duration=duration,
+                              max_in_flight=options.max_in_flight,
+                              report_every=options.report_every,
+                              label=(lambda request: request['action']) if options.replay else None,
+                              ioloop=ioloop)
+    ioloop.add_callback(functools.partial(generator.start, ioloop.stop))
+    ioloop.start()
+
+    if recorder is not None:
+        recorder.close()
+    summary = report(generator, tracker, hedge_policy=hedge_policy)
+    print_report(summary)
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,144 @@
+#!/bin/env python
+#
+# Copyright 2013 bit.ly
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Queue for requests waiting on a session token.
+"""
+
+from collections import deque
+import time
+
+from boto.exception import DynamoDBResponseError
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
+OVERFLOW_FAIL = 'fail'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+
+
+class PendingQueueFullError(DynamoDBResponseError):
+    '''
+    Error passed to the callback of a request that did not fit in the queue
+    of requests waiting for a session token
+    '''
+
+    def __init__(self):
+        DynamoDBResponseError.__init__(self, None, 'Pending request queue is full')
+
+
+class PendingRequestQueue(object):
+    '''
+    Bounded queue of requests waiting for a session token, with one FIFO per
+    priority class. Lower numbers are replayed first.
+
+    When the queue holds `maxsize` requests, `overflow` decides what happens to
+    a new one: OVERFLOW_FAIL rejects it, OVERFLOW_DROP_OLDEST makes room by
+    failing the oldest request of the least important non-empty class.
+    Failed requests get a PendingQueueFullError.
+
+    Requests pushed with an asyncdynamo.deadline.RequestHandle are dropped
+    once it is cancelled or past its deadline: they are skipped when popped,
+    and cleared out before the queue counts as full.
+    '''
+
+    def __init__(self, maxsize=10000, overflow=OVERFLOW_FAIL, priorities=3):
+        assert overflow in (OVERFLOW_FAIL, OVERFLOW_DROP_OLDEST)
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.queues = [deque() for i in range(priorities)]
+        self.size = 0
+        self.enqueued = 0
+        self.dropped = 0
+        self.expired = 0
+        self.replayed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, request, callback, priority=PRIORITY_NORMAL, handle=None):
+        '''
+        Queue request, a callable taking no arguments. callback is the request's
+        callback, used to fail it if it is dropped. Returns False if the request
+        was rejected because the queue is full, and its callback was not called.
+        '''
+        priority = min(max(priority, 0), len(self.queues) - 1)
+        if self.size >= self.maxsize:
+            self.purge()
+        if self.size >= self.maxsize:
+            if self.overflow == OVERFLOW_FAIL:
+                self.dropped += 1
+                return False
+            for queue in reversed(self.queues):
+                if queue:
+                    enqueued_at, dropped_request, dropped_callback, dropped_handle = queue.popleft()
+                    self.size -= 1
+                    self.dropped += 1
+                    dropped_callback({}, error=PendingQueueFullError())
+                    break
+        self.queues[priority].append((time.time(), request, callback, handle))
+        self.size += 1
+        self.enqueued += 1
+        return True
+
+    def pop(self):
+        '''Return the oldest request of the most important class, or None if the queue is empty'''
+        for queue in self.queues:
+            while queue:
+                enqueued_at, request, callback, handle = queue.popleft()
+                self.size -= 1
+                if handle is not None and handle.abandoned():
+                    self._expire(callback, handle)
+                    continue
+                self.replayed += 1
+                waited = time.time() - enqueued_at
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+                return request, callback
+        return None
+
+    def purge(self):
+        '''Drop the requests that were cancelled or are past their deadline'''
+        for queue in self.queues:
+            live = deque()
+            for entry in queue:
+                if entry[3] is not None and entry[3].abandoned():
+                    self.size -= 1
+                    self._expire(entry[2], entry[3])
+                else:
+                    live.append(entry)
+            queue.clear()
+            queue.extend(live)
+
+    def _expire(self, callback, handle):
+        self.expired += 1
+        # the handle ignores it, but wrappers such as instrumentation see the request end
+        callback({}, error=handle.error)
+
+    def stats(self):
+        '''Queue depth and how long replayed requests waited, in seconds'''
+        return {
+            'depth': self.size,
+            'depth_by_priority': [len(queue) for queue in self.queues],
+            'enqueued': self.enqueued,
+            'dropped': self.dropped,
+            'expired': self.expired,
+            'replayed': self.replayed,
+            'wait_avg': self.wait_total / self.replayed if self.replayed else 0.0,
+            'wait_max': self.wait_max,
+        }
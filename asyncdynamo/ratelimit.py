@@ -0,0 +1,326 @@
+#!/bin/env python
+#
+# Copyright 2013 bit.ly
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Client side rate limiting of DynamoDB requests, per table.
+"""
+
+from collections import deque
+import functools
+import logging
+import time
+
+READ_ACTIONS = frozenset(['GetItem', 'BatchGetItem', 'Query', 'Scan'])
+WRITE_ACTIONS = frozenset(['PutItem', 'UpdateItem', 'DeleteItem', 'BatchWriteItem'])
+
+
+def action_kind(action):
+    '''Returns 'read' or 'write' for actions that consume capacity, otherwise None'''
+    if action in READ_ACTIONS:
+        return 'read'
+    if action in WRITE_ACTIONS:
+        return 'write'
+    return None
+
+
+class TokenBucket(object):
+    '''
+    A token bucket whose refill rate is adjusted with AIMD (additive increase,
+    multiplicative decrease), like TCP congestion control.
+
+    Every request takes one token up front; once the response arrives the
+    bucket is charged for the capacity units actually consumed, so expensive
+    queries leave the bucket in debt and delay the requests behind them.
+    Requests that cannot be admitted wait in FIFO order on the IOLoop; those
+    whose asyncdynamo.deadline.RequestHandle is cancelled or past its deadline
+    meanwhile are dropped without taking a token.
+    '''
+
+    def __init__(self, ceiling, ioloop, burst_seconds=1.0, min_rate=1.0,
+                 increase=0.05, decrease=0.5):
+        self.ceiling = float(ceiling)
+        self.rate = self.ceiling
+        self.ioloop = ioloop
+        self.burst_seconds = burst_seconds
+        self.min_rate = min(float(min_rate), self.ceiling)
+        self.increase = increase
+        self.decrease = decrease
+        self.tokens = self.rate * burst_seconds
+        self.updated = self.adjusted = time.time()
+        self.waiters = deque()
+        self._timeout = None
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.rate * self.burst_seconds,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, callback, handle=None):
+        '''Run callback, now if the bucket has a token or later on the IOLoop if it doesn't'''
+        self._refill()
+        if not self.waiters and self.tokens >= 1:
+            self.tokens -= 1
+            return callback()
+        self.waiters.append((callback, handle))
+        self._schedule()
+
+    def _schedule(self):
+        if self._timeout is None:
+            delay = max(0, (1 - self.tokens) / self.rate)
+            self._timeout = self.ioloop.add_timeout(time.time() + delay, self._release)
+
+    def _release(self):
+        self._timeout = None
+        self._refill()
+        while self.waiters and self.tokens >= 1:
+            callback, handle = self.waiters.popleft()
+            if handle is not None and handle.abandoned():
+                # _make_request drops it without sending it
+                callback()
+                continue
+            self.tokens -= 1
+            callback()
+        if self.waiters:
+            self._schedule()
+
+    def charge(self, units):
+        '''Take tokens for capacity consumed beyond what was taken when the request was admitted'''
+        self._refill()
+        self.tokens -= units
+
+    def throttled(self):
+        '''DynamoDB rejected a request, cut the rate sharply'''
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self.tokens = min(self.tokens, self.rate * self.burst_seconds)
+        self.adjusted = time.time()
+
+    def succeeded(self):
+        '''Creep back towards the ceiling by `increase` of it per second'''
+        now = time.time()
+        if self.rate < self.ceiling:
+            self.rate = min(self.ceiling, self.rate + self.ceiling * self.increase * (now - self.adjusted))
+        self.adjusted = now
+
+
+class RateLimiter(object):
+    '''
+    Holds a read and a write TokenBucket for every table, and makes requests
+    wait on the IOLoop until their table has capacity left for them.
+
+    Buckets start at the table's provisioned throughput, taken from
+    `capacities` ({table_name: (read_units, write_units)}) or, for tables
+    not listed there, fetched with DescribeTable the first time the table is
+    used (unless `describe_tables` is False, in which case such tables are
+    not limited). The rate then adapts: halved on every throttled request and
+    raised slowly while requests succeed.
+
+    Pass an instance to AsyncDynamoDB with the `rate_limiter` argument.
+    '''
+
+    def __init__(self, capacities=None, describe_tables=True, burst_seconds=1.0,
+                 min_rate=1.0, increase=0.05, decrease=0.5):
+        self.capacities = dict(capacities or {})
+        self.describe_tables = describe_tables
+        self.burst_seconds = burst_seconds
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.buckets = {}
+        self.db = None
+        self._describing = {}
+
+    def bind(self, db):
+        '''Attach to the AsyncDynamoDB instance whose requests are limited'''
+        self.db = db
+
+    def _bucket(self, table_name, kind):
+        bucket = self.buckets.get((table_name, kind))
+        if bucket is None:
+            capacity = self.capacities.get(table_name)
+            if not capacity:
+                return None
+            read_units, write_units = capacity
+            bucket = TokenBucket(read_units if kind == 'read' else write_units, self.db.ioloop,
+                                 burst_seconds=self.burst_seconds, min_rate=self.min_rate,
+                                 increase=self.increase, decrease=self.decrease)
+            self.buckets[(table_name, kind)] = bucket
+        return bucket
+
+    def acquire(self, action, table_name, callback, handle=None):
+        '''
+        Call callback once a request of type `action` may be sent to `table_name`.
+        Requests that do not consume capacity, or are not tied to a single table,
+        are never delayed. handle is the request's asyncdynamo.deadline.RequestHandle,
+        if it has one.
+        '''
+        kind = action_kind(action)
+        if kind is None or table_name is None:
+            return callback()
+        bucket = self._bucket(table_name, kind)
+        if bucket is not None:
+            return bucket.acquire(callback, handle)
+        if not self.describe_tables or table_name in self.capacities:
+            return callback()
+        if table_name in self._describing:
+            self._describing[table_name].append((action, callback, handle))
+            return
+        self._describing[table_name] = [(action, callback, handle)]
+        self.db.describe_table(table_name, callback=functools.partial(self._finish_describe, table_name))
+
+    def _finish_describe(self, table_name, response, error=None):
+        if error:
+            logging.warning("Unable to describe table %s, it will not be rate limited: %s" % (table_name, error))
+            self.capacities[table_name] = None
+        else:
+            throughput = response['Table']['ProvisionedThroughput']
+            self.capacities[table_name] = (throughput['ReadCapacityUnits'],
+                                           throughput['WriteCapacityUnits'])
+        for action, callback, handle in self._describing.pop(table_name, []):
+            self.acquire(action, table_name, callback, handle)
+
+    def record(self, action, table_name, consumed, throttled=False):
+        '''
+        Adapt to the outcome of a request. consumed maps table names to the
+        ConsumedCapacityUnits reported in the response.
+        '''
+        kind = action_kind(action)
+        if kind is None:
+            return
+        if throttled:
+            bucket = self.buckets.get((table_name, kind))
+            if bucket is not None:
+                bucket.throttled()
+            return
+        for name, units in consumed.items():
+            bucket = self.buckets.get((name, kind))
+            if bucket is not None:
+                # requests tied to a single table already took a token in acquire
+                bucket.charge(units - 1 if name == table_name else units)
+                bucket.succeeded()
+
+
+class ScanPacer(object):
+    '''
+    Spaces out the pages of a long scan so that it consumes about `share` of
+    the table's provisioned read capacity, leaving the rest to everyone else.
+
+    The read capacity is `read_capacity` or, if that is None, fetched with
+    DescribeTable before the first page. Every page reserves the capacity
+    units the previous pages used on average, and is corrected by what it
+    actually used once it is back, so pages are sent at the rate that
+    consumes `share` of the capacity.
+
+    Whenever the scan or another request to the table made through the same
+    AsyncDynamoDB is throttled, as counted in its `throttles`, the share used
+    is multiplied by `decrease` (down to `min_share`); each page that goes
+    through without throttling then adds `increase` of `share` back.
+    '''
+
+    def __init__(self, db, table_name, share=0.2, read_capacity=None,
+                 min_share=0.01, increase=0.05, decrease=0.5):
+        assert 0 < share <= 1
+        self.db = db
+        self.table_name = table_name
+        self.share = share
+        self.current_share = share
+        self.min_share = min(min_share, share)
+        self.increase = increase
+        self.decrease = decrease
+        self.read_capacity = read_capacity
+        self.estimate = 1.0
+        self.next_at = 0
+        self.pages = 0
+        self.units = 0
+        self.throttles = 0
+        self.waited = 0.0
+        self.started = None
+        self._seen_throttles = db.throttles.get(table_name, 0)
+        self._describing = None
+
+    def rate(self):
+        '''Capacity units per second the scan may consume now, None if it is not paced'''
+        if not self.read_capacity:
+            return None
+        return self.read_capacity * self.current_share
+
+    def wait(self, callback):
+        '''Call callback once the next page may be requested'''
+        if self.started is None:
+            self.started = time.time()
+        if self.read_capacity is None and self._describing is not False:
+            if self._describing is None:
+                self._describing = [callback]
+                self.db.describe_table(self.table_name, callback=self._finish_describe)
+            else:
+                self._describing.append(callback)
+            return
+        rate = self.rate()
+        if rate is None:
+            return callback()
+        now = time.time()
+        start = max(now, self.next_at)
+        self.next_at = start + self.estimate / rate
+        if start <= now:
+            return callback()
+        self.waited += start - now
+        self.db.ioloop.add_timeout(start, callback)
+
+    def _finish_describe(self, response, error=None):
+        if error:
+            logging.warning("Unable to describe table %s, the scan will not be paced: %s" % (self.table_name, error))
+        else:
+            self.read_capacity = response['Table']['ProvisionedThroughput']['ReadCapacityUnits']
+        waiters, self._describing = self._describing, False
+        for callback in waiters:
+            self.wait(callback)
+
+    def is_throttle(self, response):
+        '''True if response is the error of a request throttled by DynamoDB'''
+        return isinstance(response, dict) and self.db.ThruputError in response.get('__type', '')
+
+    def record(self, units):
+        '''Account for a page that consumed `units`'''
+        rate = self.rate()
+        if rate is not None:
+            self.next_at += (units - self.estimate) / rate
+        self.pages += 1
+        self.units += units
+        # DynamoDB charges at least half a unit for any read
+        self.estimate = max(0.5, self.units / float(self.pages))
+        throttles = self.db.throttles.get(self.table_name, 0)
+        if throttles > self._seen_throttles:
+            self._seen_throttles = throttles
+            self.throttled()
+        else:
+            self.current_share = min(self.share, self.current_share + self.share * self.increase)
+
+    def throttled(self):
+        '''A page, or another request to the table, was throttled: slow down'''
+        self._seen_throttles = self.db.throttles.get(self.table_name, 0)
+        self.throttles += 1
+        self.current_share = max(self.min_share, self.current_share * self.decrease)
+
+    def progress(self):
+        elapsed = time.time() - self.started if self.started is not None else 0.0
+        return {
+            'pages': self.pages,
+            'units': self.units,
+            'units_per_second': self.units / elapsed if elapsed else 0.0,
+            'target_units_per_second': self.rate(),
+            'share': self.current_share,
+            'throttles': self.throttles,
+            'waited': self.waited,
+        }
@@ -0,0 +1,84 @@
+#!/bin/env python
+#
+# Copyright 2013 bit.ly
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Recording of the requests made through AsyncDynamoDB, for replay by
+asyncdynamo.loadgen.
+"""
+
+import json
+import random
+import time
+
+from ratelimit import READ_ACTIONS, WRITE_ACTIONS
+
+
+class RequestRecorder(object):
+    '''
+    Writes the requests made with AsyncDynamoDB.make_request to `log` (a file
+    name or a file object), one json object per line:
+
+        {"t": seconds since the first request, "action": "GetItem",
+         "table": "links", "body": "<the request body>"}
+
+    Only actions that read or write items are recorded, unless `actions`
+    lists others, and only a `sample_rate` share of them. Requests are
+    recorded as the application makes them: retries are not, but reads that
+    share a request with single_flight each are, so a replay sends them all.
+
+    Pass an instance to AsyncDynamoDB with the `request_recorder` argument.
+    '''
+
+    def __init__(self, log, sample_rate=1.0, actions=None):
+        if isinstance(log, basestring):
+            log = open(log, 'a')
+            self._owns_log = True
+        else:
+            self._owns_log = False
+        self.log = log
+        self.sample_rate = sample_rate
+        self.actions = frozenset(actions or READ_ACTIONS | WRITE_ACTIONS)
+        self.started = None
+        self.count = 0
+
+    def record(self, action, table_name, body):
+        if action not in self.actions or self.log is None:
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        now = time.time()
+        if self.started is None:
+            self.started = now
+        self.log.write(json.dumps({'t': round(now - self.started, 6), 'action': action,
+                                   'table': table_name, 'body': body}) + '\n')
+        self.count += 1
+
+    def close(self):
+        if self.log is not None:
+            if self._owns_log:
+                self.log.close()
+            else:
+                self.log.flush()
+            self.log = None
+
+
+def read_log(log):
+    '''The requests of a RequestRecorder log (a file name or object), as dicts'''
+    if isinstance(log, basestring):
+        log = open(log)
+    for line in log:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
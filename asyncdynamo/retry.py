@@ -0,0 +1,107 @@
+#!/bin/env python
+#
+# Copyright 2013 bit.ly
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Retry policy for throttled DynamoDB requests.
+"""
+
+import random
+
+
+class RetryBudget(object):
+    '''
+    Caps retries to a fraction of the requests actually sent to a table.
+
+    Every request deposits `ratio` tokens (up to `burst`), and every retry
+    withdraws a whole token. With the defaults at most one request in five
+    may be retried once the initial burst is used up, so a throttling storm
+    can never multiply the request volume sent to DynamoDB.
+    '''
+
+    def __init__(self, ratio, burst):
+        self.ratio = ratio
+        self.burst = float(burst)
+        self.tokens = float(burst)
+
+    def deposit(self):
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def withdraw(self):
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RetryPolicy(object):
+    '''
+    Decides whether, and when, a throttled request is sent again.
+
+    Retries are spaced with capped exponential backoff and "full jitter"
+    (a uniformly random delay between 0 and the backoff ceiling), so clients
+    that were throttled together do not come back together. Each table gets
+    its own RetryBudget; requests made without a table name share one.
+
+    :type max_attempts: int
+    :param max_attempts: Total number of attempts per request, including the
+        first one. Use 1 to disable retries.
+
+    :type base_delay: float
+    :param base_delay: Backoff ceiling, in seconds, for the first retry. It
+        doubles on every subsequent attempt.
+
+    :type max_delay: float
+    :param max_delay: Upper bound for the backoff ceiling, in seconds.
+
+    :type budget_ratio: float
+    :param budget_ratio: Retry tokens earned by every request sent.
+
+    :type budget_burst: int
+    :param budget_burst: Maximum number of retry tokens a table can save up.
+    '''
+
+    def __init__(self, max_attempts=5, base_delay=0.05, max_delay=2.0,
+                 budget_ratio=0.2, budget_burst=10):
+        assert (isinstance(max_attempts, int) and max_attempts >= 1)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.budget_burst = budget_burst
+        self.budgets = {}
+
+    def budget(self, table_name):
+        budget = self.budgets.get(table_name)
+        if budget is None:
+            budget = self.budgets[table_name] = RetryBudget(self.budget_ratio, self.budget_burst)
+        return budget
+
+    def record_request(self, table_name):
+        '''Credit the table's retry budget for a request that is being sent'''
+        self.budget(table_name).deposit()
+
+    def should_retry(self, table_name, attempts):
+        '''
+        Returns True if a request that has already been retried `attempts` times
+        may be sent again. A True answer spends a token from the table's budget.
+        '''
+        if attempts + 1 >= self.max_attempts:
+            return False
+        return self.budget(table_name).withdraw()
+
+    def backoff(self, attempts):
+        '''Seconds to wait before retry number `attempts + 1`'''
+        ceiling = min(self.max_delay, self.base_delay * (2 ** attempts))
+        return random.uniform(0, ceiling)
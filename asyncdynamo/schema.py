@@ -0,0 +1,142 @@
+#!/bin/env python
+#
+# Copyright 2013 bit.ly
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Pack and unpack functions specialised for a table's attribute schema.
+"""
+
+# schema values accepted for each DynamoDB type
+TYPES = {
+    int: 'N', long: 'N', 'N': 'N',
+    str: 'S', unicode: 'S', basestring: 'S', 'S': 'S',
+    'NS': 'NS', 'SS': 'SS',
+}
+
+_UNPACK = {
+    'N': 'int(value["N"])',
+    'S': 'value["S"]',
+    'NS': 'set(map(int, value["NS"]))',
+    'SS': 'set(value["SS"])',
+}
+
+# values that are packed with _PACK; others go to pack_val
+_GUARD = {
+    'N': 'isinstance(value, (int, long))',
+    'S': 'isinstance(value, basestring)',
+    'NS': 'is_set_of(value, (int, long))',
+    'SS': 'is_set_of(value, basestring)',
+}
+
+_PACK = {
+    'N': '{"N": str(value)}',
+    'S': '{"S": value}',
+    'NS': '{"NS": map(str, value)}',
+    'SS': '{"SS": list(value)}',
+}
+
+
+def is_set_of(value, types):
+    '''True if value is a set whose elements are all instances of types'''
+    if not isinstance(value, (set, frozenset)):
+        return False
+    for element in value:
+        if not isinstance(element, types):
+            return False
+    return True
+
+
+def normalize(schema):
+    '''Map of attribute name to DynamoDB type code ("N", "S", "NS" or "SS")'''
+    types = {}
+    for name, attr_type in schema.items():
+        if attr_type not in TYPES:
+            raise TypeError("%r can not be stored in attribute %r, use int, "
+                            "str, 'NS' or 'SS'" % (attr_type, name))
+        types[name] = TYPES[attr_type]
+    return types
+
+
+def _pack_source(types):
+    '''Source of pack(item), which falls back to pack_val like unpack does to unpack_val'''
+    lines = ['def pack(item):',
+             '    packed = {}',
+             '    found = 0']
+    for name, code in sorted(types.items()):
+        lines += ['    value = item.get(%r)' % name,
+                  '    if value is not None:',
+                  '        found += 1',
+                  '        if %s:' % _GUARD[code]]
+        if code in ('NS', 'SS'):
+            lines += ['            if not value:',
+                      '                raise ValueError("empty sets are not supported by DynamoDB")']
+        lines += ['            packed[%r] = %s' % (name, _PACK[code]),
+                  '        else:',
+                  '            packed[%r] = pack_val(value)' % name]
+    lines += ['    if found != len(item):',
+              '        for name, value in item.iteritems():',
+              '            if name not in packed:',
+              '                packed[name] = pack_val(value)',
+              '    return packed']
+    return '\n'.join(lines)
+
+
+def _unpack_source(types, indent):
+    '''Statements unpacking `item` into `unpacked`, falling back to unpack_val'''
+    lines = ['unpacked = {}',
+             'try:',
+             '    found = 0']
+    for name, code in sorted(types.items()):
+        lines += ['    value = item.get(%r)' % name,
+                  '    if value is not None:',
+                  '        found += 1',
+                  '        unpacked[%r] = %s' % (name, _UNPACK[code])]
+    lines += ['    if found != len(item):',
+              '        for name, value in item.iteritems():',
+              '            if name not in unpacked:',
+              '                unpacked[name] = unpack_val(value)',
+              'except KeyError:',
+              '    # an attribute does not have the type of the schema',
+              '    unpacked = dict((name, unpack_val(value)) for name, value in item.iteritems())']
+    return '\n'.join(' ' * indent + line for line in lines)
+
+
+def compile_schema(schema, pack_val, unpack_val):
+    '''
+    Returns (pack, unpack, unpack_items) functions for items whose
+    attributes have the types in schema. pack_val and unpack_val handle
+    the attributes that are not in it, or do not have its type: a value is
+    only packed for its declared type if it is an instance of it.
+
+    unpack_items unpacks a whole list of items in a single call.
+    '''
+    types = normalize(schema)
+    source = '\n'.join([
+        _pack_source(types),
+        '',
+        'def unpack(item):',
+        _unpack_source(types, 4),
+        '    return unpacked',
+        '',
+        'def unpack_items(items):',
+        '    result = []',
+        '    append = result.append',
+        '    for item in items:',
+        _unpack_source(types, 8),
+        '        append(unpacked)',
+        '    return result',
+    ])
+    namespace = {'pack_val': pack_val, 'unpack_val': unpack_val, 'is_set_of': is_set_of}
+    exec compile(source, '<schema %s>' % ', '.join(sorted(types)), 'exec') in namespace
+    return namespace['pack'], namespace['unpack'], namespace['unpack_items']
@@ -0,0 +1,855 @@
+#!/bin/env python
+#
+# Copyright 2013 bit.ly
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+An in-process stand-in for DynamoDB and STS, to test and benchmark
+AsyncDynamoDB without AWS.
+
+    standin = DynamoStandIn(latency=0.002)
+    standin.create_table('links', ('hash', 'S'), ('ts', 'N'), read_units=100)
+    standin.listen()
+    db = GenDynamo(**standin.client_kwargs())
+
+or from the command line:
+
+    python -m asyncdynamo.standin --port 8000 --table links:hash:S:ts:N
+"""
+
+import bisect
+import functools
+import json
+import logging
+import math
+import optparse
+import random
+import time
+import zlib
+from decimal import Decimal
+
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from tornado.web import Application, RequestHandler, asynchronous
+
+_DYNAMODB_ERRORS = 'com.amazonaws.dynamodb.v20111205#'
+THROUGHPUT_EXCEEDED = _DYNAMODB_ERRORS + 'ProvisionedThroughputExceededException'
+CONDITIONAL_CHECK_FAILED = _DYNAMODB_ERRORS + 'ConditionalCheckFailedException'
+RESOURCE_NOT_FOUND = _DYNAMODB_ERRORS + 'ResourceNotFoundException'
+INTERNAL_SERVER_ERROR = _DYNAMODB_ERRORS + 'InternalServerError'
+VALIDATION = 'com.amazon.coral.validate#ValidationException'
+EXPIRED_TOKEN = 'com.amazon.coral.service#ExpiredTokenException'
+UNRECOGNIZED_CLIENT = 'com.amazon.coral.service#UnrecognizedClientException'
+UNKNOWN_OPERATION = 'com.amazon.coral.service#UnknownOperationException'
+
+_THROUGHPUT_MESSAGE = "The level of configured provisioned throughput for the table was exceeded. " \
+    "Consider increasing your provisioning level with the UpdateTable API"
+
+ACTIONS = {
+    'GetItem': 'get_item',
+    'PutItem': 'put_item',
+    'UpdateItem': 'update_item',
+    'DeleteItem': 'delete_item',
+    'BatchGetItem': 'batch_get_item',
+    'BatchWriteItem': 'batch_write_item',
+    'Query': 'query',
+    'Scan': 'scan',
+    'DescribeTable': 'describe_table',
+}
+
+_STS_RESPONSE = '''<GetSessionTokenResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/">
+  <GetSessionTokenResult>
+    <Credentials>
+      <SessionToken>%(token)s</SessionToken>
+      <SecretAccessKey>standin-secret-key</SecretAccessKey>
+      <Expiration>%(expiration)s</Expiration>
+      <AccessKeyId>standin-access-key</AccessKeyId>
+    </Credentials>
+  </GetSessionTokenResult>
+  <ResponseMetadata>
+    <RequestId>%(request_id)s</RequestId>
+  </ResponseMetadata>
+</GetSessionTokenResponse>'''
+
+
+class StandInError(Exception):
+    '''An error response: the __type and message of its body, and its HTTP status'''
+
+    def __init__(self, error_type, message, status=400):
+        Exception.__init__(self, message)
+        self.error_type = error_type
+        self.message = message
+        self.status = status
+
+
+class _Last(object):
+    '''Sorts after any range key, to find the end of a hash key's items'''
+
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
+
+    def __eq__(self, other):
+        return other is self
+
+_LAST = _Last()
+
+
+def _value(attribute):
+    '''(type, value) of a packed attribute, numbers as Decimals and sets as sets'''
+    if not isinstance(attribute, dict) or len(attribute) != 1:
+        raise StandInError(VALIDATION, "invalid attribute value %r" % (attribute,))
+    (code, raw), = attribute.items()
+    try:
+        if code == 'N':
+            return code, Decimal(raw)
+        if code == 'S':
+            return code, raw
+        if code == 'NS':
+            return code, set(Decimal(v) for v in raw)
+        if code == 'SS':
+            return code, set(raw)
+    except Exception:
+        pass
+    raise StandInError(VALIDATION, "invalid attribute value %r" % (attribute,))
+
+
+def _element(code, raw):
+    '''The value of one element of a packed set'''
+    return Decimal(raw) if code == 'NS' else raw
+
+
+def _size(item):
+    size = 0
+    for name, attribute in item.items():
+        size += len(name)
+        for raw in attribute.values():
+            if isinstance(raw, list):
+                size += sum(len(v) for v in raw)
+            else:
+                size += len(raw)
+    return size
+
+
+def _units(size, consistent=True):
+    units = max(1, int(math.ceil(size / 1024.0)))
+    return units if consistent else units / 2.0
+
+
+def _matches(attribute, operator, operands):
+    '''Whether a packed attribute (None if missing) satisfies a comparison'''
+    if operator == 'NULL':
+        return attribute is None
+    if operator == 'NOT_NULL':
+        return attribute is not None
+    if attribute is None:
+        return False
+    code, value = _value(attribute)
+    args = [_value(operand) for operand in operands]
+    if not args:
+        raise StandInError(VALIDATION, "%s needs a value to compare to" % operator)
+    if operator == 'IN':
+        return (code, value) in args
+    if operator in ('CONTAINS', 'NOT_CONTAINS'):
+        arg_code, arg = args[0]
+        if code == 'S':
+            found = arg_code == 'S' and arg in value
+        elif code in ('SS', 'NS'):
+            found = arg_code == code[0] and arg in value
+        else:
+            found = False
+        return found if operator == 'CONTAINS' else not found
+    if any(arg_code != code for arg_code, arg in args):
+        return operator == 'NE'
+    args = [arg for arg_code, arg in args]
+    if operator == 'EQ':
+        return value == args[0]
+    if operator == 'NE':
+        return value != args[0]
+    if operator == 'LT':
+        return value < args[0]
+    if operator == 'LE':
+        return value <= args[0]
+    if operator == 'GT':
+        return value > args[0]
+    if operator == 'GE':
+        return value >= args[0]
+    if operator == 'BEGINS_WITH':
+        return code == 'S' and value.startswith(args[0])
+    if operator == 'BETWEEN':
+        if len(args) != 2:
+            raise StandInError(VALIDATION, "BETWEEN needs two values")
+        return args[0] <= value <= args[1]
+    raise StandInError(VALIDATION, "unknown comparison operator %r" % operator)
+
+
+def _project(item, attributes_to_get):
+    if not attributes_to_get:
+        return item
+    return dict((name, item[name]) for name in attributes_to_get if name in item)
+
+
+class StandInTable(object):
+    '''
+    A table of the stand-in. Items are kept as they are sent (packed), by
+    their key, along with a sorted list of the keys for queries and scans.
+    hash_key and range_key are (attribute name, 'S' or 'N') pairs.
+    '''
+
+    def __init__(self, name, hash_key, range_key=None, read_units=10, write_units=10):
+        self.name = name
+        self.hash_key_name, self.hash_key_type = hash_key
+        self.range_key_name, self.range_key_type = range_key or (None, None)
+        self.read_units = read_units
+        self.write_units = write_units
+        self.created = time.time()
+        self.items = {}
+        self.keys = []
+        self.size = 0
+        # capacity left, and when it was last refilled, for read and write
+        self.capacity = {'read': [read_units, self.created], 'write': [write_units, self.created]}
+
+    def _key_value(self, attribute, code, name):
+        attribute_code, value = _value(attribute)
+        if attribute_code != code:
+            raise StandInError(VALIDATION, "%s must be of type %s" % (name, code))
+        return value
+
+    def key(self, hash_element, range_element=None):
+        '''The key, as stored, of packed hash and range key values'''
+        if hash_element is None:
+            raise StandInError(VALIDATION, "missing hash key")
+        hash_key = self._key_value(hash_element, self.hash_key_type, self.hash_key_name)
+        if self.range_key_name is None:
+            if range_element is not None:
+                raise StandInError(VALIDATION, "table %s has no range key" % self.name)
+            return (hash_key,)
+        if range_element is None:
+            raise StandInError(VALIDATION, "missing range key")
+        return (hash_key, self._key_value(range_element, self.range_key_type,
+                                          self.range_key_name))
+
+    def element_key(self, key):
+        '''The key of a 2011-12-05 Key ({"HashKeyElement": .., "RangeKeyElement": ..})'''
+        if not isinstance(key, dict):
+            raise StandInError(VALIDATION, "invalid key %r" % (key,))
+        return self.key(key.get('HashKeyElement'), key.get('RangeKeyElement'))
+
+    def item_key(self, item):
+        '''The key of an item, or of a 2012-08-10 key'''
+        return self.key(item.get(self.hash_key_name),
+                        item.get(self.range_key_name) if self.range_key_name else None)
+
+    def key_elements(self, item):
+        '''The 2011-12-05 Key of an item'''
+        key = {'HashKeyElement': item[self.hash_key_name]}
+        if self.range_key_name is not None:
+            key['RangeKeyElement'] = item[self.range_key_name]
+        return key
+
+    def key_attributes(self, item):
+        '''The key of an item as the 2012-08-10 API has it'''
+        key = {self.hash_key_name: item[self.hash_key_name]}
+        if self.range_key_name is not None:
+            key[self.range_key_name] = item[self.range_key_name]
+        return key
+
+    def get(self, key):
+        return self.items.get(key)
+
+    def put(self, key, item):
+        old = self.items.get(key)
+        if old is None:
+            bisect.insort(self.keys, key)
+        else:
+            self.size -= _size(old)
+        self.items[key] = item
+        self.size += _size(item)
+        return old
+
+    def delete(self, key):
+        old = self.items.pop(key, None)
+        if old is not None:
+            del self.keys[bisect.bisect_left(self.keys, key)]
+            self.size -= _size(old)
+        return old
+
+    def take_capacity(self, kind, burst_seconds):
+        '''Whether there is capacity left for a request, refilling it first'''
+        rate = self.read_units if kind == 'read' else self.write_units
+        left, updated = self.capacity[kind]
+        now = time.time()
+        self.capacity[kind] = [min(rate * burst_seconds, left + (now - updated) * rate), now]
+        return self.capacity[kind][0] > 0
+
+    def charge(self, kind, units):
+        self.capacity[kind][0] -= units
+
+    def describe(self):
+        key_schema = {'HashKeyElement': {'AttributeName': self.hash_key_name,
+                                         'AttributeType': self.hash_key_type}}
+        if self.range_key_name is not None:
+            key_schema['RangeKeyElement'] = {'AttributeName': self.range_key_name,
+                                             'AttributeType': self.range_key_type}
+        return {
+            'TableName': self.name,
+            'TableStatus': 'ACTIVE',
+            'CreationDateTime': self.created,
+            'KeySchema': key_schema,
+            'ProvisionedThroughput': {'ReadCapacityUnits': self.read_units,
+                                      'WriteCapacityUnits': self.write_units},
+            'ItemCount': len(self.items),
+            'TableSizeBytes': self.size,
+        }
+
+
+class DynamoStandIn(object):
+    '''
+    Serves the 2011-12-05 DynamoDB actions AsyncDynamoDB uses (GetItem,
+    PutItem, UpdateItem, DeleteItem, BatchGetItem, BatchWriteItem, Query,
+    Scan and DescribeTable; Scan also in its 2012-08-10 segmented form) and
+    STS GetSessionToken over plain HTTP, from memory, on the IOLoop.
+
+    Responses are delayed by `latency` seconds, a number or a function
+    returning one (e.g. lambda: random.expovariate(500)). A `throttle_rate`
+    share of requests is rejected as throttled, an `error_rate` share fails
+    with a 500 InternalServerError, and an `unprocessed_rate` share of the
+    keys and items of batch requests is returned unprocessed. With
+    `enforce_capacity`, requests beyond a table's provisioned throughput
+    (with `burst_seconds` of it saved up) are throttled too.
+
+    Session tokens expire after `token_lifetime` seconds, or when
+    expire_tokens is called; requests signed with an expired token get an
+    ExpiredTokenException. With `require_session_token`, unsigned requests
+    are rejected. fail_next queues specific errors for the next requests.
+
+    Signatures are not checked. `stats` counts requests by action and
+    response status.
+    '''
+
+    def __init__(self, latency=0, throttle_rate=0.0, error_rate=0.0, unprocessed_rate=0.0,
+                 enforce_capacity=False, burst_seconds=1.0, token_lifetime=3600,
+                 require_session_token=False, page_bytes=1024 * 1024, ioloop=None, seed=None):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.unprocessed_rate = unprocessed_rate
+        self.enforce_capacity = enforce_capacity
+        self.burst_seconds = burst_seconds
+        self.token_lifetime = token_lifetime
+        self.require_session_token = require_session_token
+        self.page_bytes = page_bytes
+        self.ioloop = ioloop or IOLoop.instance()
+        self.random = random.Random(seed)
+        self.tables = {}
+        self.tokens = {}
+        self.failures = []
+        self.stats = {}
+        self.server = None
+        self.address = None
+        self.port = None
+        self._request_ids = 0
+
+    def create_table(self, name, hash_key, range_key=None, read_units=10, write_units=10):
+        '''Add a table; hash_key and range_key are (attribute name, 'S' or 'N') pairs'''
+        table = self.tables[name] = StandInTable(name, hash_key, range_key,
+                                                 read_units=read_units, write_units=write_units)
+        return table
+
+    def load(self, table_name, items):
+        '''Store packed items in a table, without charging for them'''
+        table = self.tables[table_name]
+        for item in items:
+            table.put(table.item_key(item), item)
+
+    def expire_tokens(self):
+        '''Make every session token handed out so far expire now'''
+        for token in self.tokens:
+            self.tokens[token] = 0
+
+    def fail_next(self, error_type=THROUGHPUT_EXCEEDED, action=None, status=400, times=1):
+        '''Fail the next `times` requests (of `action`, if given) with error_type'''
+        for i in range(times):
+            self.failures.append((action, error_type, status))
+
+    def listen(self, port=0, address='127.0.0.1'):
+        '''Serve on address and port (any free port by default), which is returned'''
+        sockets = bind_sockets(port, address)
+        self.server = HTTPServer(Application([(r'/.*', StandInHandler, {'standin': self})]),
+                                 io_loop=self.ioloop)
+        self.server.add_sockets(sockets)
+        self.address = address
+        self.port = sockets[0].getsockname()[1]
+        return self.port
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+
+    def client_kwargs(self, authenticate_requests=False, **kwargs):
+        '''
+        Arguments for AsyncDynamoDB (or GenDynamo) to use this stand-in; with
+        authenticate_requests, requests are signed with session tokens from it.
+        '''
+        kwargs.update(aws_access_key_id='standin', aws_secret_access_key='standin',
+                      host=self.address, port=self.port, is_secure=False,
+                      sts_host=self.address, sts_port=self.port,
+                      authenticate_requests=authenticate_requests, ioloop=self.ioloop)
+        return kwargs
+
+    def client(self, **kwargs):
+        '''An AsyncDynamoDB using this stand-in'''
+        import asyncdynamo
+        return asyncdynamo.AsyncDynamoDB(**self.client_kwargs(**kwargs))
+
+    def delay(self):
+        latency = self.latency() if callable(self.latency) else self.latency
+        return max(0, latency or 0)
+
+    def _request_id(self):
+        self._request_ids += 1
+        return 'standin-%d' % self._request_ids
+
+    def _count(self, action, status):
+        counts = self.stats.setdefault(action, {})
+        counts[status] = counts.get(status, 0) + 1
+
+    def get_session_token(self):
+        '''(status, content type, body) of a GetSessionToken response'''
+        token = 'standin-token-%d-%08x' % (len(self.tokens), self.random.getrandbits(32))
+        expires = time.time() + self.token_lifetime
+        self.tokens[token] = expires
+        self._count('GetSessionToken', 200)
+        body = _STS_RESPONSE % {
+            'token': token,
+            'expiration': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(expires)),
+            'request_id': self._request_id()}
+        return 200, 'text/xml', body
+
+    def respond(self, target, token, body):
+        '''
+        (status, content type, body) of the response to a DynamoDB request
+        with the X-Amz-Target header target, signed with session token token.
+        '''
+        try:
+            service, action = target.split('.', 1)
+            version = service.rsplit('_', 1)[-1]
+        except (AttributeError, ValueError):
+            version, action = None, target
+        try:
+            response = self._respond(version, action, token, body)
+            status = 200
+        except StandInError, e:
+            response = {'__type': e.error_type, 'message': e.message}
+            status = e.status
+        self._count(action, status)
+        return status, 'application/x-amz-json-1.0', json.dumps(response)
+
+    def _respond(self, version, action, token, body):
+        if action not in ACTIONS or version not in ('20111205', '20120810') or \
+                (version == '20120810' and action != 'Scan'):
+            raise StandInError(UNKNOWN_OPERATION, "unknown operation %s" % action)
+        if token is not None:
+            if token not in self.tokens:
+                raise StandInError(UNRECOGNIZED_CLIENT, "The security token included in the "
+                                   "request is invalid", status=403)
+            if self.tokens[token] <= time.time():
+                raise StandInError(EXPIRED_TOKEN, "The security token included in the "
+                                   "request is expired")
+        elif self.require_session_token:
+            raise StandInError(UNRECOGNIZED_CLIENT, "Request is missing a session token",
+                               status=403)
+        for i, (failing_action, error_type, status) in enumerate(self.failures):
+            if failing_action is None or failing_action == action:
+                del self.failures[i]
+                raise StandInError(error_type, "injected failure", status=status)
+        if self.error_rate and self.random.random() < self.error_rate:
+            raise StandInError(INTERNAL_SERVER_ERROR, "injected failure", status=500)
+        if self.throttle_rate and self.random.random() < self.throttle_rate:
+            raise StandInError(THROUGHPUT_EXCEEDED, _THROUGHPUT_MESSAGE)
+        try:
+            request = json.loads(body)
+        except ValueError:
+            raise StandInError('com.amazon.coral.service#SerializationException',
+                               "body is not json")
+        if not isinstance(request, dict):
+            raise StandInError(VALIDATION, "body is not a json object")
+        try:
+            return getattr(self, ACTIONS[action])(request, version=version)
+        except (KeyError, TypeError, AttributeError), e:
+            raise StandInError(VALIDATION, "invalid %s request: %r" % (action, e))
+
+    def _table(self, name):
+        table = self.tables.get(name)
+        if table is None:
+            raise StandInError(RESOURCE_NOT_FOUND, "Requested resource not found: "
+                               "Table: %s not found" % name)
+        return table
+
+    def _admit(self, table, kind):
+        if self.enforce_capacity and not table.take_capacity(kind, self.burst_seconds):
+            raise StandInError(THROUGHPUT_EXCEEDED, _THROUGHPUT_MESSAGE)
+
+    def _charge(self, table, kind, units):
+        if self.enforce_capacity:
+            table.charge(kind, units)
+        return units
+
+    def _check_expected(self, table, item, expected):
+        for name, condition in (expected or {}).items():
+            if 'Value' in condition:
+                if item is None or name not in item or \
+                        _value(item[name]) != _value(condition['Value']):
+                    raise StandInError(CONDITIONAL_CHECK_FAILED, "The conditional request failed")
+            elif condition.get('Exists', True) is False:
+                if item is not None and name in item:
+                    raise StandInError(CONDITIONAL_CHECK_FAILED, "The conditional request failed")
+            else:
+                raise StandInError(VALIDATION, "Expected %s needs a Value or Exists false" % name)
+
+    def describe_table(self, request, version=None):
+        return {'Table': self._table(request['TableName']).describe()}
+
+    def get_item(self, request, version=None):
+        table = self._table(request['TableName'])
+        self._admit(table, 'read')
+        item = table.get(table.element_key(request['Key']))
+        consistent = bool(request.get('ConsistentRead'))
+        response = {'ConsumedCapacityUnits': self._charge(
+            table, 'read', _units(_size(item) if item else 0, consistent))}
+        if item is not None:
+            response['Item'] = _project(item, request.get('AttributesToGet'))
+        return response
+
+    def put_item(self, request, version=None):
+        table = self._table(request['TableName'])
+        self._admit(table, 'write')
+        item = request['Item']
+        for attribute in item.values():
+            _value(attribute)
+        key = table.item_key(item)
+        old = table.get(key)
+        self._check_expected(table, old, request.get('Expected'))
+        table.put(key, item)
+        response = {'ConsumedCapacityUnits': self._charge(
+            table, 'write', _units(max(_size(item), _size(old) if old else 0)))}
+        if request.get('ReturnValues') == 'ALL_OLD' and old is not None:
+            response['Attributes'] = old
+        return response
+
+    def delete_item(self, request, version=None):
+        table = self._table(request['TableName'])
+        self._admit(table, 'write')
+        key = table.element_key(request['Key'])
+        old = table.get(key)
+        self._check_expected(table, old, request.get('Expected'))
+        table.delete(key)
+        response = {'ConsumedCapacityUnits': self._charge(
+            table, 'write', _units(_size(old) if old else 0))}
+        if request.get('ReturnValues') == 'ALL_OLD' and old is not None:
+            response['Attributes'] = old
+        return response
+
+    def update_item(self, request, version=None):
+        table = self._table(request['TableName'])
+        self._admit(table, 'write')
+        key_element = request['Key']
+        key = table.element_key(key_element)
+        old = table.get(key)
+        self._check_expected(table, old, request.get('Expected'))
+        if old is not None:
+            item = dict(old)
+        else:
+            item = {table.hash_key_name: key_element['HashKeyElement']}
+            if table.range_key_name is not None:
+                item[table.range_key_name] = key_element['RangeKeyElement']
+        updated = set()
+        for name, update in request.get('AttributeUpdates', {}).items():
+            if name in (table.hash_key_name, table.range_key_name):
+                raise StandInError(VALIDATION, "Cannot update attribute %s. This attribute is "
+                                   "part of the key" % name)
+            action = update.get('Action', 'PUT')
+            value = update.get('Value')
+            updated.add(name)
+            if action == 'PUT':
+                _value(value)
+                item[name] = value
+            elif action == 'DELETE':
+                if value is None:
+                    item.pop(name, None)
+                    continue
+                code, remove = _value(value)
+                if name in item:
+                    current_code, current = _value(item[name])
+                    if code != current_code or code not in ('SS', 'NS'):
+                        raise StandInError(VALIDATION, "Type mismatch for attribute to update")
+                    left = [raw for raw in item[name][code] if _element(code, raw) not in remove]
+                    if left:
+                        item[name] = {code: left}
+                    else:
+                        del item[name]
+            elif action == 'ADD':
+                code, add = _value(value)
+                if name not in item:
+                    item[name] = value
+                    continue
+                current_code, current = _value(item[name])
+                if code != current_code or code == 'S':
+                    raise StandInError(VALIDATION, "Type mismatch for attribute to update")
+                if code == 'N':
+                    item[name] = {'N': str(current + add)}
+                else:
+                    item[name] = {code: item[name][code] + [
+                        raw for raw in value[code] if _element(code, raw) not in current]}
+            else:
+                raise StandInError(VALIDATION, "unknown update action %r" % action)
+        table.put(key, item)
+        response = {'ConsumedCapacityUnits': self._charge(
+            table, 'write', _units(max(_size(item), _size(old) if old else 0)))}
+        return_values = request.get('ReturnValues', 'NONE')
+        if return_values == 'ALL_NEW':
+            response['Attributes'] = item
+        elif return_values == 'ALL_OLD' and old is not None:
+            response['Attributes'] = old
+        elif return_values == 'UPDATED_NEW':
+            response['Attributes'] = dict((name, item[name]) for name in updated if name in item)
+        elif return_values == 'UPDATED_OLD' and old is not None:
+            response['Attributes'] = dict((name, old[name]) for name in updated if name in old)
+        return response
+
+    def batch_get_item(self, request, version=None):
+        request_items = request['RequestItems']
+        if sum(len(keys['Keys']) for keys in request_items.values()) > 100:
+            raise StandInError(VALIDATION, "Too many items requested for the BatchGetItem call")
+        responses = {}
+        unprocessed = {}
+        size = 0
+        for name, keys in request_items.items():
+            table = self._table(name)
+            self._admit(table, 'read')
+            items = []
+            table_size = 0
+            for key_element in keys['Keys']:
+                if size >= self.page_bytes or \
+                        (self.unprocessed_rate and self.random.random() < self.unprocessed_rate):
+                    unprocessed.setdefault(name, dict(keys, Keys=[]))['Keys'].append(key_element)
+                    continue
+                item = table.get(table.element_key(key_element))
+                if item is not None:
+                    items.append(_project(item, keys.get('AttributesToGet')))
+                    table_size += _size(item)
+                    size += _size(item)
+            responses[name] = {'Items': items, 'ConsumedCapacityUnits': self._charge(
+                table, 'read', _units(table_size, consistent=False))}
+        return {'Responses': responses, 'UnprocessedKeys': unprocessed}
+
+    def batch_write_item(self, request, version=None):
+        request_items = request['RequestItems']
+        if sum(len(writes) for writes in request_items.values()) > 25:
+            raise StandInError(VALIDATION, "Too many items requested for the BatchWriteItem call")
+        responses = {}
+        unprocessed = {}
+        for name, writes in request_items.items():
+            table = self._table(name)
+            self._admit(table, 'write')
+            units = 0
+            for write in writes:
+                if self.unprocessed_rate and self.random.random() < self.unprocessed_rate:
+                    unprocessed.setdefault(name, []).append(write)
+                    continue
+                if 'PutRequest' in write:
+                    item = write['PutRequest']['Item']
+                    for attribute in item.values():
+                        _value(attribute)
+                    old = table.put(table.item_key(item), item)
+                    units += _units(max(_size(item), _size(old) if old else 0))
+                else:
+                    old = table.delete(table.element_key(write['DeleteRequest']['Key']))
+                    units += _units(_size(old) if old else 0)
+            responses[name] = {'ConsumedCapacityUnits': self._charge(table, 'write', units)}
+        return {'Responses': responses, 'UnprocessedItems': unprocessed}
+
+    def _page(self, table, keys, request, accept, consistent, version):
+        '''
+        Read items at keys (an iterable of keys, in order) until Limit items
+        were evaluated or page_bytes were read, returning the items accept
+        lets through as a Query or Scan response.
+        '''
+        limit = request.get('Limit')
+        attributes_to_get = request.get('AttributesToGet')
+        count_only = request.get('Count')
+        items = []
+        scanned = 0
+        size = 0
+        last = None
+        for key in keys:
+            if (limit and scanned >= limit) or size >= self.page_bytes:
+                break
+            item = table.items[key]
+            scanned += 1
+            size += _size(item)
+            last = item
+            if accept(item):
+                items.append(item)
+        else:
+            last = None
+        response = {'Count': len(items),
+                    'ScannedCount': scanned}
+        if not count_only:
+            response['Items'] = [_project(item, attributes_to_get) for item in items]
+        units = self._charge(table, 'read', _units(size, consistent))
+        if version == '20120810':
+            if last is not None:
+                response['LastEvaluatedKey'] = table.key_attributes(last)
+            if request.get('ReturnConsumedCapacity') in ('TOTAL', 'INDEXES'):
+                response['ConsumedCapacity'] = {'TableName': table.name, 'CapacityUnits': units}
+        else:
+            if last is not None:
+                response['LastEvaluatedKey'] = table.key_elements(last)
+            response['ConsumedCapacityUnits'] = units
+        return response
+
+    def query(self, request, version=None):
+        table = self._table(request['TableName'])
+        self._admit(table, 'read')
+        hash_key = table._key_value(request['HashKeyValue'], table.hash_key_type,
+                                    table.hash_key_name)
+        keys = table.keys
+        first = bisect.bisect_left(keys, (hash_key,))
+        end = bisect.bisect_left(keys, (hash_key, _LAST))
+        forward = request.get('ScanIndexForward', True)
+        start_key = request.get('ExclusiveStartKey')
+        if start_key:
+            start = table.element_key(start_key)
+            if forward:
+                first = max(first, bisect.bisect_right(keys, start))
+            else:
+                end = min(end, bisect.bisect_left(keys, start))
+        condition = request.get('RangeKeyCondition')
+        if condition and table.range_key_name is None:
+            raise StandInError(VALIDATION, "table %s has no range key" % table.name)
+        positions = xrange(first, end) if forward else xrange(end - 1, first - 1, -1)
+        # only items in the range key condition count towards Limit
+        matching = (keys[i] for i in positions if not condition or _matches(
+            table.items[keys[i]][table.range_key_name], condition['ComparisonOperator'],
+            condition.get('AttributeValueList', [])))
+        return self._page(table, matching, request, lambda item: True,
+                          bool(request.get('ConsistentRead')), version)
+
+    def scan(self, request, version=None):
+        table = self._table(request['TableName'])
+        self._admit(table, 'read')
+        keys = table.keys
+        first = 0
+        start_key = request.get('ExclusiveStartKey')
+        if start_key:
+            if version == '20120810':
+                start = table.item_key(start_key)
+            else:
+                start = table.element_key(start_key)
+            first = bisect.bisect_right(keys, start)
+        positions = xrange(first, len(keys))
+        if 'Segment' in request or 'TotalSegments' in request:
+            segment, total_segments = int(request['Segment']), int(request['TotalSegments'])
+            if not 0 <= segment < total_segments:
+                raise StandInError(VALIDATION, "Segment must be less than TotalSegments")
+            positions = (i for i in positions if
+                         zlib.crc32(str(keys[i][0])) % total_segments == segment)
+        scan_filter = request.get('ScanFilter') or {}
+        def accept(item):
+            for name, condition in scan_filter.items():
+                if not _matches(item.get(name), condition['ComparisonOperator'],
+                                condition.get('AttributeValueList', [])):
+                    return False
+            return True
+        return self._page(table, (keys[i] for i in positions), request, accept, False, version)
+
+
+class StandInHandler(RequestHandler):
+    '''Hands requests to a DynamoStandIn, and writes its responses after its latency'''
+
+    def initialize(self, standin):
+        self.standin = standin
+
+    @asynchronous
+    def post(self):
+        target = self.request.headers.get('X-Amz-Target')
+        if target is None and self.get_argument('Action', None) == 'GetSessionToken':
+            response = self.standin.get_session_token()
+        elif target is None:
+            response = (400, 'text/xml', '<ErrorResponse><Error><Code>InvalidAction</Code>'
+                        '</Error></ErrorResponse>')
+        else:
+            response = self.standin.respond(target,
+                self.request.headers.get('X-Amz-Security-Token'), self.request.body)
+        delay = self.standin.delay()
+        if delay:
+            self.standin.ioloop.add_timeout(time.time() + delay,
+                                            functools.partial(self._respond, *response))
+        else:
+            self._respond(*response)
+
+    get = post
+
+    def _respond(self, status, content_type, body):
+        self.set_status(status)
+        self.set_header('Content-Type', content_type)
+        self.set_header('x-amzn-RequestId', self.standin._request_id())
+        self.finish(body)
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--port", type=int, default=8000)
+    parser.add_option("--address", default='127.0.0.1')
+    parser.add_option("--table", action="append", default=[],
+                      help="name:hash_key:S|N[:range_key:S|N], may be repeated")
+    parser.add_option("--read-units", type=int, default=1000)
+    parser.add_option("--write-units", type=int, default=1000)
+    parser.add_option("--latency", type=float, default=0.0,
+                      help="mean latency in seconds (exponentially distributed)")
+    parser.add_option("--throttle-rate", type=float, default=0.0)
+    parser.add_option("--error-rate", type=float, default=0.0)
+    parser.add_option("--unprocessed-rate", type=float, default=0.0)
+    parser.add_option("--enforce-capacity", action="store_true", default=False)
+    parser.add_option("--token-lifetime", type=int, default=3600)
+    options, args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    latency = options.latency
+    if latency:
+        rng = random.Random()
+        latency = lambda: rng.expovariate(1.0 / options.latency)
+    standin = DynamoStandIn(latency=latency, throttle_rate=options.throttle_rate,
+                            error_rate=options.error_rate,
+                            unprocessed_rate=options.unprocessed_rate,
+                            enforce_capacity=options.enforce_capacity,
+                            token_lifetime=options.token_lifetime)
+    for spec in options.table:
+        parts = spec.split(':')
+        if len(parts) not in (3, 5):
+            parser.error("invalid --table %r" % spec)
+        standin.create_table(parts[0], (parts[1], parts[2]),
+                             (parts[3], parts[4]) if len(parts) == 5 else None,
+                             read_units=options.read_units, write_units=options.write_units)
+    port = standin.listen(options.port, options.address)
+    logging.info("DynamoDB stand-in listening on http://%s:%d/" % (options.address, port))
+    standin.ioloop.start()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/bin/env python
+#
+# Copyright 2013 bit.ly
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Pooled HTTP transport shared by AsyncDynamoDB and AsyncAwsSts.
+"""
+
+import functools
+import logging
+import socket
+import time
+
+from tornado.concurrent import return_future
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.netutil import Resolver
+
+try:
+    import pycurl
+except ImportError:
+    pycurl = None
+
+
+class CachingResolver(Resolver):
+    '''
+    Resolver that remembers addresses for `ttl` seconds, so that requests to
+    the same endpoint do not each pay for a DNS lookup.
+    '''
+
+    def initialize(self, resolver=None, ttl=60, io_loop=None):
+        self.resolver = resolver or Resolver(io_loop=io_loop)
+        self.ttl = ttl
+        self.cache = {}
+
+    def close(self):
+        self.resolver.close()
+
+    @return_future
+    def resolve(self, host, port, family=socket.AF_UNSPEC, callback=None):
+        key = (host, port, family)
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] > time.time():
+            return callback(cached[1])
+        self.resolver.resolve(host, port, family,
+                              callback=functools.partial(self._on_resolve, key, callback))
+
+    def _on_resolve(self, key, callback, addrinfo):
+        self.cache[key] = (time.time() + self.ttl, addrinfo)
+        callback(addrinfo)
+
+
+class HTTPTransport(object):
+    '''
+    A pool of persistent HTTP connections.
+
+    When pycurl is installed, requests go through tornado's curl client: each
+    of its `max_clients` curl handles keeps its connection open between
+    requests, so most requests skip the TCP and TLS handshakes. Connections
+    idle for more than `idle_timeout` seconds are not reused (this needs
+    libcurl 7.65 or later). DNS answers are cached for `dns_cache_ttl` seconds.
+
+    Without pycurl, or with use_curl=False, tornado's simple client is used
+    with the same pool size and DNS cache, but it opens a new connection for
+    every request, and a warning is logged when keep_alive was asked for.
+
+    Pass one instance to AsyncDynamoDB as `transport`, and it is shared with
+    the AsyncAwsSts instance that fetches session tokens.
+    '''
+
+    def __init__(self, ioloop=None, max_clients=10, keep_alive=True, idle_timeout=60,
+                 dns_cache_ttl=60, use_curl=None):
+        self.ioloop = ioloop or IOLoop.instance()
+        self.max_clients = max_clients
+        self.keep_alive = keep_alive
+        self.idle_timeout = idle_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        if use_curl is None:
+            use_curl = pycurl is not None
+        self.use_curl = use_curl
+        if use_curl:
+            from tornado.curl_httpclient import CurlAsyncHTTPClient
+            self.http_client = CurlAsyncHTTPClient(io_loop=self.ioloop, force_instance=True,
+                                                   max_clients=max_clients)
+        else:
+            if keep_alive:
+                if pycurl is None:
+                    logging.warning("pycurl is not installed, HTTP connections will not be kept alive")
+                else:
+                    logging.warning("use_curl is False, HTTP connections will not be kept alive")
+            self.resolver = CachingResolver(ttl=dns_cache_ttl, io_loop=self.ioloop)
+            self.http_client = AsyncHTTPClient(io_loop=self.ioloop, force_instance=True,
+                                               max_clients=max_clients, resolver=self.resolver)
+
+    def fetch(self, request, callback):
+        if self.use_curl:
+            request.prepare_curl_callback = self._prepare_curl
+        return self.http_client.fetch(request, callback)
+
+    def _prepare_curl(self, curl):
+        curl.setopt(pycurl.DNS_CACHE_TIMEOUT, self.dns_cache_ttl)
+        if not self.keep_alive:
+            curl.setopt(pycurl.FORBID_REUSE, 1)
+            return
+        if hasattr(pycurl, 'TCP_KEEPALIVE'):
+            curl.setopt(pycurl.TCP_KEEPALIVE, 1)
+        if self.idle_timeout is not None and hasattr(pycurl, 'MAXAGE_CONN'):
+            curl.setopt(pycurl.MAXAGE_CONN, int(self.idle_timeout))
+
+    def prewarm(self, url, connections, callback=None):
+        '''
+        Open up to `connections` connections to `url` ahead of the first real
+        requests, by sending that many requests at once. callback, if given, is
+        called once they have all finished.
+        '''
+        connections = min(connections, self.max_clients)
+        remaining = [connections]
+        def on_response(response):
+            if response.error and response.code == 599:
+                logging.warning("Unable to pre-warm connection to %s: %s" % (url, response.error))
+            remaining[0] -= 1
+            if not remaining[0] and callable(callback):
+                callback()
+        for i in range(connections):
+            self.fetch(HTTPRequest(url), on_response)
+
+    def close(self):
+        self.http_client.close()
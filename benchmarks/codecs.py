@@ -0,0 +1,84 @@
+#!/bin/env python
+"""
+Compares the json codecs of asyncdynamo.codec on typical DynamoDB payloads.
+
+    python benchmarks/codecs.py [--number N]
+
+Codecs whose module is not installed are skipped.
+"""
+
+import optparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from asyncdynamo.codec import available_codecs
+
+
+def make_item(i):
+    return {
+        'user': {'S': 'user%08d' % i},
+        'ts': {'N': str(1360000000 + i)},
+        'url': {'S': 'http://example.com/%s' % ('x' * random.randint(20, 80))},
+        'clicks': {'N': str(random.randint(0, 100000))},
+        'tags': {'SS': ['tag%d' % random.randint(0, 50) for j in range(5)]},
+    }
+
+
+def payloads():
+    '''(name, document) of requests and responses of increasing size'''
+    get_response = {'Item': make_item(0), 'ConsumedCapacityUnits': 0.5}
+    put_request = {'TableName': 'links', 'Item': make_item(1),
+                   'Expected': {'ts': {'Exists': False}}}
+    query_response = {'Count': 1000, 'Items': [make_item(i) for i in range(1000)],
+                      'LastEvaluatedKey': {'HashKeyElement': {'S': 'user00000999'},
+                                           'RangeKeyElement': {'N': '1360000999'}},
+                      'ConsumedCapacityUnits': 128.5}
+    batch_response = {'Responses': {'links': {'Items': [make_item(i) for i in range(100)],
+                                              'ConsumedCapacityUnits': 50}},
+                      'UnprocessedKeys': {}}
+    return [('GetItem response', get_response),
+            ('PutItem request', put_request),
+            ('BatchGetItem response', batch_response),
+            ('Query response', query_response)]
+
+
+def object_hook(obj):
+    return obj
+
+
+def bench(number):
+    random.seed(0)
+    codecs = available_codecs()
+    print '%-24s %-12s %12s %12s %16s' % ('payload', 'codec', 'encode us', 'decode us',
+                                          'hook decode us')
+    for name, doc in payloads():
+        encoded = codecs['simplejson'].encode(doc)
+        for codec_name, codec in sorted(codecs.items()):
+            encode = timeit.timeit(lambda: codec.encode(doc), number=number)
+            decode = timeit.timeit(lambda: codec.decode(encoded), number=number)
+            hook = timeit.timeit(lambda: codec.decode(encoded, object_hook=object_hook),
+                                 number=number)
+            print '%-24s %-12s %12.1f %12.1f %16.1f' % (
+                '%s (%dB)' % (name, len(encoded)), codec_name,
+                encode * 1e6 / number, decode * 1e6 / number, hook * 1e6 / number)
+    fields = (('TableName', 'links'), ('Key', {'HashKeyElement': {'S': 'user00000001'}}),
+              ('AttributesToGet', None), ('ConsistentRead', True))
+    codec = codecs['simplejson']
+    as_dict = timeit.timeit(lambda: codec.encode(dict((k, v) for k, v in fields if v is not None)),
+                            number=number)
+    direct = timeit.timeit(lambda: codec.encode_fields(*fields), number=number)
+    print
+    print 'GetItem request, simplejson: dict + encode %.1f us, encode_fields %.1f us' % (
+        as_dict * 1e6 / number, direct * 1e6 / number)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('--number', type='int', default=200,
+                      help='iterations per measurement')
+    options, args = parser.parse_args()
+    bench(options.number)
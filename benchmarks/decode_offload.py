@@ -0,0 +1,105 @@
+#!/bin/env python
+"""
+Measures how long the IOLoop is blocked while large Query responses are
+decoded on it, and when they are decoded in a thread or process pool.
+
+    python benchmarks/decode_offload.py [--responses N] [--items N]
+
+A callback scheduled every millisecond records how late it runs; the
+report shows the worst and 99th percentile delays and AsyncDynamoDB's
+decode_stats: the time spent decoding, or loading offloaded results, on
+the IOLoop, and the time spent in the executor. The "+unpack" runs also
+unpack the items as GenDynamoTable(unpack_in_executor=True) does. Needs
+the futures package on python 2.
+"""
+
+import functools
+from io import BytesIO
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from tornado.httpclient import HTTPRequest, HTTPResponse
+from tornado.ioloop import IOLoop
+
+from asyncdynamo.asyncdynamo import AsyncDynamoDB
+from asyncdynamo.codec import JSONCodec
+from asyncdynamo.gendynamo import GenDynamoTable
+
+
+def make_body(items):
+    return JSONCodec().encode({
+        'Count': items,
+        'Items': [{'user': {'S': 'user%08d' % i}, 'ts': {'N': str(1360000000 + i)},
+                   'url': {'S': 'http://example.com/%s' % ('x' * 100)},
+                   'tags': {'SS': ['a', 'b', 'c']}} for i in range(items)],
+        'ConsumedCapacityUnits': 128.0})
+
+
+def run(executor, body, responses, postprocess=None):
+    ioloop = IOLoop()
+    db = AsyncDynamoDB('key', 'secret', authenticate_requests=False, ioloop=ioloop,
+                       decode_executor=executor, decode_threshold=64 * 1024)
+    request = HTTPRequest(db.url)
+    lags = []
+    remaining = [responses]
+
+    def tick(expected):
+        now = time.time()
+        lags.append(now - expected)
+        if remaining[0]:
+            ioloop.add_timeout(now + 0.001, functools.partial(tick, now + 0.001))
+        else:
+            ioloop.stop()
+
+    def on_response(response, error=None):
+        remaining[0] -= 1
+
+    def deliver(sent):
+        # one response every 10ms, as if they came off the network
+        response = HTTPResponse(request, 200, buffer=BytesIO(body))
+        db._finish_make_request(response, on_response, orig_request=None, token_used=None,
+                                action='Query', table_name='t', postprocess=postprocess)
+        if sent + 1 < responses:
+            ioloop.add_timeout(time.time() + 0.01, functools.partial(deliver, sent + 1))
+
+    ioloop.add_callback(functools.partial(deliver, 0))
+    ioloop.add_callback(functools.partial(tick, time.time()))
+    ioloop.start()
+    lags.sort()
+    return lags[-1], lags[int(len(lags) * 0.99)], db.decode_stats
+
+
+def main(responses, items):
+    body = make_body(items)
+    print 'decoding %d responses of %d bytes' % (responses, len(body))
+    print '%-16s %12s %12s %16s %16s' % ('decoding', 'max lag ms', 'p99 lag ms',
+                                         'on loop ms', 'in executor ms')
+    table = GenDynamoTable((str, 'user'), (int, 'ts'), unpack_in_executor=True)
+    for name, executor, postprocess in [
+            ('inline', None, None),
+            ('threads', ThreadPoolExecutor(2), None),
+            ('processes', ProcessPoolExecutor(2), None),
+            ('inline+unpack', None, table._postprocess()),
+            ('threads+unpack', ThreadPoolExecutor(2), table._postprocess()),
+            ('processes+unpack', ProcessPoolExecutor(2), table._postprocess())]:
+        worst, p99, stats = run(executor, body, responses, postprocess)
+        print '%-16s %12.2f %12.2f %16.1f %16.1f' % (
+            name, worst * 1000, p99 * 1000,
+            (stats['inline']['seconds'] + stats['offloaded']['loop_seconds']) * 1000,
+            stats['offloaded']['seconds'] * 1000)
+        if executor is not None:
+            executor.shutdown()
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('--responses', type='int', default=20)
+    parser.add_option('--items', type='int', default=5000,
+                      help='items per response')
+    options, args = parser.parse_args()
+    main(options.responses, options.items)
@@ -0,0 +1,363 @@
+#!/bin/env python
+"""
+Benchmark suite: microbenchmarks of request signing, json encoding and
+decoding, the make_request pipeline and GenDynamoTable packing and
+unpacking, and end-to-end runs against asyncdynamo.standin at several
+concurrency levels.
+
+    python benchmarks/run.py [--output results.json] [--baseline old.json]
+
+Results are written as json. With --baseline, each result is compared to
+the one in an earlier results file, and results worse by more than
+--threshold are reported as regressions (the exit status is 1 if there are
+any). --only runs the benchmarks whose name starts with one of its
+comma separated prefixes.
+
+Microbenchmarks report the best of --repeat runs, to keep the noise of
+other processes out. End-to-end runs use a stand-in server in a child
+process, so that client and server do not share an IOLoop.
+"""
+
+from io import BytesIO
+import functools
+import json
+import multiprocessing
+import optparse
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tornado.httpclient import HTTPRequest, HTTPResponse
+from tornado.ioloop import IOLoop
+
+from asyncdynamo.asyncdynamo import AsyncDynamoDB
+from asyncdynamo.codec import available_codecs
+from asyncdynamo.gendynamo import GenDynamoTable
+from asyncdynamo.standin import DynamoStandIn
+from asyncdynamo.transport import HTTPTransport
+
+LOWER, HIGHER = 'lower', 'higher'
+
+
+def small_item(i):
+    return {'user': 'user%08d' % i, 'ts': 1360000000 + i, 'clicks': i % 1000}
+
+
+def wide_item(i):
+    item = {'user': 'user%08d' % i, 'ts': 1360000000 + i}
+    for j in range(25):
+        item['n%02d' % j] = i * j
+        item['s%02d' % j] = 'value %d %d' % (i, j)
+    return item
+
+
+def set_item(i):
+    return {'user': 'user%08d' % i, 'ts': 1360000000 + i,
+            'tags': set('tag%d' % j for j in range(50)),
+            'ids': set(range(i, i + 50)),
+            'domains': set('d%d.example.com' % j for j in range(20))}
+
+def mismatched_item(i):
+    # values whose type is not the one the schema declares, packed by _pack_val
+    return {'user': 'user%08d' % i, 'ts': 1360000000 + i, 'clicks': 'many',
+            'name': i, 'tags': 'tag', 'ids': set('abc')}
+
+ITEMS = [
+    ('small', small_item, {'clicks': int}),
+    ('wide', wide_item, dict([('n%02d' % j, int) for j in range(25)] +
+                             [('s%02d' % j, str) for j in range(25)])),
+    ('sets', set_item, {'tags': 'SS', 'ids': 'NS', 'domains': 'SS'}),
+    ('mismatched', mismatched_item, {'clicks': int, 'name': str, 'tags': 'NS', 'ids': 'NS'}),
+]
+
+
+class Suite(object):
+    '''Runs benchmarks and collects their results'''
+
+    def __init__(self, only=None, repeat=5, number=None):
+        self.only = only
+        self.repeat = repeat
+        self.number = number
+        self.results = {}
+
+    def wanted(self, name):
+        return not self.only or any(name.startswith(prefix) for prefix in self.only)
+
+    def add(self, name, value, unit, better=LOWER, **extra):
+        result = dict(extra, value=value, unit=unit, better=better)
+        self.results[name] = result
+        print '%-48s %14.2f %s' % (name, value, unit)
+
+    def micro(self, name, function, number, per=1):
+        '''Time function, reporting microseconds per call (divided by per)'''
+        if not self.wanted(name):
+            return
+        number = self.number or number
+        best = min(timeit.repeat(function, number=number, repeat=self.repeat))
+        self.add(name, best * 1e6 / number / per, 'us')
+
+
+def bench_signing(suite):
+    db = AsyncDynamoDB('AKIDEXAMPLE', 'secret', session_token='session token',
+                       ioloop=IOLoop())
+    body = json.dumps({'TableName': 'links', 'Key': {'HashKeyElement': {'S': 'user00000001'}}})
+    request = HTTPRequest(db.url, method='POST', body=body, headers={
+        'X-Amz-Target': 'DynamoDB_20111205.GetItem',
+        'Content-Type': 'application/x-amz-json-1.0',
+        'Content-Length': str(len(body))})
+    request.auth_path = '/'
+    suite.micro('sign GetItem', lambda: db._auth_handler.add_auth(request), 2000)
+
+
+def bench_codecs(suite):
+    random.seed(0)
+    table = GenDynamoTable((str, 'user'), (int, 'ts'))
+    get_response = {'Item': table._pack(small_item(0)), 'ConsumedCapacityUnits': 0.5}
+    query_response = {'Count': 100, 'Items': [table._pack(wide_item(i)) for i in range(100)],
+                      'ConsumedCapacityUnits': 25.0}
+    for codec_name, codec in sorted(available_codecs().items()):
+        for payload_name, payload, number in (('GetItem response', get_response, 2000),
+                                              ('Query response', query_response, 20)):
+            encoded = codec.encode(payload)
+            suite.micro('json %s encode %s' % (codec_name, payload_name),
+                        functools.partial(codec.encode, payload), number)
+            suite.micro('json %s decode %s' % (codec_name, payload_name),
+                        functools.partial(codec.decode, encoded), number)
+    codec = available_codecs()['simplejson']
+    fields = (('TableName', 'links'), ('Key', {'HashKeyElement': {'S': 'user00000001'}}),
+              ('AttributesToGet', None), ('ConsistentRead', True))
+    suite.micro('json simplejson encode_fields GetItem request',
+                functools.partial(codec.encode_fields, *fields), 5000)
+
+
+def bench_pack(suite):
+    random.seed(0)
+    plain = GenDynamoTable((str, 'user'), (int, 'ts'))
+    for name, make_item, schema in ITEMS:
+        items = [make_item(i) for i in range(100)]
+        checked = GenDynamoTable((str, 'user'), (int, 'ts'), schema=schema)
+        for item in items:
+            # a schema must not change what is stored, only how fast
+            assert checked._pack(item) == plain._pack(item), (name, item)
+        for variant, table in (('', GenDynamoTable((str, 'user'), (int, 'ts'))),
+                               (' schema', GenDynamoTable((str, 'user'), (int, 'ts'),
+                                                          schema=schema))):
+            packed = map(table._pack, items)
+            suite.micro('pack %s item%s' % (name, variant),
+                        functools.partial(map, table._pack, items), 20, per=len(items))
+            suite.micro('unpack %s item%s' % (name, variant),
+                        functools.partial(table._unpack_items, packed), 20, per=len(items))
+        # every attribute of the wide item is in its schema, but a pack that
+        # looks each one up in the schema can still lose to the plain one
+        for action in ('pack', 'unpack'):
+            plain_result = suite.results.get('%s %s item' % (action, name))
+            schema_result = suite.results.get('%s %s item schema' % (action, name))
+            if name != 'mismatched' and plain_result and schema_result and \
+                    schema_result['value'] > plain_result['value']:
+                print 'NOTE: %s %s item is slower with its schema than without' % (action, name)
+
+
+class _InstantTransport(object):
+    '''Answers every request at once with the same body, to time the client alone'''
+
+    def __init__(self, body):
+        self.body = body
+
+    def fetch(self, request, callback):
+        callback(HTTPResponse(request, 200, buffer=BytesIO(self.body)))
+
+
+def bench_pipeline(suite):
+    table = GenDynamoTable((str, 'user'), (int, 'ts'))
+    for name, response, number in (
+            ('GetItem', {'Item': table._pack(small_item(0)), 'ConsumedCapacityUnits': 0.5}, 2000),
+            ('Query 100 items', {'Count': 100, 'ConsumedCapacityUnits': 25.0,
+                                 'Items': [table._pack(wide_item(i)) for i in range(100)]}, 50)):
+        for signed in (False, True):
+            db = AsyncDynamoDB('AKIDEXAMPLE', 'secret', session_token='session token',
+                               authenticate_requests=signed, ioloop=IOLoop(),
+                               transport=_InstantTransport(json.dumps(response)))
+            if name == 'GetItem':
+                request = functools.partial(db.get_item, 'links',
+                                            {'HashKeyElement': {'S': 'user00000001'}}, _ignore)
+            else:
+                request = functools.partial(db.query, 'links', {'S': 'user00000001'}, _ignore)
+            suite.micro('make_request %s%s' % (name, ' signed' if signed else ''),
+                        request, number)
+
+
+def _ignore(response, error=None):
+    if error:
+        raise error
+
+
+def _serve(table_items, latency, ready):
+    '''Run a stand-in in this (child) process, telling its port through ready'''
+    ioloop = IOLoop()
+    standin = DynamoStandIn(latency=latency, ioloop=ioloop, seed=0)
+    standin.create_table('links', ('user', 'S'), ('ts', 'N'), read_units=100000,
+                         write_units=100000)
+    standin.load('links', table_items)
+    ready.put(standin.listen())
+    ioloop.start()
+
+
+def bench_end_to_end(suite, concurrencies, seconds, latency):
+    names = []
+    for concurrency in concurrencies:
+        names += ['e2e %s c=%d' % (action, concurrency) for action in ('GetItem', 'Query')]
+    if not any(suite.wanted(name) for name in names):
+        return
+    table = GenDynamoTable((str, 'user'), (int, 'ts'))
+    random.seed(0)
+    items = [table._pack(dict(small_item(i), user='user%08d' % (i % 100))) for i in range(2000)]
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(target=_serve, args=(items, latency, ready))
+    server.daemon = True
+    server.start()
+    try:
+        port = ready.get(timeout=10)
+        for concurrency in concurrencies:
+            for action in ('GetItem', 'Query'):
+                name = 'e2e %s c=%d' % (action, concurrency)
+                if suite.wanted(name):
+                    _end_to_end(suite, name, port, action, concurrency, seconds)
+    finally:
+        server.terminate()
+        server.join()
+
+
+def _end_to_end(suite, name, port, action, concurrency, seconds):
+    '''Keep concurrency requests in flight for seconds, then report throughput and latency'''
+    ioloop = IOLoop()
+    transport = HTTPTransport(ioloop=ioloop, max_clients=concurrency)
+    db = AsyncDynamoDB('standin', 'standin', host='127.0.0.1', port=port, is_secure=False,
+                       authenticate_requests=False, ioloop=ioloop, transport=transport)
+    rng = random.Random(concurrency)
+    latencies = []
+    errors = [0]
+    state = {'deadline': None, 'running': concurrency}
+
+    def send():
+        if time.time() >= state['deadline']:
+            state['running'] -= 1
+            if not state['running']:
+                ioloop.stop()
+            return
+        user = {'S': 'user%08d' % rng.randrange(100)}
+        callback = functools.partial(done, time.time())
+        if action == 'GetItem':
+            db.get_item('links', {'HashKeyElement': user,
+                                  'RangeKeyElement': {'N': str(1360000000 + rng.randrange(2000))}},
+                        callback)
+        else:
+            db.query('links', user, callback, limit=20)
+
+    def done(started, response, error=None):
+        latencies.append(time.time() - started)
+        if error:
+            errors[0] += 1
+        send()
+
+    def start():
+        state['deadline'] = time.time() + seconds
+        for i in range(concurrency):
+            send()
+    ioloop.add_callback(start)
+    started = time.time()
+    ioloop.start()
+    elapsed = time.time() - started
+    transport.close()
+    ioloop.close(all_fds=True)
+    latencies.sort()
+    def percentile(percent):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100.0))] * 1000
+    suite.add(name + ' throughput', len(latencies) / elapsed, 'req/s', better=HIGHER,
+              requests=len(latencies), errors=errors[0])
+    suite.add(name + ' p50', percentile(50), 'ms')
+    suite.add(name + ' p99', percentile(99), 'ms')
+
+
+def metadata():
+    meta = {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count(),
+    }
+    try:
+        meta['commit'] = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return meta
+
+
+def compare(results, baseline, threshold):
+    '''Print how results changed since baseline, returning the names of regressions'''
+    regressions = []
+    print
+    print '%-48s %14s %14s %9s' % ('compared to baseline', 'baseline', 'now', 'change')
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['value'], results[name]['value']
+        if not old:
+            continue
+        change = (new - old) / float(old)
+        worse = change > threshold if results[name]['better'] == LOWER else change < -threshold
+        if worse:
+            regressions.append(name)
+        print '%-48s %14.2f %14.2f %+8.1f%%%s' % (name, old, new, change * 100,
+                                                 '  REGRESSION' if worse else '')
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--output', help='write results to this json file')
+    parser.add_option('--baseline', help='compare to the results in this json file')
+    parser.add_option('--threshold', type='float', default=0.1,
+                      help='relative change reported as a regression (default 0.1)')
+    parser.add_option('--only', help='comma separated prefixes of benchmarks to run')
+    parser.add_option('--repeat', type='int', default=5,
+                      help='runs of each microbenchmark, the best is kept')
+    parser.add_option('--number', type='int',
+                      help='calls per run of each microbenchmark (default depends on it)')
+    parser.add_option('--concurrency', default='1,8,32',
+                      help='comma separated concurrency levels of end-to-end runs')
+    parser.add_option('--seconds', type='float', default=3.0,
+                      help='duration of each end-to-end run')
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='latency added by the stand-in server, in seconds')
+    options, args = parser.parse_args()
+
+    suite = Suite(only=options.only and options.only.split(','), repeat=options.repeat,
+                  number=options.number)
+    bench_signing(suite)
+    bench_codecs(suite)
+    bench_pack(suite)
+    bench_pipeline(suite)
+    bench_end_to_end(suite, [int(c) for c in options.concurrency.split(',')],
+                     options.seconds, options.latency)
+
+    document = {'meta': metadata(), 'results': suite.results}
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)['results']
+        if compare(suite.results, baseline, options.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/bin/env python
+"""
+Measures the per item cost of packing and unpacking GenDynamoTable items,
+with and without a schema, and of reading lazy items.
+
+    python benchmarks/unpack.py [--items N] [--number N]
+"""
+
+import optparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from asyncdynamo.gendynamo import GenDynamoTable
+
+SCHEMA = {'ts': int, 'url': str, 'clicks': int, 'tags': 'SS'}
+
+
+def make_item(i):
+    return {
+        'user': 'user%08d' % i,
+        'ts': 1360000000 + i,
+        'url': 'http://example.com/%s' % ('x' * random.randint(20, 80)),
+        'clicks': random.randint(0, 100000),
+        'tags': set('tag%d' % random.randint(0, 50) for j in range(5)),
+    }
+
+
+def bench(count, number):
+    random.seed(0)
+    plain = GenDynamoTable((str, 'user'), (int, 'ts'))
+    compiled = GenDynamoTable((str, 'user'), (int, 'ts'), schema=SCHEMA)
+    items = [make_item(i) for i in range(count)]
+    packed = map(plain._pack, items)
+    assert map(compiled._pack, items) == packed
+    assert compiled._unpack_items(packed) == plain._unpack_items(packed) == items
+
+    def per_item(seconds):
+        return seconds * 1e6 / number / count
+
+    results = [
+        ('pack, no schema', timeit.timeit(lambda: map(plain._pack, items), number=number)),
+        ('pack, schema', timeit.timeit(lambda: map(compiled._pack, items), number=number)),
+        ('unpack, no schema', timeit.timeit(lambda: map(plain._unpack, packed), number=number)),
+        ('unpack, schema', timeit.timeit(lambda: map(compiled._unpack, packed), number=number)),
+        ('unpack_items, schema', timeit.timeit(lambda: compiled._unpack_items(packed),
+                                               number=number)),
+        ('lazy, read 1 attribute', timeit.timeit(
+            lambda: [item['clicks'] for item in plain._unpack_items(packed, lazy=True)],
+            number=number)),
+        ('lazy, read all', timeit.timeit(
+            lambda: map(dict, plain._unpack_items(packed, lazy=True)), number=number)),
+    ]
+    print '%-24s %12s' % ('%d items' % count, 'us per item')
+    for name, seconds in results:
+        print '%-24s %12.2f' % (name, per_item(seconds))
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('--items', type='int', default=1000,
+                      help='items per call')
+    parser.add_option('--number', type='int', default=20,
+                      help='iterations per measurement')
+    options, args = parser.parse_args()
+    bench(options.items, options.number)
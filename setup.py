@@ -18,7 +18,12 @@ setup(
         "License :: OSI Approved :: Apache Software License",
     ],
     packages=['asyncdynamo'],
-    install_requires=['tornado', 'boto', 'simplejson'],
+    install_requires=['tornado>=3.0', 'boto', 'simplejson'],
+    # asyncdynamo.transport.HTTPTransport only keeps connections alive with pycurl
+    extras_require={'curl': ['pycurl']},
     requires=['tornado'],
+    entry_points={
+        'console_scripts': ['asyncdynamo-loadgen = asyncdynamo.loadgen:main'],
+    },
     download_url="http://github.com/downloads/bitly/asyncdynamo/asyncdynamo-%s.tar.gz" % version,
 )